@@ -1,16 +1,29 @@
 import os
+from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify, abort
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from flask_migrate import Migrate
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeout
 
 from forms import UserAddForm, LoginForm, MessageForm, CsrfOnlyForm, UserEditForm
-from models import db, connect_db, User, Message, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL, Like
+from fragments import fragment_cache
+from http_cache import http_cache
+from instrumentation import instrumentation
+from jobs import jobs
+from models import (
+    db, connect_db, User, CurrentUser, Message, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL,
+    Like, TimelineEntry, Follows, FollowSuggestion, Trending, TrendingCount, AccountPurge,
+    USERS_PER_PAGE, make_feed)
+from pagination import paginate
+from passwords import HashingBusy
+from search import user_search, message_search
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_SNAPSHOT_KEY = "curr_user_snapshot"
 
 app = Flask(__name__)
 
@@ -19,12 +32,44 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
+# Read replicas for GET requests, if any (see replicas.py)
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    url.strip().replace("postgres://", "postgresql://")
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+app.config['REPLICA_MAX_LAG'] = float(os.environ.get('REPLICA_MAX_LAG', 2))
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False #Switch to true for redirects
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+# bcrypt work factor, and how many hashes may run / wait at once per process
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 8))
+# Log requests running more than this many SQL queries (likely N+1s)
+app.config['N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 20))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Rendered-card cache: 'lru', 'memcached' (on FRAGMENT_CACHE_SERVERS) or 'off'
+app.config['FRAGMENT_CACHE'] = os.environ.get('FRAGMENT_CACHE', 'lru')
+app.config['FRAGMENT_CACHE_SERVERS'] = os.environ.get('FRAGMENT_CACHE_SERVERS')
+# Background jobs: 'queue' (run by `flask run-jobs` workers) or, for tests
+# and development, 'eager' (inline; see jobs.py)
+app.config['JOBS_MODE'] = os.environ.get('JOBS_MODE', 'queue')
+# Connection pool per process, and PgBouncer transaction pooling (see pooling.py)
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+app.config['DB_STATEMENT_TIMEOUT'] = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+app.config['DB_PGBOUNCER'] = os.environ.get('DB_PGBOUNCER', '0') == '1'
 toolbar = DebugToolbarExtension(app)
 #``
 connect_db(app)
+instrumentation.init_app(app)
+fragment_cache.init_app(app)
+http_cache.init_app(app)
+jobs.init_app(app)
+migrate = Migrate(app, db)
 
 
 ##############################################################################
@@ -33,10 +78,21 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a CurrentUser: identity comes from the snapshot cached in the
+    session, checked with a single query on users.version. The full User is
+    only loaded if a route touches something beyond the snapshot.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        snapshot = session.get(CURR_USER_SNAPSHOT_KEY)
+        g.user = CurrentUser.load(session[CURR_USER_KEY], snapshot)
+
+        if g.user is None:
+            do_logout()
+        elif g.user.snapshot != snapshot:
+            session[CURR_USER_SNAPSHOT_KEY] = g.user.snapshot
 
     else:
         g.user = None
@@ -45,6 +101,7 @@ def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_SNAPSHOT_KEY] = CurrentUser.snapshot_of(user)
 
 def do_logout():
     """Log out user."""
@@ -52,16 +109,47 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(CURR_USER_SNAPSHOT_KEY, None)
+
 @app.before_request
 def add_csrf_form_to_all_pages():
     """Before every route, add CSRF-only form to global object."""
 
     g.csrf_form = CsrfOnlyForm()
 
+@app.template_global()
+def next_page_url(cursor):
+    """URL for the next page of the current listing, keeping other args."""
+
+    args = request.args.to_dict()
+    args['before'] = cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+def feed_validators(feed, author_version):
+    """What a Feed's page shows (for http_cache.check) and its newest time.
+
+    `author_version(msg)` gives the version of the user shown on a message.
+    """
+
+    shown = ([(msg.id, author_version(msg), msg.like_count) for msg in feed.messages],
+             sorted(feed.liked_ids),
+             feed.next_cursor)
+    newest = max((msg.timestamp for msg in feed.messages), default=None)
+
+    return shown, newest
+
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template("404.html"), 404
 
+@app.errorhandler(HashingBusy)
+def hashing_busy(e):
+    return render_template("503.html"), 503
+
+@app.errorhandler(PoolTimeout)
+def pool_exhausted(e):
+    return render_template("503.html"), 503
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -113,6 +201,8 @@ def login():
             form.password.data)
 
         if user:
+            #save the password if authenticate re-hashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -145,7 +235,9 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames, bios and
+    locations (returns the best matches, unpaged), or a 'before' cursor for
+    the next page of all users.
     """
 
     if not g.user:
@@ -155,11 +247,32 @@ def list_users():
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        page = paginate(User.query, [User.id], request.args.get('before'), USERS_PER_PAGE)
+        users, next_cursor = page
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, next_cursor = user_search.search(search), None
+
+    following_ids = g.user.following_status([user.id for user in users])
+
+    return render_template('users/index.html',
+                           users=users,
+                           next_cursor=next_cursor,
+                           following_ids=following_ids)
+
+
+@app.get('/users/typeahead')
+def users_typeahead():
+    """JSON list of users whose username starts with the 'q' param."""
 
-    return render_template('users/index.html', users=users)
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    users = user_search.typeahead(request.args.get('q'))
+
+    return jsonify(users=[
+        dict(id=user.id, username=user.username, image_url=user.image_url)
+        for user in users
+    ])
 
 
 @app.get('/users/<int:user_id>')
@@ -170,9 +283,21 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    profile = User.profile_bundle(user_id, g.user, request.args.get('before'))
+    user = profile.user
+
+    shown, newest = feed_validators(profile.feed, lambda msg: user.version)
+    not_modified = http_cache.check(
+        'profile', user.id, user.version, user.message_count,
+        user.following_count, user.follower_count, user.liked_count,
+        g.user.is_following(user), shown,
+        last_modified=newest)
+    if not_modified:
+        return not_modified
 
-    return render_template('users/show.html', user=user)
+    return render_template('users/show.html',
+                           user=profile.user,
+                           **profile.feed._asdict())
 
 
 @app.get('/users/<int:user_id>/following')
@@ -184,7 +309,18 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following = (User
+                 .query
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user.id))
+    page = paginate(following, [User.id], request.args.get('before'), USERS_PER_PAGE)
+    following_ids = g.user.following_status([user.id for user in page.items])
+
+    return render_template('users/following.html',
+                           user=user,
+                           following=page.items,
+                           next_cursor=page.next_cursor,
+                           following_ids=following_ids)
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -196,7 +332,18 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers = (User
+                 .query
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user.id))
+    page = paginate(followers, [User.id], request.args.get('before'), USERS_PER_PAGE)
+    following_ids = g.user.following_status([user.id for user in page.items])
+
+    return render_template('users/followers.html',
+                           user=user,
+                           followers=page.items,
+                           next_cursor=page.next_cursor,
+                           following_ids=following_ids)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -211,8 +358,12 @@ def start_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+
+    if followed_user.id == g.user.id:
+        flash("You can't follow yourself!", "danger")
+    else:
+        g.user.follow(followed_user)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -229,8 +380,11 @@ def stop_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+
+    #unfollowing yourself would take your own warbles off your timeline
+    if followed_user.id != g.user.id:
+        g.user.unfollow(followed_user)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -244,7 +398,11 @@ def show_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/liked_messages.html', user=user)
+    feed = Message.liked_by(user, g.user, request.args.get('before'))
+
+    return render_template('users/liked_messages.html',
+                           user=user,
+                           **feed._asdict())
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -255,21 +413,24 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    form = UserEditForm(obj=g.user)
+    user = g.user.model
+    form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
-        g.user.username = form.username.data
-        g.user.email = form.email.data
+        user.username = form.username.data
+        user.email = form.email.data
         #defaults for falsy values from form submission:
-        g.user.image_url = form.image_url.data or DEFAULT_IMAGE_URL
-        g.user.header_image_url = form.header_image_url.data or DEFAULT_HEADER_IMAGE_URL
-        g.user.bio = form.bio.data
-        g.user.location = form.location.data
+        user.image_url = form.image_url.data or DEFAULT_IMAGE_URL
+        user.header_image_url = form.header_image_url.data or DEFAULT_HEADER_IMAGE_URL
+        user.bio = form.bio.data
+        user.location = form.location.data
+        #invalidates cached snapshots of this user in every session
+        user.version = User.version + 1
 
-        if User.authenticate(g.user.username, form.password.data):
+        if user.check_password(form.password.data):
 
             db.session.commit()
-            return redirect(f"/users/{g.user.id}")
+            return redirect(f"/users/{user.id}")
         else:
             flash("Incorrect password!")
 
@@ -291,7 +452,8 @@ def delete_user():
     if form.validate_on_submit() and g.user:
         do_logout()
 
-        db.session.delete(g.user)
+        #hidden now; their rows are deleted in batches in the background
+        g.user.tombstone()
         db.session.commit()
 
         flash("User deleted!", "danger")
@@ -321,8 +483,7 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        g.user.add_message(form.text.data)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -330,6 +491,76 @@ def add_message():
     return render_template('messages/create.html', form=form)
 
 
+@app.get('/messages/search')
+def search_messages():
+    """Search warbles.
+
+    Takes 'q' (words, "quoted phrases" and -exclusions), optional 'since'
+    and 'until' dates (YYYY-MM-DD, both inclusive) and a 'before' cursor for
+    the next page. Results are ranked best match first.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    query = request.args.get('q', '').strip()
+    since = parse_date_arg('since')
+    until = parse_date_arg('until')
+
+    if not query:
+        return render_template('messages/search.html', query=query)
+
+    page = message_search.search(
+        query,
+        since=since,
+        until=until and until + timedelta(days=1),
+        before=request.args.get('before'))
+
+    return render_template('messages/search.html',
+                           query=query,
+                           **make_feed(g.user, page)._asdict())
+
+
+@app.get('/trending')
+def trending():
+    """Show the warbles being liked fastest and the users gaining followers
+    fastest.
+
+    Both are precomputed rankings (see TrendingCount), so this is two short
+    indexed reads however busy the site is.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    feed = Trending.messages(g.user)
+    users = Trending.users()
+
+    shown, newest = feed_validators(feed, lambda msg: msg.user.version)
+    not_modified = http_cache.check(
+        'trending', shown, [(user.id, user.version) for user in users])
+    if not_modified:
+        return not_modified
+
+    return render_template('messages/trending.html', users=users,
+                           **feed._asdict())
+
+
+def parse_date_arg(name):
+    """Parse the YYYY-MM-DD query arg `name` as a datetime, or 400."""
+
+    value = request.args.get(name)
+    if not value:
+        return None
+
+    try:
+        return datetime.combine(date.fromisoformat(value), datetime.min.time())
+    except ValueError:
+        abort(400)
+
+
 @app.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
@@ -338,10 +569,40 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    msg = (Message
+           .query
+           .options(db.joinedload(Message.user))
+           .filter_by(id=message_id)
+           .first_or_404())
+
+    not_modified = http_cache.check(
+        'message', msg.id, msg.user.version, g.user.is_following(msg.user),
+        msg.like_count, last_modified=msg.timestamp)
+    if not_modified:
+        return not_modified
+
     return render_template('messages/show.html', message=msg)
 
 
+@app.get('/messages/<int:message_id>/likes')
+def show_message_likes(message_id):
+    """Show the users who liked a message, a page at a time."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    msg = Message.query.get_or_404(message_id)
+    page = msg.likers(request.args.get('before'))
+    following_ids = g.user.following_status([user.id for user in page.items])
+
+    return render_template('messages/likes.html',
+                           message=msg,
+                           users=page.items,
+                           next_cursor=page.next_cursor,
+                           following_ids=following_ids)
+
+
 @app.post('/messages/<int:message_id>/delete')
 def delete_message(message_id):
     """Delete a message.
@@ -355,10 +616,10 @@ def delete_message(message_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
-    if msg not in g.user.messages:
+    if msg.user_id != g.user.id:
         flash("You can't delete someone else's message!", "danger")
     else:
-        db.session.delete(msg)
+        g.user.delete_message(msg)
         db.session.commit()
         flash("Warble deleted.", "success")
 
@@ -375,10 +636,10 @@ def like_message(message_id):
 
     msg = Message.query.get_or_404(message_id)
 
-    if msg in g.user.messages:
+    if msg.user_id == g.user.id:
         flash("You can't like your own messages!", "danger")
     else:
-        g.user.liked_messages.append(msg)
+        g.user.like(msg)
         #add flash
         db.session.commit()
         flash("Warble liked!", "success")
@@ -396,10 +657,10 @@ def unlike_message(message_id):
 
     msg = Message.query.get_or_404(message_id)
 
-    if msg in g.user.messages:
+    if msg.user_id == g.user.id:
         flash("You can't unlike your own messages!", "danger")
     else:
-        g.user.liked_messages.remove(msg)
+        g.user.unlike(msg)
         db.session.commit()
         flash("Warble removed from likes.", "success")
 
@@ -417,35 +678,82 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
+
+    Reads the user's materialized timeline (see TimelineEntry), so this is a
+    single range scan however many users they follow. The "who to follow"
+    sidebar is likewise precomputed (see FollowSuggestion).
     """
 
     if g.user:
-        user_following = [u.id for u in g.user.following]
-        messages = (Message
-                    .query
-                    .filter((Message.user_id.in_(user_following)) | (Message.user_id == g.user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+        feed = Message.timeline_for(g.user, request.args.get('before'))
+        suggestions = FollowSuggestion.for_user(g.user)
+        user = g.user.model
+
+        shown, newest = feed_validators(feed, lambda msg: msg.user.version)
+        not_modified = http_cache.check(
+            'home', user.header_image_url, user.message_count,
+            user.following_count, user.follower_count, shown,
+            [(suggested.id, suggested.version) for suggested in suggestions],
+            last_modified=newest)
+        if not_modified:
+            return not_modified
+
+        return render_template('home.html', suggestions=suggestions,
+                               **feed._asdict())
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(response):
-    """Add non-caching headers on every request."""
-
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
+# Maintenance commands
+
+
+@app.cli.command("backfill-timelines")
+def backfill_timelines():
+    """Rebuild every user's home timeline from existing messages and follows."""
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+
+
+@app.cli.command("refresh-suggestions")
+def refresh_suggestions():
+    """Queue a recompute of every user's "who to follow" suggestions."""
+
+    for user_ids in FollowSuggestion.user_batches():
+        FollowSuggestion.refresh_later(user_ids)
+        db.session.commit()
+
+
+@app.cli.command("compact-trending")
+def compact_trending():
+    """Recompute the trending rankings, dropping counts that have aged out.
+
+    Workers do this periodically; this runs it now.
+    """
+
+    TrendingCount.compact()
+    db.session.commit()
+
+
+@app.cli.command("purge-accounts")
+def purge_accounts():
+    """Finish deleting the rows of deleted accounts, a batch per transaction."""
+
+    unfinished = AccountPurge.query.filter(AccountPurge.finished_at.is_(None))
+    for purge in unfinished.all():
+        while purge.step():
+            db.session.commit()
+        db.session.commit()
+
+
+@app.cli.command("reconcile-counters")
+def reconcile_counters():
+    """Recompute every user's message/follow/like counters and every
+    message's like count."""
+
+    User.reconcile_counters()
+    Message.reconcile_counters()
+    db.session.commit()
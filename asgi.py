@@ -0,0 +1,46 @@
+"""Warbler as an ASGI application, for ASGI servers such as uvicorn:
+
+    uvicorn asgi:app
+    WARBLER_SERVER_MODE=asgi gunicorn -c gunicorn.conf.py
+
+The Flask app stays WSGI: each request runs the same view code, with the
+same per-request database session, on one of ASGI_THREADS threads, while
+the server's event loop handles the connections.
+
+asgiref's own WsgiToAsgi runs every request on one shared thread (its
+sync_to_async default), which would serve a whole worker's requests one
+at a time; requests here go to a thread pool instead.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgiInstance
+
+from app import app as wsgi_app
+
+DEFAULT_THREADS = 16
+
+
+class ThreadedWsgiToAsgi:
+    """Like asgiref's WsgiToAsgi, but running requests on a pool of
+    `threads` threads."""
+
+    def __init__(self, wsgi_application, threads=DEFAULT_THREADS):
+        self.wsgi_application = wsgi_application
+        executor = ThreadPoolExecutor(threads, thread_name_prefix="asgi")
+
+        class Instance(WsgiToAsgiInstance):
+            run_wsgi_app = sync_to_async(
+                WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+                thread_sensitive=False, executor=executor)
+
+        self.instance_class = Instance
+
+    async def __call__(self, scope, receive, send):
+        await self.instance_class(self.wsgi_application)(scope, receive, send)
+
+
+app = ThreadedWsgiToAsgi(
+    wsgi_app, threads=int(os.environ.get('ASGI_THREADS', DEFAULT_THREADS)))
@@ -0,0 +1,469 @@
+"""Load-test Warbler and compare latencies against a saved baseline.
+
+Run it against a scratch database, since it resets and reseeds it:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmark.py \\
+        --users 10000 --messages 100000 --follows 500000 --likes 200000
+    python benchmark.py --skip-seed --save-baseline   # record a new baseline
+    python benchmark.py --skip-seed                   # fail on regressions
+
+The dataset is made by generator/create_csvs.py and loaded with seed.py.
+The app is then served in-process on a threaded werkzeug server (or pass
+--url to hit a server you started yourself), and --concurrency logged-in
+clients each send a weighted mix of requests (ROUTES) for --duration
+seconds.
+
+For each route it reports p50/p95/p99 latency, throughput and SQL queries
+per request (read from the app's Server-Timing header). With a baseline file present
+the run fails (exit status 1) if a route's p95 grows by more than
+--tolerance, or it makes more queries than before.
+
+To compare the server modes in gunicorn.conf.py at equal memory:
+
+    python benchmark.py --skip-seed --server-modes sync,gevent,asgi \\
+        --concurrency 64 --memory-budget 600
+
+Each mode is started under gunicorn with one worker and put under load
+briefly to measure a warmed-up worker's memory. It's then restarted with as
+many workers as fit in --memory-budget MB and benchmarked. (Linux only: memory
+is read from /proc.)
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import socket
+import threading
+import time
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+
+from werkzeug.serving import make_server
+
+from app import app
+from models import db, User, Message
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+# Every generated user has this password (see generator/create_csvs.py)
+BENCHMARK_PASSWORD = 'password'
+
+LOGIN_ATTEMPTS = 10
+
+# The query count the app reports in its Server-Timing header
+QUERY_COUNT_RE = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+# (route name, relative weight)
+ROUTES = [
+    ('home', 8),
+    ('users', 2),
+    ('user', 4),
+    ('followers', 2),
+    ('like', 2),
+    ('unlike', 2),
+    ('new message', 1),
+]
+
+Sample = namedtuple("Sample", ["elapsed", "queries", "status", "body"])
+
+CSRF_TOKEN_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=50000)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="reuse the data already in the database")
+    parser.add_argument('--url', help="benchmark this server instead of "
+                        "serving the app in-process")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed fractional p95 growth over the baseline")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--server-modes', help="compare these comma-separated "
+                        "WARBLER_SERVER_MODEs under gunicorn (see gunicorn.conf.py)")
+    parser.add_argument('--memory-budget', type=float, default=512,
+                        help="MB of worker memory each server mode gets")
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        seed_dataset(args)
+
+    if args.server_modes:
+        compare_modes(args.server_modes.split(','), args)
+        return
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = serve_in_process()
+
+    try:
+        results = run_load(url, args)
+    finally:
+        if server:
+            server.shutdown()
+
+    report(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f"\nsaved baseline to {args.baseline}")
+
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressions = compare(json.load(baseline_file), results, args.tolerance)
+
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+
+        if regressions:
+            sys.exit(1)
+
+
+def seed_dataset(args):
+    """Generate a dataset of the requested size and load it."""
+
+    import seed
+
+    with tempfile.TemporaryDirectory() as out:
+        subprocess.run([
+            sys.executable, 'generator/create_csvs.py',
+            '--users', str(args.users),
+            '--messages', str(args.messages),
+            '--follows', str(args.follows),
+            '--likes', str(args.likes),
+            '--seed', str(args.seed),
+            '--out', out,
+        ], check=True, stdout=subprocess.DEVNULL)
+
+        with app.app_context():
+            seed.seed(out, defer_indexes=True)
+
+
+##############################################################################
+# Serving
+
+
+def serve_in_process():
+    """Serve the app on a threaded werkzeug server in a background thread."""
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+@contextmanager
+def serve_gunicorn(mode, workers):
+    """Run gunicorn in server mode `mode`; yields (url, master pid)."""
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    env = dict(os.environ, WARBLER_SERVER_MODE=mode,
+               WEB_CONCURRENCY=str(workers), PORT=str(port))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+
+    try:
+        wait_until_up(url, server)
+        yield url, server.pid
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def wait_until_up(url, server, timeout=30):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+        try:
+            build_opener().open(url + '/login').read()
+            return
+        except OSError:
+            time.sleep(0.2)
+
+    raise RuntimeError(f"gunicorn didn't answer on {url}")
+
+
+def workers_memory(master_pid):
+    """Total resident memory of `master_pid`'s worker processes, in MB."""
+
+    total_kb = 0
+
+    for pid in os.listdir('/proc'):
+        try:
+            with open(f'/proc/{pid}/stat') as stat:
+                #the command name (field 2) may contain spaces; ppid follows it
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+            if ppid != master_pid:
+                continue
+
+            with open(f'/proc/{pid}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+
+    return total_kb / 1024
+
+
+##############################################################################
+# Load
+
+
+class NoRedirects(HTTPRedirectHandler):
+    """Time each request on its own, without following its redirect."""
+
+    def redirect_request(self, *args):
+        return None
+
+
+class Client:
+    """A logged-in user sending a random mix of requests."""
+
+    def __init__(self, url, username, user_count, message_count, rng):
+        self.url = url
+        self.rng = rng
+        self.user_count = user_count
+        self.message_count = message_count
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirects())
+
+        page = self.request('GET', '/login').body
+        self.csrf_token = CSRF_TOKEN_RE.search(page).group(1)
+
+        #a crowd of clients logging in at once can fill the bcrypt queue (503)
+        for attempt in range(LOGIN_ATTEMPTS):
+            login = self.request('POST', '/login',
+                                 dict(username=username, password=BENCHMARK_PASSWORD))
+            if login.status != 503:
+                break
+            time.sleep(rng.uniform(0.5, 2))
+
+        if login.status != 302:
+            raise RuntimeError(f"couldn't log in as {username}")
+
+        #messages this client has liked, so it only unlikes those
+        self.liked = set()
+
+    def request(self, method, path, data=None):
+        """Send a request and time it; returns a Sample."""
+
+        if data is not None:
+            data = urlencode(dict(data, csrf_token=self.csrf_token)).encode()
+
+        started = time.perf_counter()
+        try:
+            response = self.opener.open(self.url + path, data)
+        except HTTPError as error:
+            #redirects and error responses both arrive as HTTPError
+            response = error
+
+        body = response.read().decode()
+        elapsed = time.perf_counter() - started
+
+        queries = QUERY_COUNT_RE.search(response.headers.get('Server-Timing', ''))
+        return Sample(elapsed, queries and int(queries.group(1)), response.status, body)
+
+    def send(self, route):
+        """Send one request for `route`."""
+
+        user_id = self.rng.randint(1, self.user_count)
+        message_id = self.rng.randint(1, self.message_count)
+
+        if route == 'home':
+            return self.request('GET', '/')
+        if route == 'users':
+            return self.request('GET', '/users')
+        if route == 'user':
+            return self.request('GET', f'/users/{user_id}')
+        if route == 'followers':
+            return self.request('GET', f'/users/{user_id}/followers')
+        if route == 'like' and message_id not in self.liked:
+            self.liked.add(message_id)
+            return self.request('POST', f'/messages/{message_id}/like', {})
+        if route == 'unlike' and self.liked:
+            message_id = self.liked.pop()
+            return self.request('POST', f'/messages/{message_id}/unlike', {})
+        if route == 'new message':
+            return self.request('POST', '/messages/new', dict(text="Benchmarking!"))
+
+        #nothing sensible to send (e.g. unlike with nothing liked)
+        return None
+
+
+def run_load(url, args):
+    """Drive the server with concurrent clients; return per-route stats."""
+
+    with app.app_context():
+        user_count = db.session.query(db.func.max(User.id)).scalar()
+        message_count = db.session.query(db.func.max(Message.id)).scalar()
+        usernames = [
+            username for username, in
+            db.session.query(User.username).order_by(User.id).limit(args.concurrency)
+        ]
+        db.session.remove()
+
+    names, weights = zip(*ROUTES)
+    samples = defaultdict(list)
+    errors = []
+    start = time.monotonic() + args.warmup
+    stop = start + args.duration
+
+    def work(username, seed):
+        rng = random.Random(seed)
+        try:
+            client = Client(url, username, user_count, message_count, rng)
+
+            while time.monotonic() < stop:
+                route = rng.choices(names, weights)[0]
+                sample = client.send(route)
+                if sample and time.monotonic() >= start:
+                    samples[route].append(sample)
+
+        except Exception as error:
+            errors.append(error)
+
+    threads = [
+        threading.Thread(target=work, args=(username, f"{args.seed}-{i}"))
+        for i, username in enumerate(usernames)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return {route: summarize(route_samples, args.duration)
+            for route, route_samples in sorted(samples.items())}
+
+
+##############################################################################
+# Reporting
+
+
+def summarize(samples, duration):
+    latencies = sorted(sample.elapsed for sample in samples)
+    queries = [sample.queries for sample in samples if sample.queries is not None]
+
+    return dict(
+        requests=len(samples),
+        errors=sum(sample.status >= 400 for sample in samples),
+        throughput=len(samples) / duration,
+        p50=percentile(latencies, 50) * 1000,
+        p95=percentile(latencies, 95) * 1000,
+        p99=percentile(latencies, 99) * 1000,
+        queries=sum(queries) / len(queries) if queries else None,
+    )
+
+
+def percentile(ordered, pct):
+    """The `pct` percentile of an already sorted list."""
+
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def report(results):
+    print(f"{'route':<14}{'reqs':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>9}"
+          f"{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}")
+
+    for route, stats in results.items():
+        queries = "-" if stats['queries'] is None else f"{stats['queries']:.1f}"
+        print(f"{route:<14}{stats['requests']:>8}{stats['errors']:>8}"
+              f"{stats['throughput']:>9.1f}{stats['p50']:>9.1f}"
+              f"{stats['p95']:>9.1f}{stats['p99']:>9.1f}{queries:>9}")
+
+    total = sum(stats['throughput'] for stats in results.values())
+    print(f"\ntotal throughput: {total:.1f} req/s")
+
+
+def compare_modes(modes, args):
+    """Benchmark each server mode with the workers that fit the memory budget."""
+
+    warmup_args = argparse.Namespace(**dict(vars(args), duration=5, warmup=1))
+    rows = []
+
+    for mode in modes:
+        with serve_gunicorn(mode, workers=1) as (url, pid):
+            run_load(url, warmup_args)
+            worker_mb = workers_memory(pid)
+
+        workers = max(1, int(args.memory_budget // worker_mb))
+        print(f"{mode}: {worker_mb:.0f} MB per worker, running {workers}")
+
+        with serve_gunicorn(mode, workers) as (url, pid):
+            results = run_load(url, args)
+            memory = workers_memory(pid)
+
+        rows.append((mode, workers, memory, results))
+
+    print(f"\n{'mode':<10}{'workers':>8}{'MB':>8}{'req/s':>9}{'errors':>8}"
+          f"{'home p95':>10}{'worst p95':>11}")
+
+    for mode, workers, memory, results in rows:
+        throughput = sum(stats['throughput'] for stats in results.values())
+        errors = sum(stats['errors'] for stats in results.values())
+        home = results.get('home', {}).get('p95', 0)
+        worst = max(stats['p95'] for stats in results.values())
+
+        print(f"{mode:<10}{workers:>8}{memory:>8.0f}{throughput:>9.1f}{errors:>8}"
+              f"{home:>10.1f}{worst:>11.1f}")
+
+
+def compare(baseline, results, tolerance):
+    """Describe each way `results` is worse than `baseline`."""
+
+    regressions = []
+
+    for route, stats in results.items():
+        before = baseline.get(route)
+        if before is None:
+            continue
+
+        if stats['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append(
+                f"{route}: p95 {stats['p95']:.1f}ms, was {before['p95']:.1f}ms")
+
+        if stats['errors'] > before['errors']:
+            regressions.append(
+                f"{route}: {stats['errors']} errors, was {before['errors']}")
+
+        if (stats['queries'] is not None and before['queries'] is not None
+                and stats['queries'] > before['queries'] + 0.5):
+            regressions.append(
+                f"{route}: {stats['queries']:.1f} queries, was {before['queries']:.1f}")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""Fragment cache for rendered message and user cards.
+
+A card looks the same to every viewer except for its controls (the like
+star, the follow button). Templates render a card through the
+`cached_fragment` template global, marking where the controls go with
+`fragment_slot`:
+
+    {% call cached_fragment('message', msg.id, author.version,
+                            slot=star(msg)) %}
+      <li> ... {{ fragment_slot }} ... </li>
+    {% endcall %}
+
+The viewer-independent HTML is stored under the card's kind and id along
+with the version of the user it shows; the current viewer's controls are
+then filled into the slot. A different version counts as a miss, so a
+profile edit (which bumps users.version) retires every card showing that
+user. Deleting a message or user, or editing a profile, also deletes the
+cached card outright, so other processes sharing a memcached see it too.
+
+Backends, chosen by FRAGMENT_CACHE:
+
+- 'lru' (default): an in-process LRU of FRAGMENT_CACHE_SIZE cards
+- 'memcached': any memcached client, on FRAGMENT_CACHE_SERVERS
+  ("host:port,..."; needs pymemcache), or if that's unset an in-process
+  stand-in with the same client API, capped at FRAGMENT_CACHE_BYTES
+- 'off': always render
+
+Bump FRAGMENT_FORMAT whenever the card templates change, so cards rendered
+by old code aren't served.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from flask import g, has_app_context
+from markupsafe import Markup
+from sqlalchemy import event, inspect
+
+from instrumentation import instrumentation
+from models import User, Message
+
+FRAGMENT_FORMAT = 1
+
+DEFAULT_SIZE = 10_000
+DEFAULT_BYTES = 64 * 1024 * 1024
+
+# Where the viewer's controls go in a cached card
+SLOT = "<!--fragment-slot-->"
+
+
+class LRUBackend:
+    """In-process store of (version, html), evicting least recently used."""
+
+    def __init__(self, max_items=DEFAULT_SIZE):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get_many(self, keys):
+        found = {}
+
+        with self.lock:
+            for key in keys:
+                if key in self.items:
+                    self.items.move_to_end(key)
+                    found[key] = self.items[key]
+
+        return found
+
+    def set(self, key, version, html):
+        with self.lock:
+            self.items[key] = (version, html)
+            self.items.move_to_end(key)
+
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class MemcachedBackend:
+    """Stores (version, html) as bytes through a memcached client
+    (anything with pymemcache's get_many/set/delete)."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def get_many(self, keys):
+        found = {}
+
+        for key, value in self.client.get_many(keys).items():
+            version, html = value.split(b"|", 1)
+            found[key] = (int(version), html.decode())
+
+        return found
+
+    def set(self, key, version, html):
+        self.client.set(key, b"%d|%s" % (version, html.encode()))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+class LocalMemcache:
+    """In-process stand-in for a memcached server, speaking the same client
+    API: bytes values, and least recently used items evicted once the total
+    size passes max_bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get_many(self, keys):
+        found = {}
+
+        with self.lock:
+            for key in keys:
+                if key in self.items:
+                    self.items.move_to_end(key)
+                    found[key] = self.items[key]
+
+        return found
+
+    def set(self, key, value, expire=0, noreply=None):
+        with self.lock:
+            self._discard(key)
+            self.items[key] = value
+            self.size += len(key) + len(value)
+
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self.items)))
+
+        return True
+
+    def delete(self, key, noreply=None):
+        with self.lock:
+            return self._discard(key)
+
+    def _discard(self, key):
+        value = self.items.pop(key, None)
+        if value is None:
+            return False
+
+        self.size -= len(key) + len(value)
+        return True
+
+
+class FragmentCache:
+    """Caches rendered cards; configure with init_app."""
+
+    def __init__(self):
+        self.backend = None
+
+        instrumentation.metrics.describe(
+            'warbler_fragment_cache_total', 'counter',
+            "Fragment cache lookups, by kind and hit/miss.")
+
+    def init_app(self, app):
+        """Pick a backend from `app`'s config and add the template globals."""
+
+        kind = app.config.setdefault('FRAGMENT_CACHE', 'lru')
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', DEFAULT_SIZE)
+        app.config.setdefault('FRAGMENT_CACHE_BYTES', DEFAULT_BYTES)
+        app.config.setdefault('FRAGMENT_CACHE_SERVERS', None)
+
+        if kind == 'lru':
+            self.backend = LRUBackend(app.config['FRAGMENT_CACHE_SIZE'])
+
+        elif kind == 'memcached':
+            servers = app.config['FRAGMENT_CACHE_SERVERS']
+
+            if servers:
+                from pymemcache.client.hash import HashClient
+
+                client = HashClient([
+                    (host, int(port)) for host, port in
+                    (server.rsplit(":", 1) for server in servers.split(","))
+                ])
+            else:
+                client = LocalMemcache(app.config['FRAGMENT_CACHE_BYTES'])
+
+            self.backend = MemcachedBackend(client)
+
+        elif kind == 'off':
+            self.backend = None
+
+        else:
+            raise ValueError(f"Unknown FRAGMENT_CACHE {kind!r}")
+
+        app.add_template_global(self.cached, 'cached_fragment')
+        app.add_template_global(self.prefetch, 'prefetch_fragments')
+        app.add_template_global(Markup(SLOT), 'fragment_slot')
+
+    @staticmethod
+    def key(kind, id):
+        return f"fragment:{FRAGMENT_FORMAT}:{kind}:{id}"
+
+    def prefetch(self, kind, ids):
+        """Look up the cards for `ids` in one round trip, ahead of the
+        cached() calls that will want them. Renders as nothing."""
+
+        if self.backend is not None and has_app_context():
+            keys = [self.key(kind, id) for id in ids]
+            found = self.backend.get_many(keys)
+
+            #remember misses too, so cached() doesn't look them up again
+            g.setdefault('prefetched_fragments', {}).update(
+                (key, found.get(key)) for key in keys)
+
+        return ""
+
+    def cached(self, kind, id, version, slot="", caller=None):
+        """The card for (kind, id) at `version` with `slot` filled in,
+        rendering it with caller() on a miss."""
+
+        if self.backend is None:
+            return Markup(caller().replace(SLOT, slot))
+
+        key = self.key(kind, id)
+        prefetched = g.get('prefetched_fragments', {}) if has_app_context() else {}
+
+        if key in prefetched:
+            entry = prefetched[key]
+        else:
+            entry = self.backend.get_many([key]).get(key)
+
+        hit = entry is not None and entry[0] == version
+
+        if hit:
+            html = entry[1]
+        else:
+            html = str(caller())
+            self.backend.set(key, version, html)
+
+        instrumentation.metrics.inc('warbler_fragment_cache_total',
+                                    dict(kind=kind, result="hit" if hit else "miss"))
+
+        return Markup(html.replace(SLOT, str(slot)))
+
+    def forget(self, kind, id):
+        """Drop the cached card for (kind, id)."""
+
+        if self.backend is not None:
+            self.backend.delete(self.key(kind, id))
+
+    def user_changed(self, user):
+        """Drop `user`'s card if their profile (and so version) changed.
+        Cards of their messages miss on the version from now on."""
+
+        if inspect(user).attrs.version.history.has_changes():
+            self.forget('user', user.id)
+
+
+fragment_cache = FragmentCache()
+
+event.listen(User, "after_update",
+             lambda mapper, conn, user: fragment_cache.user_changed(user))
+event.listen(User, "after_delete",
+             lambda mapper, conn, user: fragment_cache.forget('user', user.id))
+event.listen(Message, "after_delete",
+             lambda mapper, conn, msg: fragment_cache.forget('message', msg.id))
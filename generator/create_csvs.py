@@ -1,77 +1,251 @@
 """Generate CSVs of random data for Warbler.
 
 Students won't need to run this for the exercise; they will just use the CSV
-files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+files that this generates. Run it to make bigger datasets for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --likes 20000000 --shards 16 --out generator/data
+    python seed.py --data-dir generator/data --defer-indexes
+
+Each table is split into --shards files (users-00000.csv, ...) written in
+parallel by --workers processes. Every row is produced as it's written, so
+memory use doesn't grow with the row counts, and nothing is fetched over the
+network.
+
+Output is reproducible: each shard has its own random generator seeded from
+--seed, the table and the shard number, so the same arguments always give
+the same files, whatever --workers is.
+
+Who gets followed, whose warbles get liked and who posts are drawn from a
+power law (--skew), so a few users are very popular and most are not. Each
+follows (or likes) shard covers a range of followers (or likers), so
+duplicate pairs only need checking within one user's own draws.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+from collections import Counter
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_random_datetime, scatter, zipf_rank
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+
+# bcrypt hash of "password", shared by every generated user
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# Give up filling a user's follows/likes after this many draws per row
+# (only matters when one user wants most of a heavily skewed population)
+MAX_DRAWS_PER_ROW = 20
 
-fake = Faker()
+# Shuffle authors differently from followed users, so the most followed
+# users aren't also the most prolific (which multiplies timeline sizes)
+AUTHOR_OFFSET = 7919
 
-# Generate random profile image URLs to use for users
+# Latest warble timestamp unless --until is given; fixed, so the same
+# arguments give the same files whenever they're run
+DEFAULT_UNTIL = datetime(2026, 1, 1)
 
-image_urls = [
+# Random profile image URLs to use for users
+
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users (saved once from splashbase)
+
+with open(os.path.join(os.path.dirname(__file__), 'header_image_urls.txt')) as urls_file:
+    HEADER_IMAGE_URLS = urls_file.read().split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=0)
+    parser.add_argument('--shards', type=int, default=1,
+                        help="files to split each table into")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="processes writing shards in parallel")
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help="power-law exponent for popularity (0 = uniform)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=DEFAULT_UNTIL,
+                        help="latest warble timestamp, YYYY-MM-DD "
+                             f"(default {DEFAULT_UNTIL:%Y-%m-%d})")
+    parser.add_argument('--out', default='generator/data')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    tasks = [
+        (table, shard, args)
+        for table in ['users', 'messages', 'follows', 'likes']
+        for shard in range(args.shards)
+    ]
+
+    with Pool(args.workers) as pool:
+        for path, rows in pool.imap_unordered(write_shard, tasks):
+            print(f"wrote {path} ({rows:,} rows)")
+
+
+def write_shard(task):
+    """Write one shard of one table; returns (path, rows written)."""
+
+    table, shard, args = task
+    writer_fn, headers = {
+        'users': (user_rows, USERS_CSV_HEADERS),
+        'messages': (message_rows, MESSAGES_CSV_HEADERS),
+        'follows': (follow_rows, FOLLOWS_CSV_HEADERS),
+        'likes': (like_rows, LIKES_CSV_HEADERS),
+    }[table]
+
+    rng = Random(f"{args.seed}-{table}-{shard}")
+    fake = Faker()
+    fake.seed_instance(f"{args.seed}-{table}-{shard}")
+
+    path = os.path.join(args.out, f"{table}-{shard:05d}.csv")
+    rows = 0
+
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(headers)
+
+        for row in writer_fn(shard, rng, fake, args):
+            writer.writerow(row)
+            rows += 1
+
+    return path, rows
+
+
+def shard_range(total, shard, shards):
+    """The slice [start, end) of 0..total that `shard` is responsible for."""
+
+    return total * shard // shards, total * (shard + 1) // shards
+
+
+def shard_size(total, shard, shards):
+    start, end = shard_range(total, shard, shards)
+    return end - start
+
+
+def user_rows(shard, rng, fake, args):
+    start, end = shard_range(args.users, shard, args.shards)
+
+    for user_id in range(start + 1, end + 1):
+        #suffixing the id keeps usernames and emails unique at any size
+        username = f"{fake.user_name()}{user_id}"
+
+        yield [
+            user_id,
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD_HASH,
+            fake.sentence(),
+            rng.choice(HEADER_IMAGE_URLS),
+            fake.city(),
+        ]
+
+
+def message_rows(shard, rng, fake, args):
+    start, end = shard_range(args.messages, shard, args.shards)
+
+    for message_id in range(start + 1, end + 1):
+        yield [
+            message_id,
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            get_random_datetime(now=args.until, rng=rng),
+            author_of(message_id, args),
+        ]
+
+
+def author_of(message_id, args):
+    """Who posted a warble. Drawn from its own generator seeded by the
+    message id, so like shards can tell authors apart without reading
+    the messages files."""
+
+    rng = Random(f"{args.seed}-author-{message_id}")
+    return popular(rng, args.users, args.skew, offset=AUTHOR_OFFSET)
+
+
+def follow_rows(shard, rng, fake, args):
+    """Follows for this shard's range of followers: followers are picked
+    uniformly, who they follow by popularity."""
+
+    start, end = shard_range(args.users, shard, args.shards)
+    quota = shard_size(args.follows, shard, args.shards)
+
+    for follower_id, count in per_user_counts(rng, start, end, quota, args.users - 1):
+        for followed_id in distinct_draws(rng, count, args.users, args.skew,
+                                          skip=lambda picked: picked == follower_id):
+            yield [followed_id, follower_id]
+
+
+def like_rows(shard, rng, fake, args):
+    """Likes for this shard's range of likers: likers are picked
+    uniformly, which warbles they like by popularity. Nobody likes their
+    own warbles; the app doesn't allow it."""
+
+    start, end = shard_range(args.users, shard, args.shards)
+    quota = shard_size(args.likes, shard, args.shards)
+
+    for user_id, count in per_user_counts(rng, start, end, quota, args.messages):
+        for message_id in distinct_draws(rng, count, args.messages, args.skew,
+                                         skip=lambda picked: author_of(picked, args) == user_id):
+            yield [user_id, message_id]
+
+
+def per_user_counts(rng, start, end, quota, most):
+    """Spread `quota` rows over users start+1..end at random, capping
+    each user at `most`. Yields (user id, count) in id order."""
+
+    if end <= start or most < 1:
+        return
+
+    counts = Counter(rng.randrange(start + 1, end + 1) for _ in range(quota))
+
+    for user_id in sorted(counts):
+        yield user_id, min(counts[user_id], most)
+
+
+def distinct_draws(rng, count, n, skew, skip=None):
+    """Up to `count` distinct ids in 1..n drawn by popularity, leaving out
+    any for which skip(id) is true."""
+
+    seen = set()
+
+    for _ in range(count * MAX_DRAWS_PER_ROW):
+        if len(seen) == count:
+            break
+
+        picked = popular(rng, n, skew)
+        if picked in seen or (skip and skip(picked)):
+            continue
+
+        seen.add(picked)
+        yield picked
+
+
+def popular(rng, n, skew, offset=0):
+    """A random id in 1..n, weighted by a power law over a fixed shuffle
+    of the ids."""
+
+    return scatter(zipf_rank(rng, n, skew), n, offset)
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
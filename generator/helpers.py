@@ -1,14 +1,58 @@
 """Support functions for CSV generation."""
 
+import random
 from datetime import datetime
-from random import uniform
+from functools import lru_cache
+from math import gcd
 
+# Odd multiplier (Knuth's) used to scatter ranks across ids
+SCATTER_MULTIPLIER = 2654435761
 
-def get_random_datetime(year_gap=2):
+
+def get_random_datetime(year_gap=2, now=None, rng=random):
     """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def zipf_rank(rng, n, skew):
+    """Draw a rank in 1..n where rank r is picked in proportion to 1/r**skew.
+
+    Uses the inverse CDF of the continuous power law, so it costs O(1) per
+    draw with no table of n weights. skew=0 is uniform; around 1 gives a
+    few very popular ranks and a long tail.
+    """
+
+    u = rng.random()
+
+    if skew == 1:
+        rank = n ** u
+    else:
+        rank = ((n ** (1 - skew) - 1) * u + 1) ** (1 / (1 - skew))
+
+    return min(int(rank), n)
+
+
+@lru_cache
+def _multiplier(n):
+    """A multiplier coprime to n, so scatter is a bijection on 1..n."""
+
+    a = SCATTER_MULTIPLIER % n or 1
+    while gcd(a, n) != 1:
+        a += 1
+    return a
+
+
+def scatter(rank, n, offset=0):
+    """Map rank 1..n to an id 1..n, one-to-one, spreading popular ranks
+    across the id space instead of bunching them at the first ids.
+
+    Different offsets give different orderings, so separate kinds of
+    popularity (e.g. being followed vs. posting a lot) can be independent.
+    """
+
+    return ((rank - 1) * _multiplier(n) + offset) % n + 1
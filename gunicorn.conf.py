@@ -0,0 +1,51 @@
+"""Gunicorn settings for Warbler (see Procfile).
+
+WARBLER_SERVER_MODE picks how each worker process serves requests:
+
+- 'sync' (default): one request at a time per worker. A slow query or a
+  bcrypt hash holds the whole worker.
+- 'gevent': a worker serves up to GEVENT_CONNECTIONS requests at once on
+  greenlets. psycogreen makes psycopg2 yield to other requests while it
+  waits on Postgres, and passwords.py hashes on native threads so bcrypt
+  doesn't block the loop. Each worker then wants a bigger connection pool,
+  so DB_POOL_SIZE defaults to 20 in this mode.
+- 'asgi': the app behind the ASGI adapter in asgi.py, on uvicorn workers;
+  the event loop holds connections while requests run on ASGI_THREADS
+  threads.
+
+The routes are the same in every mode, and so is the database session's
+lifecycle: Flask-SQLAlchemy scopes the session to the current greenlet
+(which, outside gevent, is one per thread), so each request has its own,
+and it's removed when the request's app context ends.
+
+Set the number of workers with WEB_CONCURRENCY and the port with PORT.
+`python benchmark.py --server-modes sync,gevent` compares the modes.
+"""
+
+import os
+
+SERVER_MODES = ('sync', 'gevent', 'asgi')
+
+mode = os.environ.get('WARBLER_SERVER_MODE', 'sync')
+if mode not in SERVER_MODES:
+    raise ValueError(f"WARBLER_SERVER_MODE must be one of {', '.join(SERVER_MODES)}")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+wsgi_app = 'app:app'
+
+if mode == 'gevent':
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('GEVENT_CONNECTIONS', 100))
+    os.environ.setdefault('DB_POOL_SIZE', '20')
+
+elif mode == 'asgi':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    wsgi_app = 'asgi:app'
+
+
+def post_fork(server, worker):
+    """Make psycopg2 cooperative in gevent workers."""
+
+    if mode == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
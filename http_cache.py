@@ -0,0 +1,157 @@
+"""HTTP caching policy for Warbler.
+
+Static files: url_for('static', ...) adds ?v=<content hash>, and responses
+for a URL whose hash matches are cached by browsers and CDNs for a year as
+immutable. Changing a file changes its URL, so nothing stale is served.
+Unversioned static URLs must revalidate (they still get an ETag).
+
+Pages: views that can say what their page shows call
+
+    not_modified = http_cache.check(<page data>..., last_modified=...)
+    if not_modified:
+        return not_modified
+
+before rendering. The data is hashed into a weak ETag, along with the
+viewer's identity, the templates and the CSRF token's age. A request with
+a matching If-None-Match gets a 304 without the page being rendered. These
+pages are `private, no-cache`: browsers keep them but revalidate every time.
+Last-Modified (the newest warble shown) is sent too, but a 304 needs a
+matching ETag: likes and follows change a page without changing any
+timestamp. Pages with flashed messages waiting are never 304'd.
+
+Everything else stays `no-store`.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from flask import g, request, session
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class HttpCache:
+    """Sets cache headers on every response; configure with init_app."""
+
+    def __init__(self):
+        self.app = None
+        self.static_hashes = {}
+        self.templates_hash = ""
+
+    def init_app(self, app):
+        self.app = app
+        self.templates_hash = self.hash_templates(app)
+
+        app.url_defaults(self.add_static_version)
+        app.after_request(self.set_headers)
+
+    @staticmethod
+    def hash_templates(app):
+        """A hash of every template, so a deploy changing them changes ETags."""
+
+        digest = hashlib.blake2b(digest_size=8)
+        folder = os.path.join(app.root_path, app.template_folder)
+
+        for root, dirs, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as template:
+                    digest.update(template.read())
+
+        return digest.hexdigest()
+
+    ##########################################################################
+    # Static files
+
+    def static_version(self, filename):
+        """A short hash of static file `filename`'s contents (or None)."""
+
+        path = os.path.join(self.app.static_folder, filename)
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+
+        cached = self.static_hashes.get(filename)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rb') as static_file:
+                digest = hashlib.blake2b(static_file.read(), digest_size=6).hexdigest()
+            cached = self.static_hashes[filename] = (mtime, digest)
+
+        return cached[1]
+
+    def add_static_version(self, endpoint, values):
+        if endpoint == 'static' and 'v' not in values:
+            version = self.static_version(values.get('filename', ''))
+            if version:
+                values['v'] = version
+
+    ##########################################################################
+    # Pages
+
+    def check(self, *page_data, last_modified=None):
+        """Set validators for this page; return a 304 response if the
+        client's copy is still current, else None."""
+
+        if session.get('_flashes'):
+            return None
+
+        etag = self.etag(page_data)
+        g.page_validators = (etag, last_modified)
+
+        if request.if_none_match.contains_weak(etag):
+            return self.app.response_class(status=304)
+
+        return None
+
+    def etag(self, page_data):
+        """A weak ETag for `page_data` as seen by the current viewer."""
+
+        #pages embed CSRF tokens, which expire; re-render before they do
+        limit = self.app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        token_age = int(time.time() // (limit / 2)) if limit else 0
+
+        viewer = g.user.snapshot if g.get('user') else None
+
+        #canonical JSON, so a snapshot that's been through the session
+        #(keys sorted, tuples turned into lists) hashes the same as a fresh one
+        raw = json.dumps([self.templates_hash, token_age, viewer, page_data],
+                         default=str, sort_keys=True)
+        return hashlib.blake2b(raw.encode(), digest_size=12).hexdigest()
+
+    ##########################################################################
+    # Headers
+
+    def set_headers(self, response):
+        """Apply the caching policy to every response."""
+
+        if request.endpoint == 'static':
+            version = self.static_version(request.view_args['filename'])
+
+            if version and request.args.get('v') == version:
+                response.cache_control.public = True
+                response.cache_control.max_age = STATIC_MAX_AGE
+                response.cache_control.immutable = True
+            else:
+                response.cache_control.no_cache = True
+
+        elif 'page_validators' in g and response.status_code in (200, 304):
+            etag, last_modified = g.page_validators
+
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+
+        else:
+            response.cache_control.no_store = True
+
+        return response
+
+
+http_cache = HttpCache()
@@ -0,0 +1,322 @@
+"""Per-request timing and metrics for Warbler.
+
+For every request this counts SQL statements and adds up time spent in the
+database, rendering templates and hashing passwords. It reports them three
+ways:
+
+- a Server-Timing header on the response (visible in browser dev tools),
+  e.g. `db;dur=12.5;desc="4 queries", tpl;dur=3.1, app;dur=20.2`
+- Prometheus counters and histograms per endpoint, served at /metrics
+- a warning log line for any request running more than
+  N_PLUS_ONE_THRESHOLD queries, naming the statement it repeated most
+
+Metrics live in process memory, so each worker process reports its own and
+Prometheus should scrape (and sum) them per process. Set METRICS_TOKEN to
+require `Authorization: Bearer <token>` on /metrics, and SERVER_TIMING to
+False to leave the header off.
+
+Other code can time its own work into the current request with
+`instrumentation.timer(name)`, and add scrape-time gauges with
+`instrumentation.metrics.collector(fn)`.
+"""
+
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+from flask import Response, abort, current_app, g, has_app_context, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_N_PLUS_ONE_THRESHOLD = 20
+
+DURATION_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 20, 50, 100)
+
+# Server-Timing metric names for the timers we report
+TIMER_NAMES = {'db': "db", 'template': "tpl", 'bcrypt': "bcrypt"}
+
+
+class Metrics:
+    """A small thread-safe registry of Prometheus counters, histograms and
+    scrape-time gauges, rendered in the text exposition format."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.help = {}
+        self.kinds = {}
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.collectors = []
+
+    def describe(self, name, kind, help):
+        self.kinds[name] = kind
+        self.help[name] = help
+
+    def inc(self, name, labels, amount=1):
+        """Add `amount` to the counter `name` with `labels` (a dict)."""
+
+        with self.lock:
+            self.counters[name, _label_key(labels)] += amount
+
+    def observe(self, name, labels, value, buckets=DURATION_BUCKETS):
+        """Record `value` in the histogram `name` with `labels`."""
+
+        key = (name, _label_key(labels))
+
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def collector(self, fn):
+        """Register fn() to be called at scrape time; it yields
+        (name, labels, value) for gauges that were described up front."""
+
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+
+        samples = defaultdict(list)
+
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples[name].append((name, labels, value))
+
+            for (name, labels), histogram in self.histograms.items():
+                samples[name].extend(histogram.samples(name, labels))
+
+        for fn in self.collectors:
+            for name, labels, value in fn():
+                samples[name].append((name, _label_key(labels), value))
+
+        lines = []
+
+        for name in sorted(samples):
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} {self.kinds.get(name, 'untyped')}")
+
+            for sample_name, labels, value in samples[name]:
+                lines.append(f"{sample_name}{_format_labels(labels)} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+
+class Histogram:
+    """Cumulative bucket counts plus a sum and count."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield f"{name}_bucket", labels + (('le', f"{bound:g}"),), count
+        yield f"{name}_bucket", labels + (('le', "+Inf"),), self.count
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+class RequestTimings:
+    """What one request has spent its time on so far."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.statements = Counter()
+        self.durations = defaultdict(float)
+
+
+class Instrumentation:
+    """Hooks request, template and SQL timing into an app; see init_app."""
+
+    def __init__(self):
+        self.metrics = Metrics()
+
+        self.metrics.describe(
+            'warbler_requests_total', 'counter', "Requests handled.")
+        self.metrics.describe(
+            'warbler_request_duration_seconds', 'histogram',
+            "Time to build each response.")
+        self.metrics.describe(
+            'warbler_request_queries', 'histogram',
+            "SQL statements run per request.")
+        self.metrics.describe(
+            'warbler_db_seconds_total', 'counter',
+            "Time spent running SQL statements.")
+        self.metrics.describe(
+            'warbler_template_seconds_total', 'counter',
+            "Time spent rendering templates.")
+        self.metrics.describe(
+            'warbler_bcrypt_seconds_total', 'counter',
+            "Time spent waiting for password hashes.")
+        self.metrics.describe(
+            'warbler_n_plus_one_requests_total', 'counter',
+            "Requests that ran more than N_PLUS_ONE_THRESHOLD queries.")
+
+    def init_app(self, app):
+        """Install the request, template and SQL hooks and /metrics on `app`."""
+
+        app.config.setdefault('N_PLUS_ONE_THRESHOLD', DEFAULT_N_PLUS_ONE_THRESHOLD)
+        app.config.setdefault('SERVER_TIMING', True)
+        app.config.setdefault('METRICS_TOKEN', None)
+
+        #start timing before the app's own before_request hooks run
+        app.before_request_funcs.setdefault(None, []).insert(0, self.start_request)
+        app.after_request(self.finish_request)
+
+        before_render_template.connect(self.template_started, app)
+        template_rendered.connect(self.template_finished, app)
+
+        if not event.contains(Engine, 'before_cursor_execute', self.query_started):
+            event.listen(Engine, 'before_cursor_execute', self.query_started)
+            event.listen(Engine, 'after_cursor_execute', self.query_finished)
+            event.listen(Engine, 'handle_error', self.query_failed)
+
+        app.add_url_rule('/metrics', 'metrics', self.show_metrics)
+
+    @staticmethod
+    def current():
+        """The RequestTimings for the request in progress, if any."""
+
+        if has_app_context():
+            return g.get('request_timings')
+        return None
+
+    @contextmanager
+    def timer(self, name):
+        """Add the time spent in the block to the current request's `name`."""
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings = self.current()
+            if timings is not None:
+                timings.durations[name] += time.perf_counter() - started
+
+    ##########################################################################
+    # Hooks
+
+    def start_request(self):
+        g.request_timings = RequestTimings()
+
+    def finish_request(self, response):
+        timings = self.current()
+        if timings is None:
+            return response
+
+        total = time.perf_counter() - timings.started
+        endpoint = request.endpoint or "unmatched"
+        labels = dict(endpoint=endpoint)
+
+        self.metrics.inc('warbler_requests_total', dict(
+            endpoint=endpoint, method=request.method, status=response.status_code))
+        self.metrics.observe('warbler_request_duration_seconds', labels, total)
+        self.metrics.observe('warbler_request_queries', labels, timings.queries,
+                             buckets=QUERY_COUNT_BUCKETS)
+
+        for name in TIMER_NAMES:
+            if timings.durations[name]:
+                self.metrics.inc(f'warbler_{name}_seconds_total', labels,
+                                 timings.durations[name])
+
+        threshold = current_app.config['N_PLUS_ONE_THRESHOLD']
+        if threshold and timings.queries > threshold:
+            self.metrics.inc('warbler_n_plus_one_requests_total', labels)
+            statement, repeats = timings.statements.most_common(1)[0]
+            current_app.logger.warning(
+                "%s %s ran %d queries; most repeated (%d times): %s",
+                request.method, request.path, timings.queries, repeats,
+                " ".join(statement.split())[:300])
+
+        if current_app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = self.server_timing(timings, total)
+
+        return response
+
+    def server_timing(self, timings, total):
+        """The Server-Timing header value for `timings`."""
+
+        parts = []
+
+        for name, short_name in TIMER_NAMES.items():
+            duration = timings.durations[name]
+            if name == 'db':
+                parts.append(f'{short_name};dur={duration * 1000:.1f};'
+                             f'desc="{timings.queries} queries"')
+            elif duration:
+                parts.append(f"{short_name};dur={duration * 1000:.1f}")
+
+        parts.append(f"app;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+    def template_started(self, sender, template, context, **extra):
+        g.setdefault('template_starts', []).append(time.perf_counter())
+
+    def template_finished(self, sender, template, context, **extra):
+        timings = self.current()
+        starts = g.get('template_starts')
+
+        if timings is not None and starts:
+            timings.durations['template'] += time.perf_counter() - starts.pop()
+
+    def query_started(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_starts', []).append(time.perf_counter())
+
+    def query_finished(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_starts'].pop()
+        timings = self.current()
+
+        if timings is not None:
+            timings.queries += 1
+            timings.statements[statement] += 1
+            timings.durations['db'] += time.perf_counter() - started
+
+    def query_failed(self, exception_context):
+        starts = exception_context.connection.info.get('query_starts')
+        if starts:
+            starts.pop()
+
+    ##########################################################################
+    # /metrics
+
+    def show_metrics(self):
+        """Prometheus scrape endpoint."""
+
+        token = current_app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != f"Bearer {token}":
+            abort(401)
+
+        return Response(self.metrics.render(),
+                        mimetype="text/plain; version=0.0.4")
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,408 @@
+"""Background jobs for Warbler.
+
+Side effects that needn't finish before the response (timeline fan-out,
+counter reconciliation, deleting big accounts) are registered as tasks and
+enqueued from request code:
+
+    @jobs.task('fan_out')
+    def fan_out(message_id):
+        ...
+
+    jobs.enqueue('fan_out', msg.id, key=f"fan_out:{msg.id}")
+
+JOBS_MODE picks what enqueue does:
+
+- 'queue' (default): add the job to the `jobs` table as part of the
+  caller's database transaction, so it's queued when that commits and
+  dropped if it rolls back. Workers anywhere that can reach the database
+  run the jobs (see Procfile), each claiming one at a time with
+  SELECT ... FOR UPDATE SKIP LOCKED:
+
+      flask run-jobs            # run jobs until stopped
+      flask run-jobs --burst    # run what's ready, then exit
+
+- 'eager': run the task right away, inside the caller's transaction,
+  exactly as if it had been called directly. Nothing else to run; tests
+  and development opt into it with JOBS_MODE=eager. Jobs a task enqueues
+  run after it returns, rather than recursing. Delayed jobs wait until the
+  request (or CLI command) is over, then run one after another, each in
+  its own transaction, along with any they delay in turn; so a job that
+  queues its next batch with a delay still runs every batch, just not
+  inside the view.
+
+Each job runs in its own app context and transaction, committed when the
+task returns. A job that raises is retried up to JOBS_MAX_ATTEMPTS times,
+backing off JOBS_RETRY_DELAY * 2**n seconds, then kept as 'failed' with its
+error. A worker that dies mid-job leaves it 'running' until its lease
+(JOBS_LEASE seconds) runs out, when another worker picks it up.
+
+Jobs may therefore run more than once, so tasks must be idempotent. An
+idempotency key collapses duplicates: enqueuing a job whose key matches
+one still waiting in the queue does nothing. A job that fails while
+another with its key is waiting is kept as 'superseded' rather than
+retried, since the waiting job will do the same work.
+
+A task registered with `every` is periodic: `flask run-jobs` queues it on
+start (its name is its key, so however many workers start, one is
+waiting), and each run queues the next, `every` seconds later. Periodic
+tasks only run in 'queue' mode.
+
+/metrics reports the queue's depth by status, and its lag: how long the
+oldest job that's due has been waiting.
+"""
+
+import json
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import (
+    Column, DateTime, Index, Integer, MetaData, Table, Text, and_, func, or_,
+    select, text)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+from instrumentation import instrumentation
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 10
+DEFAULT_LEASE = 300
+
+# Finished jobs are kept this long, then deleted by the workers
+DONE_RETENTION = 24 * 60 * 60
+
+# The queue lives in the app's database (created by migration 0013), so
+# web and worker processes share it wherever they run
+metadata = MetaData()
+
+job_table = Table(
+    'jobs', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', Text, nullable=False),
+    Column('args', Text, nullable=False),
+    Column('key', Text),
+    Column('status', Text, nullable=False, server_default='queued'),
+    Column('attempts', Integer, nullable=False, server_default='0'),
+    Column('enqueued_at', DateTime, nullable=False),
+    Column('run_at', DateTime, nullable=False),
+    Column('locked_until', DateTime),
+    Column('finished_at', DateTime),
+    Column('error', Text),
+    Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    Index('ix_jobs_waiting_key', 'key', unique=True,
+          postgresql_where=text("status = 'queued'"),
+          sqlite_where=text("status = 'queued'")),
+)
+
+STATUSES = ('queued', 'running', 'done', 'failed', 'superseded')
+
+
+class JobQueue:
+    """Registers tasks and runs or queues them; configure with init_app."""
+
+    def __init__(self):
+        self.app = None
+        self.tasks = {}
+        self.periodic = {}
+        self.mode = 'eager'
+        self.local = threading.local()
+
+        metrics = instrumentation.metrics
+        metrics.describe(
+            'warbler_jobs', 'gauge',
+            "Jobs in the queue, by status.")
+        metrics.describe(
+            'warbler_jobs_lag_seconds', 'gauge',
+            "How long the oldest job that's due has been waiting.")
+        metrics.collector(self.collect)
+
+    def init_app(self, app):
+        """Read the mode from `app`'s config and add the worker command."""
+
+        self.app = app
+        self.mode = app.config.setdefault('JOBS_MODE', 'queue')
+        app.config.setdefault('JOBS_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        app.config.setdefault('JOBS_RETRY_DELAY', DEFAULT_RETRY_DELAY)
+        app.config.setdefault('JOBS_LEASE', DEFAULT_LEASE)
+
+        if self.mode not in ('eager', 'queue'):
+            raise ValueError(f"JOBS_MODE must be 'eager' or 'queue', not {self.mode!r}")
+
+        #registered after Flask-SQLAlchemy's, so it runs before the session
+        #is removed
+        app.teardown_appcontext(self.run_delayed)
+
+        @app.cli.command("run-jobs")
+        @click.option('--burst', is_flag=True, help="Exit once no jobs are ready.")
+        @click.option('--poll', default=1.0, help="Seconds between polls when idle.")
+        def run_jobs(burst, poll):
+            """Run queued background jobs."""
+
+            if self.mode != 'queue':
+                raise click.UsageError(
+                    "JOBS_MODE is 'eager', so jobs run inline; there's no queue")
+
+            self.schedule_periodic()
+            click.echo(f"ran {self.work(burst=burst, poll=poll)} jobs")
+
+    @property
+    def session(self):
+        """The app's Flask-SQLAlchemy (scoped) session."""
+
+        return self.app.extensions['sqlalchemy'].db.session
+
+    @property
+    def engine(self):
+        """The app's primary database engine, where the queue lives."""
+
+        return self.app.extensions['sqlalchemy'].db.get_engine(self.app)
+
+    def task(self, name, every=None):
+        """Decorator registering fn as the task `name`; with `every`, as a
+        periodic task run that many seconds apart."""
+
+        def register(fn):
+            self.tasks[name] = fn
+            if every is not None:
+                self.periodic[name] = every
+            return fn
+
+        return register
+
+    ##########################################################################
+    # Enqueuing
+
+    def enqueue(self, name, *args, key=None, delay=0):
+        """Run task `name` with `args` (JSON-serializable) now, or queue it
+        in the current transaction (see JOBS_MODE)."""
+
+        if name not in self.tasks:
+            raise KeyError(f"no task named {name!r}")
+
+        if self.mode == 'eager':
+            if delay:
+                self.delayed.append((name, args))
+                return None
+            return self.run_eagerly(name, args)
+
+        now = datetime.utcnow()
+        insert = (sqlite_insert if self.engine.dialect.name == 'sqlite'
+                  else postgresql_insert)
+
+        self.session.execute(
+            insert(job_table)
+            .values(name=name, args=json.dumps(args), key=key,
+                    enqueued_at=now, run_at=now + timedelta(seconds=delay))
+            .on_conflict_do_nothing(
+                index_elements=['key'],
+                index_where=job_table.c.status == 'queued'))
+
+    def run_eagerly(self, name, args):
+        """Run a task now; jobs it enqueues wait until it's returned."""
+
+        backlog = getattr(self.local, 'backlog', None)
+        if backlog is not None:
+            backlog.append((name, args))
+            return None
+
+        self.local.backlog = backlog = deque()
+        try:
+            result = self.tasks[name](*args)
+            while backlog:
+                name, args = backlog.popleft()
+                self.tasks[name](*args)
+        finally:
+            self.local.backlog = None
+
+        return result
+
+    @property
+    def delayed(self):
+        """This thread's delayed eager jobs, waiting for run_delayed."""
+
+        if getattr(self.local, 'delayed', None) is None:
+            self.local.delayed = deque()
+        return self.local.delayed
+
+    def run_delayed(self, exc=None):
+        """Run the delayed eager jobs once the request or command that
+        queued them is over (dropping them if it failed)."""
+
+        delayed = self.delayed
+        if exc is not None or not delayed:
+            delayed.clear()
+            return
+
+        session = self.session
+        try:
+            #whatever the caller left uncommitted isn't theirs to keep
+            session.rollback()
+            while delayed:
+                name, args = delayed.popleft()
+                self.run_eagerly(name, args)
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            delayed.clear()
+
+    def schedule_periodic(self):
+        """Queue each periodic task, unless it's already waiting."""
+
+        with self.app.app_context():
+            for name in self.periodic:
+                self.enqueue(name, key=name)
+            self.session.commit()
+
+    ##########################################################################
+    # Working
+
+    def claim(self):
+        """Take the next due job (or one whose lease ran out); returns its
+        row, or None if nothing's ready."""
+
+        now = datetime.utcnow()
+        lease = timedelta(seconds=self.app.config['JOBS_LEASE'])
+        c = job_table.c
+
+        with self.engine.begin() as conn:
+            #other workers skip the row this one has locked, rather than
+            #waiting for it or claiming it too
+            job = conn.execute(
+                select(job_table)
+                .where(or_(and_(c.status == 'queued', c.run_at <= now),
+                           and_(c.status == 'running', c.locked_until < now)))
+                .order_by(c.run_at)
+                .limit(1)
+                .with_for_update(skip_locked=True)).mappings().first()
+
+            if job is not None:
+                conn.execute(
+                    job_table.update()
+                    .where(c.id == job['id'])
+                    .values(status='running', locked_until=now + lease,
+                            attempts=c.attempts + 1))
+
+        return job
+
+    def run(self, job):
+        """Run a claimed job in its own app context and transaction."""
+
+        attempt = job['attempts'] + 1
+        session = self.session
+
+        with self.app.app_context():
+            try:
+                self.tasks[job['name']](*json.loads(job['args']))
+                if job['name'] in self.periodic:
+                    self.enqueue(job['name'], key=job['name'],
+                                 delay=self.periodic[job['name']])
+                session.commit()
+
+            except Exception:
+                session.rollback()
+                error = traceback.format_exc()
+                self.app.logger.warning(
+                    "job %s %s failed (attempt %d): %s",
+                    job['id'], job['name'], attempt, error)
+                self.finish(job, attempt, error)
+                return False
+
+            finally:
+                session.remove()
+
+        self.finish(job, attempt)
+        return True
+
+    def finish(self, job, attempt, error=None):
+        now = datetime.utcnow()
+        config = self.app.config
+
+        if error is None:
+            self.set_status(job, 'done', finished_at=now, error=None)
+
+        elif attempt < config['JOBS_MAX_ATTEMPTS']:
+            delay = config['JOBS_RETRY_DELAY'] * 2 ** (attempt - 1)
+            try:
+                self.set_status(job, 'queued', error=error,
+                                run_at=now + timedelta(seconds=delay))
+            except IntegrityError:
+                #the same work was queued again while this ran; that job
+                #takes over the retry (one key can't be queued twice)
+                self.set_status(job, 'superseded', finished_at=now, error=error)
+
+        else:
+            self.set_status(job, 'failed', finished_at=now, error=error)
+
+    def set_status(self, job, status, **values):
+        """Release a claimed job with a new status, in its own transaction."""
+
+        with self.engine.begin() as conn:
+            conn.execute(
+                job_table.update()
+                .where(job_table.c.id == job['id'])
+                .values(status=status, locked_until=None, **values))
+
+    def work(self, burst=False, poll=1.0):
+        """Run jobs as they come due; with `burst`, stop when none are ready.
+        Returns how many jobs ran."""
+
+        ran = 0
+
+        while True:
+            job = self.claim()
+
+            if job is None:
+                self.clean_up()
+                if burst:
+                    return ran
+                time.sleep(poll)
+                continue
+
+            self.run(job)
+            ran += 1
+
+    def clean_up(self):
+        """Delete jobs that finished more than DONE_RETENTION ago."""
+
+        c = job_table.c
+
+        with self.engine.begin() as conn:
+            conn.execute(
+                job_table.delete()
+                .where(c.status.in_(['done', 'superseded']))
+                .where(c.finished_at
+                       < datetime.utcnow() - timedelta(seconds=DONE_RETENTION)))
+
+    ##########################################################################
+    # Metrics
+
+    def collect(self):
+        """Scrape-time gauges for the queue's depth and lag."""
+
+        if self.mode != 'queue':
+            return
+
+        now = datetime.utcnow()
+        c = job_table.c
+
+        with self.engine.connect() as conn:
+            counts = dict(conn.execute(
+                select(c.status, func.count()).group_by(c.status)).all())
+            oldest = conn.execute(
+                select(func.min(c.run_at))
+                .where(c.status == 'queued', c.run_at <= now)).scalar()
+
+        for status in STATUSES:
+            yield 'warbler_jobs', dict(status=status), counts.get(status, 0)
+
+        lag = (now - oldest).total_seconds() if oldest else 0
+        yield 'warbler_jobs_lag_seconds', {}, lag
+
+
+jobs = JobQueue()
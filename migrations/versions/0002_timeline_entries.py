@@ -0,0 +1,47 @@
+"""Add timeline_entries for fan-out-on-write home timelines.
+
+Run `flask backfill-timelines` after upgrading an existing database.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 09:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'timeline_entries',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.Column('author_id', sa.Integer(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['author_id'], ['users.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(
+            ['message_id'], ['messages.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_id', 'message_id'),
+    )
+    op.create_index(
+        'ix_timeline_entries_user_id_timestamp', 'timeline_entries',
+        ['user_id', 'timestamp', 'message_id'])
+    op.create_index(
+        'ix_timeline_entries_author_id_user_id', 'timeline_entries',
+        ['author_id', 'user_id'])
+
+
+def downgrade():
+    op.drop_index(
+        'ix_timeline_entries_author_id_user_id', table_name='timeline_entries')
+    op.drop_index(
+        'ix_timeline_entries_user_id_timestamp', table_name='timeline_entries')
+    op.drop_table('timeline_entries')
@@ -0,0 +1,32 @@
+"""Add denormalized message/follow/like counters to users.
+
+Run `flask reconcile-counters` after upgrading an existing database.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+COUNTERS = ['message_count', 'following_count', 'follower_count', 'liked_count']
+
+
+def upgrade():
+    for name in COUNTERS:
+        op.add_column(
+            'users',
+            sa.Column(name, sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    for name in reversed(COUNTERS):
+        op.drop_column('users', name)
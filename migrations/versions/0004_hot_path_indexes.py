@@ -0,0 +1,47 @@
+"""Add secondary indexes for the hot query paths.
+
+- messages (user_id, timestamp, id): profiles and follow backfill
+- follows (user_following_id, ...): "who does X follow"
+- likes (message_id, ...): "who liked X" and message-delete cascades
+
+On Postgres the indexes are built CONCURRENTLY (outside a transaction) so
+they can be rolled out to a live database without locking writes.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 09:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages',
+     ['user_id', 'timestamp', 'id']),
+    ('ix_follows_user_following_id', 'follows',
+     ['user_following_id', 'user_being_followed_id']),
+    ('ix_likes_message_id', 'likes',
+     ['message_id', 'user_id']),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name, table, columns,
+                postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.drop_index(
+                name, table_name=table,
+                postgresql_concurrently=True)
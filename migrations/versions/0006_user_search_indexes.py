@@ -0,0 +1,47 @@
+"""Add Postgres indexes for user search and username typeahead.
+
+- ix_users_search: GIN over the full-text document searched by
+  search.UserSearch (username, bio and location)
+- ix_users_username_prefix: btree over lower(username) COLLATE "C", which
+  serves LIKE 'prefix%' and ordering for typeahead
+
+Other databases use search.py's in-memory index instead, so this is a
+no-op there. Built CONCURRENTLY to avoid locking a live users table.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY ix_users_search ON users "
+            "USING gin (to_tsvector('simple', "
+            "coalesce(username, '') || ' ' || coalesce(bio, '') || ' ' "
+            "|| coalesce(location, '')))")
+        op.execute(
+            "CREATE INDEX CONCURRENTLY ix_users_username_prefix ON users "
+            "(lower(username) COLLATE \"C\")")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY ix_users_username_prefix")
+        op.execute("DROP INDEX CONCURRENTLY ix_users_search")
@@ -0,0 +1,37 @@
+"""Add a Postgres full-text index over message text.
+
+Serves search.MessageSearch. Postgres keeps it current as messages are
+inserted and deleted; other databases use search.py's in-memory index, so
+this is a no-op there.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17 11:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY ix_messages_search ON messages "
+            "USING gin (to_tsvector('english', text))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY ix_messages_search")
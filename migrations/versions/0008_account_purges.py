@@ -0,0 +1,50 @@
+"""Add users.deleted_at and account_purges for chunked account deletion.
+
+Deleting an account stamps users.deleted_at, which hides the user and their
+messages at once; a background job then deletes their rows in batches,
+recording how far it's got in account_purges.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'users',
+        sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+    # Only tombstoned users are indexed, so hiding them stays a tiny lookup
+    op.create_index(
+        'ix_users_deleted', 'users', ['id'],
+        postgresql_where=sa.text('deleted_at IS NOT NULL'),
+        sqlite_where=sa.text('deleted_at IS NOT NULL'))
+
+    op.create_table(
+        'account_purges',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('stage', sa.Text(), nullable=False),
+        sa.Column('rows_deleted', sa.Integer(), server_default='0',
+                  nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('user_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('account_purges')
+    op.drop_index('ix_users_deleted', table_name='users')
+    op.drop_column('users', 'deleted_at')
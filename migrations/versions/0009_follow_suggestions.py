@@ -0,0 +1,45 @@
+"""Add follow_suggestions, the precomputed "who to follow" lists.
+
+Run `flask refresh-suggestions` after upgrading (and then periodically).
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'follow_suggestions',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('suggested_id', sa.Integer(), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(
+            ['suggested_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_id', 'suggested_id'),
+    )
+    op.create_index(
+        'ix_follow_suggestions_user_id_score', 'follow_suggestions',
+        ['user_id', 'score', 'suggested_id'])
+    op.create_index(
+        'ix_follow_suggestions_suggested_id', 'follow_suggestions',
+        ['suggested_id', 'user_id'])
+
+
+def downgrade():
+    op.drop_index(
+        'ix_follow_suggestions_suggested_id', table_name='follow_suggestions')
+    op.drop_index(
+        'ix_follow_suggestions_user_id_score', table_name='follow_suggestions')
+    op.drop_table('follow_suggestions')
@@ -0,0 +1,44 @@
+"""Add trending_counts and trending for time-decayed trending rankings.
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'trending_counts',
+        sa.Column('kind', sa.Text(), nullable=False),
+        sa.Column('subject_id', sa.Integer(), nullable=False),
+        sa.Column('bucket', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+        sa.PrimaryKeyConstraint('kind', 'subject_id', 'bucket'),
+    )
+    op.create_index(
+        'ix_trending_counts_bucket', 'trending_counts', ['bucket'])
+
+    op.create_table(
+        'trending',
+        sa.Column('kind', sa.Text(), nullable=False),
+        sa.Column('rank', sa.Integer(), nullable=False),
+        sa.Column('subject_id', sa.Integer(), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('kind', 'rank'),
+    )
+
+
+def downgrade():
+    op.drop_table('trending')
+    op.drop_index('ix_trending_counts_bucket', table_name='trending_counts')
+    op.drop_table('trending_counts')
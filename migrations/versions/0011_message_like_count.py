@@ -0,0 +1,28 @@
+"""Add messages.like_count, a denormalized count of each message's likes.
+
+Run `flask reconcile-counters` after upgrading an existing database.
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-17 13:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0011'
+down_revision = '0010'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'messages',
+        sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('messages', 'like_count')
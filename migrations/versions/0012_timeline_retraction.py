@@ -0,0 +1,44 @@
+"""Drop the timeline_entries -> messages cascade; index message_id instead.
+
+Deleting a message no longer deletes its timeline entries (one per follower)
+inside the same statement; a background job removes them by message_id.
+
+Revision ID: 0012
+Revises: 0011
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0012'
+down_revision = '0011'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite doesn't enforce foreign keys unless asked to, and can't drop one
+    # without rebuilding the table, so there's nothing to do there
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_constraint(
+            'timeline_entries_message_id_fkey', 'timeline_entries',
+            type_='foreignkey')
+
+    op.create_index(
+        'ix_timeline_entries_message_id', 'timeline_entries', ['message_id'])
+
+
+def downgrade():
+    op.drop_index(
+        'ix_timeline_entries_message_id', table_name='timeline_entries')
+
+    if op.get_bind().dialect.name != 'sqlite':
+        op.execute(sa.text(
+            "DELETE FROM timeline_entries WHERE message_id NOT IN "
+            "(SELECT id FROM messages)"))
+        op.create_foreign_key(
+            'timeline_entries_message_id_fkey', 'timeline_entries',
+            'messages', ['message_id'], ['id'], ondelete='cascade')
@@ -1,16 +1,136 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
+from functools import cached_property
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from jobs import jobs
+from pagination import Page, paginate
+from passwords import hasher
+from pooling import db_pool
+from replicas import replica_router
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from a replica when replicas.py says it may.
+
+    Flushes and DML statements always go to the primary, and once a
+    session has written, its reads do too (it may be reading its writes).
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.info['wrote'] = True
+
+        if not self.info.get('wrote'):
+            replica = replica_router.read_engine()
+            if replica is not None:
+                return replica
+
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _note_write(session):
+    if session.info.pop('wrote', False):
+        replica_router.wrote()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
 
+MESSAGES_PER_PAGE = 100
+USERS_PER_PAGE = 60
+
+# How many of a user's most recent messages get copied into a new follower's
+# timeline when the follow starts (older history isn't backfilled).
+FOLLOW_BACKFILL_LIMIT = 1000
+
+# "Who to follow" (see FollowSuggestion): how many suggestions are kept per
+# user, how many of a user's likes are compared with other users', how
+# many likes a message may have and still count (past that, liking it says
+# little and its likers are too many to join), how a shared like weighs
+# against a mutual follow, how many users' lists one refresh job
+# recomputes, and how many seconds a follow change waits before its user's
+# list is recomputed.
+SUGGESTIONS_PER_USER = 20
+CO_LIKE_RECENT_LIKES = 200
+CO_LIKE_MAX_LIKES = 500
+CO_LIKE_WEIGHT = 0.5
+SUGGESTIONS_BATCH_SIZE = 500
+SUGGESTIONS_REFRESH_DELAY = 60
+
+# Trending (see TrendingCount): likes and follows are counted in hour-long
+# buckets, a bucket's weight halves every TRENDING_HALF_LIFE, buckets older
+# than TRENDING_WINDOW are dropped, each ranking keeps its top
+# TRENDING_SIZE, and the rankings are recomputed every
+# TRENDING_COMPACT_INTERVAL (all times in seconds).
+TRENDING_BUCKET = 60 * 60
+TRENDING_HALF_LIFE = 6 * 60 * 60
+TRENDING_WINDOW = 48 * 60 * 60
+TRENDING_SIZE = 50
+TRENDING_COMPACT_INTERVAL = 5 * 60
+
+# Rows a deleted account's purge removes per job (see AccountPurge), which
+# bounds how long each purge transaction holds its locks, and the seconds
+# between its jobs.
+PURGE_BATCH_SIZE = 1000
+PURGE_BATCH_DELAY = 1
+
+# A page of messages plus what the viewer needs to render it: the ids among
+# them the viewer has liked and the ids the viewer wrote. Templates check
+# membership in these sets rather than walking relationship collections.
+Feed = namedtuple("Feed", ["messages", "next_cursor", "liked_ids", "own_ids"])
+
+Profile = namedtuple("Profile", ["user", "feed"])
+
+
+def upsert(model):
+    """An INSERT into `model`'s table that takes an ON CONFLICT clause, for
+    Postgres or SQLite."""
+
+    dialect = db.session.get_bind(model.__mapper__).dialect.name
+    insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+
+    return insert(model)
+
+
+def insert_or_ignore(model):
+    """An INSERT into `model`'s table that skips rows whose key exists
+    (ON CONFLICT DO NOTHING), for Postgres or SQLite."""
+
+    return upsert(model).on_conflict_do_nothing()
+
+
+def insert_ignoring_duplicates(model, **values):
+    """INSERT a `model` row unless one with the same key exists; returns
+    whether a row was added. One statement, safe against concurrent inserts.
+    """
+
+    result = db.session.execute(insert_or_ignore(model).values(**values))
+    return result.rowcount == 1
+
+
+def make_feed(viewer, page):
+    """Build a Feed from a Page of messages, as seen by `viewer`."""
+
+    liked_ids = viewer.liked_ids_among([msg.id for msg in page.items])
+    own_ids = {msg.id for msg in page.items if msg.user_id == viewer.id}
+
+    return Feed(page.items, page.next_cursor, liked_ids, own_ids)
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -29,8 +149,140 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with user_being_followed_id, which serves
+    # "followers of X"; this serves "who X follows".
+    __table_args__ = (
+        db.Index(
+            'ix_follows_user_following_id',
+            'user_following_id', 'user_being_followed_id'),
+    )
+
+
+class CountersMixin:
+    """For models with denormalized counter columns."""
+
+    @classmethod
+    def adjust_counters(cls, ids, **deltas):
+        """Atomically add `deltas` (e.g. follower_count=1) to the counters
+        of the rows in `ids`, which may be a list or an id subquery."""
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id.in_(ids))
+            .values({name: getattr(cls, name) + delta
+                     for name, delta in deltas.items()})
+            .execution_options(synchronize_session=False))
+
+
+class ViewerMixin:
+    """Membership checks for the user viewing a page.
+
+    Everything here needs only `self.id`, so it works for a full User and
+    for the lightweight CurrentUser alike. Id sets are loaded with one
+    narrow query the first time they're used and then cached on the
+    instance, which lives for the current request.
+    """
+
+    def liked_ids_among(self, message_ids):
+        """Return the set of `message_ids` this user has liked.
+
+        One query against the likes primary key, however many likes there are.
+        """
+
+        if 'liked_message_ids' in self.__dict__:
+            return self.liked_message_ids.intersection(message_ids)
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Like.message_id)
+                .filter(Like.user_id == self.id,
+                        Like.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
+
+    ID_SETS = ('following_ids', 'follower_ids', 'liked_message_ids', 'message_ids')
+
+    @cached_property
+    def following_ids(self):
+        """Ids of the users this user follows."""
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id))
+        return {user_id for (user_id,) in rows}
+
+    @cached_property
+    def follower_ids(self):
+        """Ids of the users following this user."""
+
+        rows = (db.session
+                .query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == self.id))
+        return {user_id for (user_id,) in rows}
+
+    @cached_property
+    def liked_message_ids(self):
+        """Ids of the messages this user has liked."""
 
-class User(db.Model):
+        rows = (db.session
+                .query(Like.message_id)
+                .filter(Like.user_id == self.id))
+        return {message_id for (message_id,) in rows}
+
+    @cached_property
+    def message_ids(self):
+        """Ids of the messages this user wrote."""
+
+        rows = (db.session
+                .query(Message.id)
+                .filter(Message.user_id == self.id))
+        return {message_id for (message_id,) in rows}
+
+    def forget_id_sets(self):
+        """Drop cached id sets after this user's follows, likes or messages
+        change."""
+
+        for name in self.ID_SETS:
+            self.__dict__.pop(name, None)
+
+    def following_status(self, user_ids):
+        """Return the set of `user_ids` this user follows.
+
+        Answers a whole page of follow buttons with one indexed query (or
+        none, if following_ids is already loaded).
+        """
+
+        if 'following_ids' in self.__dict__:
+            return self.following_ids.intersection(user_ids)
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in rows}
+
+    def is_followed_by(self, other_user):
+        """Is this user followed by `other_user`?"""
+
+        return other_user.id in self.follower_ids
+
+    def is_following(self, other_user):
+        """Is this user following `other_use`?"""
+
+        return other_user.id in self.following_status([other_user.id])
+
+    def is_liked(self, message):
+        """Is this message liked by self?"""
+
+        return message.id in self.liked_message_ids
+
+
+class User(ViewerMixin, CountersMixin, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -75,6 +327,61 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Bumped on every profile edit so cached copies of the user (see
+    # CurrentUser) know to reload.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+    )
+
+    # Denormalized counts for profile headers, so showing them never loads
+    # a relationship collection. Kept current by follow/like/add_message/
+    # delete_message below; `flask reconcile-counters` recomputes them.
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    liked_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Set when the account is deleted. From then on the user and their
+    # messages are hidden from every query (see _hide_deleted_users) while
+    # AccountPurge deletes their rows in the background.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_users_deleted', 'id',
+            postgresql_where=db.text('deleted_at IS NOT NULL'),
+            sqlite_where=db.text('deleted_at IS NOT NULL')),
+    )
+
     messages = db.relationship('Message', backref="user")
 
     followers = db.relationship(
@@ -85,10 +392,13 @@ class User(db.Model):
         backref="following",
     )
 
+    # passive_deletes: the likes foreign keys cascade, so deleting a user or
+    # message never loads its likes just to delete them
     liked_messages = db.relationship(
         'Message',
         secondary="likes",
-        backref="users_liked")
+        passive_deletes=True,
+        backref=db.backref("users_liked", passive_deletes=True))
 
 
 
@@ -102,7 +412,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -128,35 +438,272 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
-    def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+    def check_password(self, password):
+        """Does `password` match this user's password?
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        If the stored hash was made with a different work factor than the
+        configured BCRYPT_LOG_ROUNDS, it's transparently re-hashed at the new
+        cost (the caller commits).
+        """
 
-    def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        if not hasher.check(self.password, password):
+            return False
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
 
-    def is_liked(self, message):
-        """Is this message liked by self?"""
+        return True
+
+    @classmethod
+    def reconcile_counters(cls, user_ids=None):
+        """Recompute counters from the underlying tables.
+
+        Covers every user, or just those in `user_ids` if given.
+        """
+
+        counts = {
+            'message_count': (
+                db.select(db.func.count(Message.id))
+                .where(Message.user_id == cls.id)
+                .scalar_subquery()),
+            'following_count': (
+                db.select(db.func.count())
+                .select_from(Follows)
+                .where(Follows.user_following_id == cls.id)
+                .scalar_subquery()),
+            'follower_count': (
+                db.select(db.func.count())
+                .select_from(Follows)
+                .where(Follows.user_being_followed_id == cls.id)
+                .scalar_subquery()),
+            'liked_count': (
+                db.select(db.func.count())
+                .select_from(Like)
+                .where(Like.user_id == cls.id)
+                .scalar_subquery()),
+        }
+
+        stmt = db.update(cls).values(counts)
+        if user_ids is not None:
+            stmt = stmt.where(cls.id.in_(user_ids))
+
+        db.session.execute(stmt.execution_options(synchronize_session=False))
+
+    def follow(self, other_user):
+        """Start following `other_user`; returns False if already following.
+
+        One INSERT ... ON CONFLICT DO NOTHING, so a double-submit or two
+        concurrent clicks add one follow, and counters and the timeline are
+        only touched by the request that added it.
+        """
+
+        if not insert_ignoring_duplicates(
+                Follows,
+                user_following_id=self.id,
+                user_being_followed_id=other_user.id):
+            return False
+
+        TimelineEntry.sync_follow_later(self.id, other_user.id)
+        FollowSuggestion.followed(self.id, other_user.id)
+        TrendingCount.record('user', other_user.id, 1)
+        User.adjust_counters([self.id], following_count=1)
+        User.adjust_counters([other_user.id], follower_count=1)
+        self.forget_follows(other_user)
+        return True
+
+    def unfollow(self, other_user):
+        """Stop following `other_user`; returns False if not following."""
+
+        deleted = db.session.execute(
+            db.delete(Follows)
+            .where(Follows.user_following_id == self.id)
+            .where(Follows.user_being_followed_id == other_user.id))
+
+        if not deleted.rowcount:
+            return False
+
+        TimelineEntry.sync_follow_later(self.id, other_user.id)
+        FollowSuggestion.refresh_later([self.id], delay=SUGGESTIONS_REFRESH_DELAY)
+        TrendingCount.record('user', other_user.id, -1)
+        User.adjust_counters([self.id], following_count=-1)
+        User.adjust_counters([other_user.id], follower_count=-1)
+        self.forget_follows(other_user)
+        return True
+
+    def like(self, message):
+        """Add `message` to this user's liked messages; returns False if it
+        was already liked."""
+
+        if not insert_ignoring_duplicates(
+                Like, user_id=self.id, message_id=message.id):
+            return False
+
+        TrendingCount.record('message', message.id, 1)
+        User.adjust_counters([self.id], liked_count=1)
+        Message.adjust_counters([message.id], like_count=1)
+        self.forget_likes(message)
+        return True
+
+    def unlike(self, message):
+        """Remove `message` from this user's liked messages; returns False
+        if it wasn't liked."""
+
+        deleted = db.session.execute(
+            db.delete(Like)
+            .where(Like.user_id == self.id)
+            .where(Like.message_id == message.id))
+
+        if not deleted.rowcount:
+            return False
+
+        TrendingCount.record('message', message.id, -1)
+        User.adjust_counters([self.id], liked_count=-1)
+        Message.adjust_counters([message.id], like_count=-1)
+        self.forget_likes(message)
+        return True
+
+    def forget_follows(self, other_user):
+        """Expire relationship collections a follow change made stale (only
+        reloaded if something reads them)."""
+
+        db.session.expire(self, ['following'])
+        db.session.expire(other_user, ['followers'])
+        self.forget_id_sets()
+
+    def forget_likes(self, message):
+        """Expire the like state a like or unlike made stale."""
+
+        db.session.expire(self, ['liked_messages'])
+        db.session.expire(message, ['users_liked', 'like_count'])
+        self.forget_id_sets()
+
+    def add_message(self, text):
+        """Post a new message by this user.
+
+        It's in the author's own timeline at once; copying it into their
+        followers' timelines is a background job.
+        """
+
+        msg = Message(text=text)
+        self.messages.append(msg)
+        db.session.flush()
+
+        TimelineEntry.add_own(msg)
+        jobs.enqueue('fan_out', msg.id, key=f"fan_out:{msg.id}")
+        User.adjust_counters([self.id], message_count=1)
+        self.forget_id_sets()
+
+        return msg
+
+    def delete_message(self, message):
+        """Delete `message`, which this user wrote."""
+
+        likers = db.select(Like.user_id).where(Like.message_id == message.id)
+
+        TimelineEntry.retract_later(message.id)
+        User.adjust_counters(likers, liked_count=-1)
+        User.adjust_counters([self.id], message_count=-1)
+        db.session.delete(message)
+        self.forget_id_sets()
+
+    def tombstone(self):
+        """Delete this account: hide it at once, and queue the purge of
+        its rows (the caller commits)."""
+
+        self.deleted_at = datetime.utcnow()
+        AccountPurge.start(self.id)
+
+    @classmethod
+    def profile_bundle(cls, user_id, viewer, before=None,
+                       per_page=MESSAGES_PER_PAGE):
+        """Load user `user_id` (or 404) with a page of their messages as a
+        Feed for `viewer`."""
+
+        user = cls.query.get_or_404(user_id)
+        page = paginate(Message.query.filter_by(user_id=user.id),
+                        [Message.timestamp, Message.id],
+                        before,
+                        per_page)
+
+        return Profile(user, make_feed(viewer, page))
+
+
+class CurrentUser(ViewerMixin):
+    """The logged-in user, as loaded for every request.
+
+    Holds only the identity columns the nav needs. They're cached in the
+    session and revalidated against users.version with one narrow query, so
+    most requests never load the full row. Any other attribute (counters,
+    relationships, write methods) loads the full User on first use, so only
+    routes that need it pay for it.
+    """
+
+    FIELDS = ('id', 'username', 'image_url', 'version')
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self._user = None
+
+    @classmethod
+    def load(cls, user_id, snapshot=None):
+        """Return the CurrentUser for `user_id`, or None if they're gone.
+
+        `snapshot` is the dict cached in the session on an earlier request;
+        it's reused as long as the user's version hasn't changed.
+        """
+
+        version = (db.session
+                   .query(User.version)
+                   .filter(User.id == user_id)
+                   .scalar())
+
+        if version is None:
+            return None
+
+        if (not snapshot
+                or snapshot.get('id') != user_id
+                or snapshot.get('version') != version):
+            row = (db.session
+                   .query(*[getattr(User, field) for field in cls.FIELDS])
+                   .filter(User.id == user_id)
+                   .one())
+            snapshot = dict(row._mapping)
+
+        return cls(snapshot)
+
+    @classmethod
+    def snapshot_of(cls, user):
+        """Session snapshot for a full User instance."""
+
+        return {field: getattr(user, field) for field in cls.FIELDS}
 
-        #use a set/make a set once
-        found_liked = [m for m in self.liked_messages if m == message]
-        return len(found_liked) == 1
+    @property
+    def model(self):
+        """The full User row, loaded on first use."""
 
-class Message(db.Model):
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'snapshot':
+            raise AttributeError(name)
+
+        if name in self.FIELDS:
+            return self.snapshot[name]
+
+        return getattr(self.model, name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+class Message(CountersMixin, db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
@@ -183,6 +730,86 @@ class Message(db.Model):
         #no nulls if you want to cascade
     )
 
+    # Denormalized so cards can show it without touching likes; kept
+    # current by User.like/unlike, recomputed by `flask reconcile-counters`.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Serves a user's messages newest-first (profiles, timeline backfill).
+    __table_args__ = (
+        db.Index(
+            'ix_messages_user_id_timestamp',
+            'user_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def reconcile_counters(cls, message_ids=None):
+        """Recompute like counts from the likes table, for every message or
+        just those in `message_ids`."""
+
+        likes = (db.select(db.func.count())
+                 .select_from(Like)
+                 .where(Like.message_id == cls.id)
+                 .scalar_subquery())
+
+        stmt = db.update(cls).values(like_count=likes)
+        if message_ids is not None:
+            stmt = stmt.where(cls.id.in_(message_ids))
+
+        db.session.execute(stmt.execution_options(synchronize_session=False))
+
+    def likers(self, before=None, per_page=USERS_PER_PAGE):
+        """A Page of the users who liked this message, by the likes index."""
+
+        likers = (User
+                  .query
+                  .join(Like, Like.user_id == User.id)
+                  .filter(Like.message_id == self.id))
+
+        return paginate(likers, [User.id], before, per_page)
+
+    @classmethod
+    def timeline_for(cls, user, before=None, per_page=MESSAGES_PER_PAGE):
+        """Return a page of `user`'s home timeline as a Feed.
+
+        Authors are joined into the same query, so rendering the page
+        doesn't lazy-load a User per message.
+        """
+
+        timeline = (cls
+                    .query
+                    .options(db.joinedload(cls.user))
+                    .join(TimelineEntry, TimelineEntry.message_id == cls.id)
+                    .filter(TimelineEntry.user_id == user.id))
+        page = paginate(timeline,
+                        [TimelineEntry.timestamp, TimelineEntry.message_id],
+                        before,
+                        per_page,
+                        item_key=lambda msg: (msg.timestamp, msg.id))
+
+        return make_feed(user, page)
+
+    @classmethod
+    def liked_by(cls, user, viewer, before=None, per_page=MESSAGES_PER_PAGE):
+        """Return a page of the messages `user` has liked as a Feed for
+        `viewer`, with authors eager-loaded."""
+
+        liked = (cls
+                 .query
+                 .options(db.joinedload(cls.user))
+                 .join(Like, Like.message_id == cls.id)
+                 .filter(Like.user_id == user.id))
+        page = paginate(liked,
+                        [cls.timestamp, cls.id],
+                        before,
+                        per_page)
+
+        return make_feed(viewer, page)
+
 #change to Like
 class Like(db.Model):
     """Liked messages for individual user """
@@ -201,6 +828,759 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with user_id; this serves "who liked message X"
+    # and the cascade when a message is deleted.
+    __table_args__ = (
+        db.Index(
+            'ix_likes_message_id',
+            'message_id', 'user_id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline.
+
+    Timelines are built fan-out-on-write: posting a message adds a row for
+    the author and for each of their followers, so reading a home feed is a
+    single range scan over (user_id, timestamp) instead of an IN (...) query
+    across everyone the user follows.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    #no foreign key: a deleted message's entries are removed by a background
+    #job (see retract_later) rather than a cascade inside the delete
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    #copy of the message's timestamp so the feed never has to sort messages
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_id_timestamp',
+            'user_id', 'timestamp', 'message_id'),
+        db.Index(
+            'ix_timeline_entries_author_id_user_id',
+            'author_id', 'user_id'),
+        db.Index(
+            'ix_timeline_entries_message_id',
+            'message_id'),
+    )
+
+    COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+    @classmethod
+    def add_own(cls, message):
+        """Add a newly-flushed `message` to its author's timeline."""
+
+        db.session.add(cls(
+            user_id=message.user_id,
+            message_id=message.id,
+            author_id=message.user_id,
+            timestamp=message.timestamp,
+        ))
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add `message` to its author's followers' timelines (skipping
+        any it's already in, so this can safely run again)."""
+
+        followers = (
+            db.select(
+                Follows.user_following_id,
+                db.literal(message.id),
+                db.literal(message.user_id),
+                db.literal(message.timestamp))
+            .where(Follows.user_being_followed_id == message.user_id))
+
+        db.session.execute(
+            insert_or_ignore(cls).from_select(cls.COLUMNS, followers))
+
+    @classmethod
+    def retract_later(cls, message_id):
+        """Remove a deleted message from every timeline, in a background
+        job. Feeds join messages, so its entries are hidden meanwhile."""
+
+        jobs.enqueue('retract_message', message_id,
+                     key=f"retract_message:{message_id}")
+
+    @classmethod
+    def retract(cls, message_id):
+        """Remove message `message_id` from every timeline it was fanned
+        out to."""
+
+        db.session.execute(
+            db.delete(cls).where(cls.message_id == message_id))
+
+    @classmethod
+    def sync_follow_later(cls, follower_id, followed_id):
+        """Bring the follower's timeline in line with whether they now
+        follow `followed_id`, in a background job."""
+
+        jobs.enqueue('sync_follow_timeline', follower_id, followed_id,
+                     key=f"sync_follow_timeline:{follower_id}:{followed_id}")
+
+    @classmethod
+    def sync_follow(cls, follower_id, followed_id):
+        """Backfill the follower's timeline with the followed user's recent
+        messages if they follow them, or clear those messages out if not.
+
+        Looks at the follow as it is when this runs, so it's safe to repeat,
+        and a follow then quick unfollow can't leave stale entries behind.
+        """
+
+        following = db.session.query(
+            db.exists()
+            .where(Follows.user_following_id == follower_id)
+            .where(Follows.user_being_followed_id == followed_id)).scalar()
+
+        if following:
+            cls.follow(follower_id, followed_id)
+        else:
+            cls.unfollow(follower_id, followed_id)
+
+    @classmethod
+    def follow(cls, follower_id, followed_id):
+        """Backfill a new follower's timeline with the followed user's
+        most recent messages."""
+
+        recent = (
+            db.select(
+                db.literal(follower_id),
+                Message.id,
+                Message.user_id,
+                Message.timestamp)
+            .where(Message.user_id == followed_id)
+            .order_by(Message.timestamp.desc())
+            .limit(FOLLOW_BACKFILL_LIMIT))
+
+        db.session.execute(
+            insert_or_ignore(cls).from_select(cls.COLUMNS, recent))
+
+    @classmethod
+    def unfollow(cls, follower_id, followed_id):
+        """Drop the unfollowed user's messages from the follower's timeline."""
+
+        db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == follower_id)
+            .where(cls.author_id == followed_id))
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild every timeline from the messages and follows tables.
+
+        Used to backfill existing data; normal writes keep timelines current.
+        """
+
+        own = (
+            db.select(
+                Message.user_id,
+                Message.id,
+                Message.user_id,
+                Message.timestamp)
+            .where(Message.user_id.isnot(None)))
+
+        followed = (
+            db.select(
+                Follows.user_following_id,
+                Message.id,
+                Message.user_id,
+                Message.timestamp)
+            .join(Message, Message.user_id == Follows.user_being_followed_id)
+            #a self-follow (older data may have them) would repeat `own`
+            .where(Follows.user_being_followed_id != Follows.user_following_id))
+
+        db.session.execute(db.delete(cls))
+        db.session.execute(
+            db.insert(cls).from_select(cls.COLUMNS, own.union_all(followed)))
+
+
+class FollowSuggestion(db.Model):
+    """A user suggested to another in "who to follow", with its score.
+
+    Computed in batches by refresh() from two graphs: friends of friends
+    (each user you follow who follows them adds 1) and co-likes (each of
+    your recent likes they also liked adds CO_LIKE_WEIGHT, skipping messages
+    with over CO_LIKE_MAX_LIKES likes). Those are the
+    sparse products Follows x Follows and Likes x Likes^T, done as joins
+    and a GROUP BY in the database. Each user keeps their top
+    SUGGESTIONS_PER_USER, so the home page reads them with one range scan.
+
+    `flask refresh-suggestions` recomputes everyone; a user's follows and
+    unfollows queue a recompute of just theirs, delayed so a burst of them
+    costs one, and never run inside the request.
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_follow_suggestions_user_id_score',
+            'user_id', 'score', 'suggested_id'),
+        db.Index(
+            'ix_follow_suggestions_suggested_id',
+            'suggested_id', 'user_id'),
+    )
+
+    COLUMNS = ['user_id', 'suggested_id', 'score']
+
+    @classmethod
+    def for_user(cls, user, limit=5):
+        """The users best suggested to `user`, best first."""
+
+        return (User
+                .query
+                .join(cls, cls.suggested_id == User.id)
+                .filter(cls.user_id == user.id)
+                .order_by(cls.score.desc(), cls.suggested_id.desc())
+                .limit(limit)
+                .all())
+
+    @classmethod
+    def refresh(cls, user_ids):
+        """Recompute the suggestions of the users in `user_ids`."""
+
+        via = db.aliased(Follows)
+        friends_of_friends = (
+            db.select(
+                Follows.user_following_id.label('user_id'),
+                via.user_being_followed_id.label('suggested_id'),
+                db.literal(1.0).label('weight'))
+            .join(via, via.user_following_id == Follows.user_being_followed_id)
+            .where(Follows.user_following_id.in_(user_ids)))
+
+        recent_likes = (
+            db.select(
+                Like.user_id,
+                Like.message_id,
+                db.func.row_number().over(
+                    partition_by=Like.user_id,
+                    order_by=Like.message_id.desc()).label('n'))
+            .join(Message, Message.id == Like.message_id)
+            .where(Like.user_id.in_(user_ids))
+            .where(Message.like_count <= CO_LIKE_MAX_LIKES)
+            .subquery())
+        co_likers = (
+            db.select(
+                recent_likes.c.user_id,
+                Like.user_id,
+                db.literal(CO_LIKE_WEIGHT))
+            .join(Like, Like.message_id == recent_likes.c.message_id)
+            .where(recent_likes.c.n <= CO_LIKE_RECENT_LIKES))
+
+        candidates = friends_of_friends.union_all(co_likers).subquery()
+        already_following = (
+            db.exists()
+            .where(Follows.user_following_id == candidates.c.user_id)
+            .where(Follows.user_being_followed_id == candidates.c.suggested_id))
+        deleted = candidates.c.suggested_id.in_(_deleted_user_ids)
+
+        scored = (
+            db.select(
+                candidates.c.user_id,
+                candidates.c.suggested_id,
+                db.func.sum(candidates.c.weight).label('score'))
+            .where(candidates.c.suggested_id != candidates.c.user_id)
+            .where(~already_following)
+            .where(~deleted)
+            .group_by(candidates.c.user_id, candidates.c.suggested_id)
+            .subquery())
+        ranked = (
+            db.select(
+                scored,
+                db.func.row_number().over(
+                    partition_by=scored.c.user_id,
+                    order_by=(scored.c.score.desc(),
+                              scored.c.suggested_id.desc())).label('rank'))
+            .subquery())
+        top = (
+            db.select(ranked.c.user_id, ranked.c.suggested_id, ranked.c.score)
+            .where(ranked.c.rank <= SUGGESTIONS_PER_USER))
+
+        db.session.execute(db.delete(cls).where(cls.user_id.in_(user_ids)))
+        db.session.execute(db.insert(cls).from_select(cls.COLUMNS, top))
+
+    @classmethod
+    def refresh_later(cls, user_ids, delay=0):
+        """Recompute these users' suggestions in a background job."""
+
+        key = (f"refresh_follow_suggestions:{user_ids[0]}"
+               if len(user_ids) == 1 else None)
+        jobs.enqueue('refresh_follow_suggestions', list(user_ids), key=key,
+                     delay=delay)
+
+    @staticmethod
+    def user_batches():
+        """Every user's id, in lists of SUGGESTIONS_BATCH_SIZE."""
+
+        after = 0
+        while True:
+            user_ids = [user_id for (user_id,) in db.session.execute(
+                db.select(User.id)
+                .where(User.id > after)
+                .order_by(User.id)
+                .limit(SUGGESTIONS_BATCH_SIZE))]
+            if not user_ids:
+                return
+
+            yield user_ids
+            after = user_ids[-1]
+
+    @classmethod
+    def followed(cls, user_id, followed_id):
+        """Drop a suggestion the user just took, and queue a refresh of
+        their list (its friends of friends have changed)."""
+
+        db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == user_id)
+            .where(cls.suggested_id == followed_id))
+        cls.refresh_later([user_id], delay=SUGGESTIONS_REFRESH_DELAY)
+
+
+class TrendingCount(db.Model):
+    """How many times something was liked or followed in one hour.
+
+    Trending ranks messages by how fast they're being liked and users by
+    how fast they're gaining followers, with recent hours weighing more: an
+    event's weight halves every TRENDING_HALF_LIFE. Likes and follows (and
+    their undoing, as -1) add to the current hour's count with a single
+    upsert, so recording them is cheap and concurrent-safe. compact(),
+    run every TRENDING_COMPACT_INTERVAL by the periodic compact_trending
+    job (never the request path), turns the counts into decayed scores and
+    writes the top of each ranking to Trending, which is all the trending
+    page reads.
+    """
+
+    __tablename__ = 'trending_counts'
+
+    KINDS = ('message', 'user')
+
+    # 'message' (liked) or 'user' (followed)
+    kind = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # Not a foreign key, as it points at messages or users
+    subject_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    #hours since the Unix epoch
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_trending_counts_bucket',
+            'bucket'),
+    )
+
+    @staticmethod
+    def current_bucket():
+        return int(datetime.utcnow().timestamp() // TRENDING_BUCKET)
+
+    @classmethod
+    def record(cls, kind, subject_id, delta):
+        """Add `delta` events for `subject_id` to the current hour."""
+
+        insert = upsert(cls).values(
+            kind=kind,
+            subject_id=subject_id,
+            bucket=cls.current_bucket(),
+            count=delta)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=[cls.kind, cls.subject_id, cls.bucket],
+            set_={'count': cls.count + insert.excluded.count}))
+
+    @classmethod
+    def compact(cls):
+        """Drop counts that have aged out of the window, and rewrite the
+        Trending rankings from the rest.
+
+        Readers see the old rankings until this commits.
+        """
+
+        now = cls.current_bucket()
+        oldest = now - TRENDING_WINDOW // TRENDING_BUCKET + 1
+
+        db.session.execute(db.delete(cls).where(cls.bucket < oldest))
+
+        weight = db.case(
+            {bucket: 0.5 ** ((now - bucket) * TRENDING_BUCKET / TRENDING_HALF_LIFE)
+             for bucket in range(oldest, now + 1)},
+            value=cls.bucket)
+        scores = (
+            db.select(
+                cls.kind,
+                cls.subject_id,
+                db.func.sum(cls.count * weight).label('score'))
+            .group_by(cls.kind, cls.subject_id)
+            .subquery())
+        ranked = (
+            db.select(
+                scores,
+                db.func.row_number().over(
+                    partition_by=scores.c.kind,
+                    order_by=(scores.c.score.desc(),
+                              scores.c.subject_id.desc())).label('rank'))
+            .where(scores.c.score > 0)
+            .subquery())
+        top = (
+            db.select(ranked.c.kind, ranked.c.rank, ranked.c.subject_id,
+                      ranked.c.score)
+            .where(ranked.c.rank <= TRENDING_SIZE))
+
+        db.session.execute(db.delete(Trending))
+        db.session.execute(db.insert(Trending).from_select(Trending.COLUMNS, top))
+
+
+class Trending(db.Model):
+    """The top of the trending rankings, as of TrendingCount's last
+    compact()."""
+
+    __tablename__ = 'trending'
+
+    kind = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    subject_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    COLUMNS = ['kind', 'rank', 'subject_id', 'score']
+
+    @classmethod
+    def messages(cls, viewer):
+        """The trending messages as a Feed for `viewer`, with authors
+        eager-loaded."""
+
+        messages = (Message
+                    .query
+                    .options(db.joinedload(Message.user))
+                    .join(cls, db.and_(cls.kind == 'message',
+                                       cls.subject_id == Message.id))
+                    .order_by(cls.rank)
+                    .all())
+
+        return make_feed(viewer, Page(messages, None))
+
+    @classmethod
+    def users(cls, limit=10):
+        """The users gaining followers fastest."""
+
+        return (User
+                .query
+                .join(cls, db.and_(cls.kind == 'user',
+                                   cls.subject_id == User.id))
+                .order_by(cls.rank)
+                .limit(limit)
+                .all())
+
+
+class AccountPurge(db.Model):
+    """Progress of deleting a deleted account's rows.
+
+    User.tombstone hides the account at once; the purge_user job then
+    deletes what it left behind in stages, at most PURGE_BATCH_SIZE rows
+    per job, so even an account with millions of followers and likes never
+    holds locks on the hot tables for long. Children go before parents
+    (likes before messages, say), so a batch never cascades into an
+    unbounded number of rows. Counters of the other users involved are
+    reconciled batch by batch. `flask purge-accounts` finishes purges that
+    stalled.
+    """
+
+    __tablename__ = 'account_purges'
+
+    # Not a foreign key: the row outlives the user, as a record of the purge.
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    STAGES = ('timelines', 'likes_received', 'likes_given', 'messages',
+              'follows', 'suggestions', 'user')
+
+    @classmethod
+    def start(cls, user_id):
+        """Record a purge of `user_id` and queue its first batch."""
+
+        now = datetime.utcnow()
+        insert_ignoring_duplicates(
+            cls, user_id=user_id, stage=cls.STAGES[0],
+            started_at=now, updated_at=now)
+        jobs.enqueue('purge_user', user_id, key=f"purge_user:{user_id}")
+
+    def step(self):
+        """Delete the next batch; returns whether there's more to do.
+
+        A stage is done once a batch comes back short. Every batch deletes
+        whatever is left, so running one twice is harmless.
+        """
+
+        if self.finished_at is not None:
+            return False
+
+        deleted = getattr(self, f"purge_{self.stage}")()
+
+        now = datetime.utcnow()
+        self.rows_deleted += deleted
+        self.updated_at = now
+
+        if deleted < PURGE_BATCH_SIZE:
+            if self.stage == self.STAGES[-1]:
+                self.finished_at = now
+                return False
+            self.stage = self.STAGES[self.STAGES.index(self.stage) + 1]
+
+        return True
+
+    def purge_timelines(self):
+        """Their messages in followers' timelines, and their own timeline."""
+
+        return len(delete_batch(
+            TimelineEntry,
+            db.or_(TimelineEntry.author_id == self.user_id,
+                   TimelineEntry.user_id == self.user_id)))
+
+    def purge_likes_received(self):
+        """Likes of their messages."""
+
+        own_messages = (db.select(Message.id)
+                        .where(Message.user_id == self.user_id))
+        rows = delete_batch(Like, Like.message_id.in_(own_messages))
+
+        User.reconcile_counters({user_id for user_id, _ in rows})
+        return len(rows)
+
+    def purge_likes_given(self):
+        rows = delete_batch(Like, Like.user_id == self.user_id)
+
+        Message.reconcile_counters({message_id for _, message_id in rows})
+        return len(rows)
+
+    def purge_messages(self):
+        return len(delete_batch(Message, Message.user_id == self.user_id))
+
+    def purge_follows(self):
+        """Follows to and from them."""
+
+        rows = delete_batch(
+            Follows,
+            db.or_(Follows.user_being_followed_id == self.user_id,
+                   Follows.user_following_id == self.user_id))
+
+        User.reconcile_counters({user_id
+                                 for row in rows
+                                 for user_id in row
+                                 if user_id != self.user_id})
+        return len(rows)
+
+    def purge_suggestions(self):
+        """Suggestions of them (a popular account is in many lists) and to
+        them."""
+
+        return len(delete_batch(
+            FollowSuggestion,
+            db.or_(FollowSuggestion.suggested_id == self.user_id,
+                   FollowSuggestion.user_id == self.user_id)))
+
+    def purge_user(self):
+        """The (by now childless) user row itself."""
+
+        result = db.session.execute(
+            db.delete(User)
+            .where(User.id == self.user_id)
+            .where(User.deleted_at.isnot(None))
+            .execution_options(synchronize_session=False))
+        return result.rowcount
+
+
+def delete_batch(model, criterion):
+    """Delete up to PURGE_BATCH_SIZE rows of `model` matching `criterion`;
+    returns the deleted rows' primary keys."""
+
+    key = model.__mapper__.primary_key
+    rows = db.session.execute(
+        db.select(*key)
+        .where(criterion)
+        .limit(PURGE_BATCH_SIZE)
+        .execution_options(include_deleted=True)).all()
+
+    if rows:
+        in_batch = (key[0].in_([pk for (pk,) in rows]) if len(key) == 1
+                    else db.tuple_(*key).in_(rows))
+        db.session.execute(
+            db.delete(model)
+            .where(in_batch)
+            .execution_options(synchronize_session=False))
+
+    return rows
+
+
+# Ids of deleted (tombstoned) users, from the users table itself so the
+# criteria below don't apply to it; ix_users_deleted keeps this cheap.
+_deleted_user_ids = (db.select(User.__table__.c.id)
+                     .where(User.__table__.c.deleted_at.isnot(None)))
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _hide_deleted_users(state):
+    """Leave deleted users and their messages out of every ORM query,
+    unless it's run with execution_options(include_deleted=True)."""
+
+    if (not state.is_select
+            or state.is_column_load
+            or state.execution_options.get('include_deleted')):
+        return
+
+    state.statement = state.statement.options(
+        orm.with_loader_criteria(
+            User, User.deleted_at.is_(None), include_aliases=True),
+        orm.with_loader_criteria(
+            Message, Message.user_id.notin_(_deleted_user_ids),
+            include_aliases=True))
+
+
+##############################################################################
+# Background jobs (see jobs.py). Each may run more than once.
+
+
+@jobs.task('fan_out')
+def fan_out(message_id):
+    """Copy a new message into its author's followers' timelines."""
+
+    message = Message.query.get(message_id)
+    if message is not None:
+        TimelineEntry.fan_out(message)
+
+
+@jobs.task('retract_message')
+def retract_message(message_id):
+    """Remove a deleted message from every timeline it was in."""
+
+    TimelineEntry.retract(message_id)
+
+
+@jobs.task('sync_follow_timeline')
+def sync_follow_timeline(follower_id, followed_id):
+    """Backfill or clear a timeline after a follow or unfollow."""
+
+    TimelineEntry.sync_follow(follower_id, followed_id)
+
+
+@jobs.task('refresh_follow_suggestions')
+def refresh_follow_suggestions(user_ids):
+    """Recompute some users' "who to follow" suggestions."""
+
+    FollowSuggestion.refresh(user_ids)
+
+
+@jobs.task('compact_trending', every=TRENDING_COMPACT_INTERVAL)
+def compact_trending():
+    """Recompute the trending rankings."""
+
+    TrendingCount.compact()
+
+
+@jobs.task('purge_user')
+def purge_user(user_id):
+    """Delete a batch of a deleted account's rows, queueing the next batch
+    until they're all gone."""
+
+    purge = AccountPurge.query.get(user_id)
+    if purge is not None and purge.step():
+        #delayed, so eager mode runs the rest after the request, not in it
+        jobs.enqueue('purge_user', user_id, key=f"purge_user:{user_id}",
+                     delay=PURGE_BATCH_DELAY)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -208,5 +1588,8 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
+    db_pool.init_app(app)
     db.app = app
     db.init_app(app)
+    replica_router.init_app(app)
+    hasher.init_app(app)
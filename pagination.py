@@ -0,0 +1,80 @@
+"""Keyset (cursor) pagination for Warbler listings.
+
+Pages are read newest-first by a tuple of sort-key columns, e.g.
+(timestamp, id) for messages or (id,) for users. Instead of an OFFSET the
+next page starts strictly after the last row we showed, so fetching page 500
+costs the same single index range read as page 1.
+"""
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import tuple_
+
+Page = namedtuple("Page", ["items", "next_cursor"])
+
+
+def encode_cursor(values):
+    """Encode a row's sort-key values as an opaque, URL-safe cursor."""
+
+    raw = json.dumps(
+        [v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, types):
+    """Decode `cursor` into a tuple of values of the given `types`.
+
+    Returns None if the cursor is malformed.
+    """
+
+    try:
+        raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+
+        if not isinstance(values, list) or len(values) != len(types):
+            return None
+
+        return tuple(
+            datetime.fromisoformat(value) if kind is datetime else kind(value)
+            for kind, value in zip(types, values))
+
+    except (ValueError, TypeError):
+        return None
+
+
+def paginate(query, keys, before=None, per_page=50, item_key=None):
+    """Return one Page of `query`, ordered newest-first by `keys`.
+
+    `keys` are the sort-key columns; together they must be unique per row.
+    `before` is the next_cursor of the previous page (or None for the first
+    page); a malformed cursor aborts with a 400.
+
+    `item_key` pulls the key values out of a result row. By default each
+    key is read from the row attribute of the same name.
+    """
+
+    if item_key is None:
+        item_key = lambda item: [getattr(item, key.key) for key in keys]
+
+    if before:
+        after = decode_cursor(before, [key.type.python_type for key in keys])
+        if after is None:
+            abort(400)
+
+        if len(keys) == 1:
+            query = query.filter(keys[0] < after[0])
+        else:
+            query = query.filter(tuple_(*keys) < tuple_(*after))
+
+    #fetch one extra row to learn whether there's another page
+    rows = query.order_by(*[key.desc() for key in keys]).limit(per_page + 1).all()
+
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        return Page(rows, encode_cursor(item_key(rows[-1])))
+
+    return Page(rows, None)
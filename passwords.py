@@ -0,0 +1,113 @@
+"""Password hashing for Warbler, run in a bounded worker pool.
+
+bcrypt is slow on purpose, so a burst of logins can tie up every request
+thread at once. Hashes are computed in a small thread pool instead (bcrypt
+releases the GIL while it works): at most PASSWORD_HASH_WORKERS run at a
+time, at most PASSWORD_HASH_QUEUE more may wait, and anyone beyond that
+waits up to PASSWORD_HASH_TIMEOUT seconds for a slot before getting
+HashingBusy (which the app turns into a 503). Under gevent the pool still
+uses native threads, so a hash never blocks the other greenlets.
+
+The work factor is BCRYPT_LOG_ROUNDS. Hashes made with a different cost are
+flagged by needs_rehash, so they can be upgraded on the next good login.
+"""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+from flask_bcrypt import Bcrypt
+
+from instrumentation import instrumentation
+
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE = 8
+DEFAULT_TIMEOUT = 5
+
+bcrypt = Bcrypt()
+
+
+class HashingBusy(Exception):
+    """Too many password hashes are already running or waiting."""
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded pool; configure with init_app."""
+
+    def __init__(self):
+        self.app = None
+        self.executor = None
+        self.slots = None
+        self.timeout = DEFAULT_TIMEOUT
+
+    def init_app(self, app):
+        """Size the pool from `app`'s config."""
+
+        self.app = app
+        workers = app.config.setdefault('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS)
+        queue = app.config.setdefault('PASSWORD_HASH_QUEUE', DEFAULT_QUEUE)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', DEFAULT_TIMEOUT)
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+        self.executor = make_executor(workers)
+        self.slots = BoundedSemaphore(workers + queue)
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+
+    def run(self, fn, *args):
+        """Run fn(*args) in the pool and wait for the result.
+
+        Raises HashingBusy if no slot frees up within the timeout.
+        """
+
+        with instrumentation.timer('bcrypt'):
+            if not self.slots.acquire(timeout=self.timeout):
+                raise HashingBusy()
+
+            try:
+                return self.executor.submit(fn, *args).result()
+            finally:
+                self.slots.release()
+
+    @property
+    def log_rounds(self):
+        """The configured work factor (read live, so tests can lower it)."""
+
+        return self.app.config['BCRYPT_LOG_ROUNDS']
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        hashed = self.run(bcrypt.generate_password_hash, password, self.log_rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self.run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        #bcrypt hashes look like $2b$<cost>$<salt+hash>
+        return int(hashed.split('$')[2]) != self.log_rounds
+
+
+def make_executor(workers):
+    """A pool of `workers` native threads.
+
+    Once gevent has monkey-patched threading, ThreadPoolExecutor's threads
+    would be greenlets taking turns on one thread; gevent's executor keeps
+    real threads, with futures that greenlets can wait on.
+    """
+
+    if 'gevent' in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            from gevent.threadpool import ThreadPoolExecutor as GeventExecutor
+            return GeventExecutor(workers)
+
+    return ThreadPoolExecutor(workers, thread_name_prefix="bcrypt")
+
+
+hasher = PasswordHasher()
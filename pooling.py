@@ -0,0 +1,180 @@
+"""Database connection pool setup for Warbler.
+
+Each process (each gunicorn worker) holds its own pool, so the most
+connections the app can open is
+
+    workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+which has to stay under Postgres's max_connections (or PgBouncer's
+default_pool_size, if that's in front). Settings, all from the app config:
+
+- DB_POOL_SIZE: connections kept open (default 5)
+- DB_MAX_OVERFLOW: extra connections opened under load and closed when
+  returned (default 10)
+- DB_POOL_TIMEOUT: seconds a request waits for a free connection before
+  getting sqlalchemy.exc.TimeoutError, which the app turns into a 503
+  (default 10)
+- DB_POOL_RECYCLE: replace connections older than this many seconds, so
+  ones a firewall or the server dropped aren't handed out (default 1800;
+  -1 to never recycle)
+- DB_POOL_PRE_PING: test each connection before handing it out (default on)
+- DB_STATEMENT_TIMEOUT: cancel statements running longer than this many
+  milliseconds (default 0, no limit)
+- DB_PGBOUNCER: set when connecting through PgBouncer in transaction
+  pooling mode, where consecutive transactions may land on different
+  server connections. Nothing may then rely on per-session server state:
+  the statement timeout is applied with SET LOCAL at the start of every
+  transaction instead of as a startup option (which PgBouncer rejects).
+  psycopg2 never prepares statements on the server, so there's nothing
+  else to turn off.
+
+The pool reports checkout waits, checkout failures and how many
+connections are in use to the Prometheus metrics at /metrics.
+"""
+
+import time
+from weakref import WeakSet
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from instrumentation import instrumentation
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 10
+DEFAULT_POOL_RECYCLE = 1800
+
+CHECKOUT_BUCKETS = (.0005, .001, .005, .01, .05, .1, .5, 1, 5, 10, 30)
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that times checkouts and counts failed ones."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        db_pool.pools.add(self)
+
+    def _do_get(self):
+        started = time.perf_counter()
+
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            db_pool.checkout_failed('timeout')
+            raise
+        except Exception:
+            db_pool.checkout_failed('connect')
+            raise
+
+        instrumentation.metrics.observe(
+            'warbler_db_pool_checkout_seconds', {},
+            time.perf_counter() - started, CHECKOUT_BUCKETS)
+
+        return connection
+
+
+def engine_options(config, url):
+    """create_engine options for the database at `url`, from the DB_*
+    settings in `config` (which db_pool.init_app has filled in)."""
+
+    #SQLite gets SQLAlchemy's defaults: it has no server to pool
+    #connections to, and in-memory databases are one per connection
+    if url.startswith('sqlite'):
+        return {}
+
+    options = dict(
+        poolclass=TimedQueuePool,
+        pool_size=config['DB_POOL_SIZE'],
+        max_overflow=config['DB_MAX_OVERFLOW'],
+        pool_timeout=config['DB_POOL_TIMEOUT'],
+        pool_recycle=config['DB_POOL_RECYCLE'],
+        pool_pre_ping=config['DB_POOL_PRE_PING'],
+    )
+
+    timeout = int(config['DB_STATEMENT_TIMEOUT'])
+    if timeout and not config['DB_PGBOUNCER']:
+        options['connect_args'] = dict(options=f"-c statement_timeout={timeout}")
+
+    return options
+
+
+class DatabasePool:
+    """Builds the engine's pool options; configure with init_app before
+    the engine is first used."""
+
+    def __init__(self):
+        self.pools = WeakSet()
+        self.local_timeout = 0
+
+        metrics = instrumentation.metrics
+        metrics.describe(
+            'warbler_db_pool_checkout_seconds', 'histogram',
+            "Time to get a connection from the pool, including any wait.")
+        metrics.describe(
+            'warbler_db_pool_checkout_failures_total', 'counter',
+            "Failed pool checkouts, by reason (timeout or connect).")
+        metrics.describe(
+            'warbler_db_pool_connections', 'gauge',
+            "Pooled connections, by state (in_use or idle).")
+        metrics.describe(
+            'warbler_db_pool_capacity', 'gauge',
+            "Most connections the pool will open (size plus overflow).")
+        metrics.collector(self.collect)
+
+    def init_app(self, app):
+        """Put the pool settings in `app`'s SQLALCHEMY_ENGINE_OPTIONS."""
+
+        config = app.config
+        config.setdefault('DB_POOL_SIZE', DEFAULT_POOL_SIZE)
+        config.setdefault('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW)
+        config.setdefault('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT)
+        config.setdefault('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE)
+        config.setdefault('DB_POOL_PRE_PING', True)
+        config.setdefault('DB_STATEMENT_TIMEOUT', 0)
+        config.setdefault('DB_PGBOUNCER', False)
+
+        #Flask-SQLAlchemy falls back to an in-memory SQLite database
+        url = config.get('SQLALCHEMY_DATABASE_URI') or "sqlite://"
+
+        options = config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        for key, value in engine_options(config, url).items():
+            options.setdefault(key, value)
+
+        if config['DB_STATEMENT_TIMEOUT'] and config['DB_PGBOUNCER']:
+            self.local_timeout = int(config['DB_STATEMENT_TIMEOUT'])
+            if not event.contains(Engine, 'begin', self.set_local_timeout):
+                event.listen(Engine, 'begin', self.set_local_timeout)
+
+    def set_local_timeout(self, connection):
+        """Apply the statement timeout to the transaction just begun.
+
+        Run on a raw cursor, so it isn't counted as one of the request's
+        queries."""
+
+        if self.local_timeout:
+            cursor = connection.connection.cursor()
+            cursor.execute("SET LOCAL statement_timeout = %s", (self.local_timeout,))
+            cursor.close()
+
+    def checkout_failed(self, reason):
+        instrumentation.metrics.inc(
+            'warbler_db_pool_checkout_failures_total', dict(reason=reason))
+
+    def collect(self):
+        """Scrape-time gauges, summed over the live pools (an engine
+        replaces its pool after a disconnect)."""
+
+        in_use = idle = capacity = 0
+        for pool in list(self.pools):
+            in_use += pool.checkedout()
+            idle += pool.checkedin()
+            capacity += pool.size() + max(pool._max_overflow, 0)
+
+        yield 'warbler_db_pool_connections', dict(state='in_use'), in_use
+        yield 'warbler_db_pool_connections', dict(state='idle'), idle
+        yield 'warbler_db_pool_capacity', {}, capacity
+
+
+db_pool = DatabasePool()
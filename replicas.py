@@ -0,0 +1,153 @@
+"""Read-replica routing for Warbler.
+
+With DATABASE_REPLICA_URLS set (comma separated), the ORM session in
+models.py (RoutingSession) sends the statements of GET and HEAD requests to
+a replica and everything else to the primary. Reads fall back to the
+primary:
+
+- outside requests (seeding, the shell, migrations);
+- once the request has written anything, for the rest of the request;
+- for REPLICA_STICKY_SECONDS after the browser's last write, so a user sees
+  their own changes after the redirect (tracked in the session cookie);
+- when a replica is more than REPLICA_MAX_LAG seconds behind, or can't be
+  reached. Lag is checked at most every REPLICA_LAG_CHECK_INTERVAL seconds
+  per replica per process; if every replica is unhealthy, reads use the
+  primary.
+
+A request sticks to the replica it started on. Replicas may be any database
+SQLAlchemy can reach: locally a second Postgres database or an SQLite file
+works (it's never considered lagging), as long as it holds the same schema.
+"""
+
+import random
+import time
+from threading import Lock
+
+from flask import current_app, g, has_request_context, request, session
+from sqlalchemy import create_engine, text
+
+from pooling import engine_options
+
+DEFAULT_STICKY_SECONDS = 5
+DEFAULT_MAX_LAG = 2
+DEFAULT_LAG_CHECK_INTERVAL = 1
+
+SAFE_METHODS = ('GET', 'HEAD')
+
+# Session cookie key: time until which this browser reads from the primary
+PRIMARY_UNTIL_KEY = "primary_until"
+
+# Seconds a Postgres standby is behind; 0 on a primary, or on a standby
+# that has replayed everything it has received
+LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+
+class Replica:
+    """An engine for one replica, and its last known lag."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lag = 0.0
+        self.checked_at = None
+
+    def measure_lag(self):
+        """Seconds this replica is behind the primary (inf if unreachable)."""
+
+        if self.engine.dialect.name != 'postgresql':
+            return 0.0
+
+        try:
+            with self.engine.connect() as conn:
+                return float(conn.execute(LAG_QUERY).scalar() or 0)
+        except Exception:
+            return float('inf')
+
+
+class ReplicaRouter:
+    """Chooses where a session's reads go; configure with init_app."""
+
+    def __init__(self):
+        self.replicas = []
+        self.max_lag = DEFAULT_MAX_LAG
+        self.check_interval = DEFAULT_LAG_CHECK_INTERVAL
+        self.lock = Lock()
+
+    def init_app(self, app):
+        """Create engines for `app`'s replicas and track writes."""
+
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+        app.config.setdefault('REPLICA_MAX_LAG', DEFAULT_MAX_LAG)
+        app.config.setdefault('REPLICA_LAG_CHECK_INTERVAL', DEFAULT_LAG_CHECK_INTERVAL)
+
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.check_interval = app.config['REPLICA_LAG_CHECK_INTERVAL']
+
+        #same pool settings as the primary (see pooling.py)
+        self.replicas = [
+            Replica(create_engine(url, **engine_options(app.config, url)))
+            for url in app.config['SQLALCHEMY_REPLICA_URIS']]
+
+        app.after_request(self.remember_write)
+
+    def read_engine(self):
+        """The replica engine the current request should read from, or None
+        to use the primary."""
+
+        if not self.replicas or not has_request_context():
+            return None
+
+        if request.method not in SAFE_METHODS:
+            return None
+
+        if g.get('wrote_to_primary') or session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+            return None
+
+        if 'read_replica' not in g:
+            healthy = [replica for replica in self.replicas if self.healthy(replica)]
+            g.read_replica = random.choice(healthy).engine if healthy else None
+
+        return g.read_replica
+
+    def healthy(self, replica):
+        """Is `replica` within REPLICA_MAX_LAG? Re-measured at most every
+        REPLICA_LAG_CHECK_INTERVAL seconds."""
+
+        now = time.monotonic()
+
+        with self.lock:
+            due = (replica.checked_at is None
+                   or now - replica.checked_at >= self.check_interval)
+            if due:
+                #claim the check, so other threads use the last result meanwhile
+                replica.checked_at = now
+
+        if due:
+            replica.lag = replica.measure_lag()
+
+        return replica.lag <= self.max_lag
+
+    def wrote(self):
+        """Note that the current request committed a write."""
+
+        if has_request_context():
+            g.wrote_to_primary = True
+
+    def remember_write(self, response):
+        """After a write, read this browser's requests from the primary for
+        a while, so replica lag can't hide what it just did."""
+
+        if self.replicas and g.get('wrote_to_primary'):
+            sticky = current_app.config['REPLICA_STICKY_SECONDS']
+            session[PRIMARY_UNTIL_KEY] = time.time() + sticky
+
+        return response
+
+
+replica_router = ReplicaRouter()
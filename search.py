@@ -0,0 +1,447 @@
+"""User and message search for Warbler.
+
+On Postgres, searches run against indexes built by migrations:
+
+- a GIN index over to_tsvector('simple', username || bio || location), so
+  "ann port" finds users with words starting "ann" and "port" without the
+  sequential scan a LIKE '%q%' forces (0006);
+- a btree over lower(username) COLLATE "C", so typeahead is an index range
+  scan that stops after the first few usernames with the typed prefix (0006);
+- a GIN index over to_tsvector('english', messages.text) for warble search
+  (0007). Postgres updates it as rows are inserted and deleted.
+
+Other databases (SQLite in development) get in-memory stand-ins with the
+same behaviour: a word-prefix index for user search, a sorted username list
+for typeahead and an inverted index for messages. They're built from the
+database on first use and kept current by ORM events, per process.
+"""
+
+import math
+import re
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from datetime import datetime
+from threading import Lock
+
+from flask import abort
+from sqlalchemy import event
+
+from models import db, User, Message
+from pagination import Page, decode_cursor, encode_cursor, paginate
+
+SEARCH_LIMIT = 20
+TYPEAHEAD_LIMIT = 8
+MESSAGE_RESULTS_PER_PAGE = 50
+
+# Only the first few words of a query are used, and only the first
+# MAX_PREFIX characters of each word.
+MAX_TERMS = 5
+MAX_PREFIX = 20
+
+# Field weights for ranking: a username match counts more than bio/location.
+USERNAME_WEIGHT = 3
+OTHER_WEIGHT = 1
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lowercase words in `text`."""
+
+    return WORD_RE.findall((text or "").lower())
+
+
+class PrefixIndex:
+    """In-memory inverted index from word prefixes to weighted doc ids.
+
+    Every prefix of every word is a key, so a query word matches any indexed
+    word it's a prefix of. Docs are scored by the summed weight of the best
+    field each query word matched; an exact word match counts double.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.doc_prefixes = {}
+
+    def add(self, doc_id, fields):
+        """Index `doc_id` with `fields`, a list of (text, weight) pairs."""
+
+        self.remove(doc_id)
+        prefixes = set()
+
+        for text, weight in fields:
+            for word in tokenize(text):
+                word = word[:MAX_PREFIX]
+                for end in range(1, len(word) + 1):
+                    score = weight * 2 if end == len(word) else weight
+                    posting = self.postings[word[:end]]
+                    posting[doc_id] = max(posting.get(doc_id, 0), score)
+                    prefixes.add(word[:end])
+
+        self.doc_prefixes[doc_id] = prefixes
+
+    def remove(self, doc_id):
+        """Drop `doc_id` from the index, if it's there."""
+
+        for prefix in self.doc_prefixes.pop(doc_id, ()):
+            posting = self.postings[prefix]
+            posting.pop(doc_id, None)
+            if not posting:
+                del self.postings[prefix]
+
+    def search(self, query, limit):
+        """Return up to `limit` doc ids matching every word of `query`,
+        best first."""
+
+        terms = [term[:MAX_PREFIX] for term in tokenize(query)[:MAX_TERMS]]
+        if not terms:
+            return []
+
+        postings = [self.postings.get(term, {}) for term in terms]
+        postings.sort(key=len)
+
+        scores = dict(postings[0])
+        for posting in postings[1:]:
+            scores = {doc_id: score + posting[doc_id]
+                      for doc_id, score in scores.items() if doc_id in posting}
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [doc_id for doc_id, score in ranked[:limit]]
+
+
+class SortedKeys:
+    """Sorted (key, doc id) pairs, for prefix lookups by binary search."""
+
+    def __init__(self):
+        self.entries = []
+        self.doc_keys = {}
+
+    def add(self, doc_id, key):
+        self.remove(doc_id)
+        insort(self.entries, (key, doc_id))
+        self.doc_keys[doc_id] = key
+
+    def remove(self, doc_id):
+        key = self.doc_keys.pop(doc_id, None)
+        if key is not None:
+            self.entries.pop(bisect_left(self.entries, (key, doc_id)))
+
+    def starting_with(self, prefix, limit):
+        """Doc ids whose key starts with `prefix`, in key order."""
+
+        found = []
+        start = bisect_left(self.entries, (prefix,))
+
+        for key, doc_id in self.entries[start:start + limit]:
+            if not key.startswith(prefix):
+                break
+            found.append(doc_id)
+
+        return found
+
+
+class InvertedIndex:
+    """In-memory inverted index from words to message ids.
+
+    Keeps each message's timestamp too, for time-range filters. Matches
+    must contain every query word; they're scored by summed tf-idf.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.doc_words = {}
+        self.timestamps = {}
+
+    def add(self, doc_id, text, timestamp):
+        """Index message `doc_id`."""
+
+        self.remove(doc_id)
+        counts = Counter(tokenize(text))
+
+        for word, count in counts.items():
+            self.postings[word][doc_id] = count
+
+        self.doc_words[doc_id] = list(counts)
+        self.timestamps[doc_id] = timestamp
+
+    def remove(self, doc_id):
+        """Drop message `doc_id` from the index, if it's there."""
+
+        for word in self.doc_words.pop(doc_id, ()):
+            posting = self.postings[word]
+            posting.pop(doc_id, None)
+            if not posting:
+                del self.postings[word]
+
+        self.timestamps.pop(doc_id, None)
+
+    def search(self, query, since=None, until=None):
+        """Return (score, timestamp, doc_id) for every match, best first."""
+
+        terms = tokenize(query)[:MAX_TERMS]
+        if not terms:
+            return []
+
+        total = len(self.doc_words)
+        postings = sorted((self.postings.get(term, {}) for term in terms), key=len)
+
+        matches = set(postings[0])
+        for posting in postings[1:]:
+            matches.intersection_update(posting)
+
+        results = []
+        for doc_id in matches:
+            timestamp = self.timestamps[doc_id]
+            if (since and timestamp < since) or (until and timestamp >= until):
+                continue
+
+            score = sum(posting[doc_id] * math.log(1 + total / len(posting))
+                        for posting in postings)
+            results.append((score, timestamp, doc_id))
+
+        return sorted(results, reverse=True)
+
+
+class UserSearch:
+    """Ranked user search and username typeahead."""
+
+    def __init__(self):
+        self.words = None
+        self.usernames = None
+        self.lock = Lock()
+
+    @property
+    def uses_postgres(self):
+        return db.engine.dialect.name == "postgresql"
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Return up to `limit` users whose username, bio or location have
+        words starting with each word of `query`, best match first."""
+
+        if self.uses_postgres:
+            return self._pg_search(query, limit)
+
+        with self.lock:
+            ids = self._local().search(query, limit)
+        return self._users_in_order(ids)
+
+    def typeahead(self, prefix, limit=TYPEAHEAD_LIMIT):
+        """Return up to `limit` users whose username starts with `prefix`,
+        alphabetically."""
+
+        prefix = (prefix or "").lower()
+        if not prefix:
+            return []
+
+        if self.uses_postgres:
+            username = db.func.lower(User.username).collate("C")
+            return (User
+                    .query
+                    .filter(username.like(escape_like(prefix) + "%", escape="\\"))
+                    .order_by(username)
+                    .limit(limit)
+                    .all())
+
+        with self.lock:
+            self._local()
+            ids = self.usernames.starting_with(prefix, limit)
+        return self._users_in_order(ids)
+
+    def _pg_search(self, query, limit):
+        terms = [term[:MAX_PREFIX] for term in tokenize(query)[:MAX_TERMS]]
+        if not terms:
+            return []
+
+        #must match the index expression in migration 0006 exactly
+        document = db.func.to_tsvector(
+            db.literal_column("'simple'"),
+            db.func.coalesce(User.username, '') + ' '
+            + db.func.coalesce(User.bio, '') + ' '
+            + db.func.coalesce(User.location, ''))
+        tsquery = db.func.to_tsquery(
+            db.literal_column("'simple'"),
+            " & ".join(f"{term}:*" for term in terms))
+
+        return (User
+                .query
+                .filter(document.op("@@")(tsquery))
+                .order_by(db.func.ts_rank(document, tsquery).desc(),
+                          User.follower_count.desc(),
+                          User.id)
+                .limit(limit)
+                .all())
+
+    # In-memory fallback
+
+    def _local(self):
+        """The in-memory indexes, built from the users table on first use.
+
+        Callers hold self.lock.
+        """
+
+        if self.words is None:
+            self.words = PrefixIndex()
+            self.usernames = SortedKeys()
+            rows = db.session.query(
+                User.id, User.username, User.bio, User.location)
+            for row in rows:
+                self._index(row)
+
+        return self.words
+
+    def _index(self, user):
+        self.words.add(user.id, [(user.username, USERNAME_WEIGHT),
+                                 (user.bio, OTHER_WEIGHT),
+                                 (user.location, OTHER_WEIGHT)])
+        self.usernames.add(user.id, user.username.lower())
+
+    def _users_in_order(self, ids):
+        """Load users by id, keeping the order of `ids` and skipping any
+        that no longer exist."""
+
+        if not ids:
+            return []
+
+        users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+        return [users[user_id] for user_id in ids if user_id in users]
+
+    def user_changed(self, user):
+        """Keep the in-memory index current after `user` is saved."""
+
+        with self.lock:
+            if self.words is not None:
+                self._index(user)
+
+    def user_deleted(self, user):
+        """Keep the in-memory index current after `user` is deleted."""
+
+        with self.lock:
+            if self.words is not None:
+                self.words.remove(user.id)
+                self.usernames.remove(user.id)
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in `text` (with backslash as the escape)."""
+
+    return (text
+            .replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_"))
+
+
+class MessageSearch:
+    """Ranked full-text search over warbles, with time-range filters and
+    cursor pagination.
+
+    Results are ordered by (rank, timestamp, id), and cursors carry all
+    three, so paging through results never re-ranks or skips messages.
+    """
+
+    def __init__(self):
+        self.index = None
+        self.lock = Lock()
+
+    def search(self, query, since=None, until=None, before=None,
+               per_page=MESSAGE_RESULTS_PER_PAGE):
+        """Return a Page of messages matching `query`, best first.
+
+        `since` and `until` bound message timestamps (until is exclusive);
+        `before` is a previous page's next_cursor.
+        """
+
+        if db.engine.dialect.name == "postgresql":
+            return self._pg_search(query, since, until, before, per_page)
+
+        return self._local_search(query, since, until, before, per_page)
+
+    def _pg_search(self, query, since, until, before, per_page):
+        #must match the index expression in migration 0007 exactly
+        document = db.func.to_tsvector(db.literal_column("'english'"), Message.text)
+        tsquery = db.func.websearch_to_tsquery(db.literal_column("'english'"), query)
+        #ts_rank is a float4; the cursor round-trips it as a Python float
+        #(a float8), so sort, cursor and comparison all use it as a float8,
+        #or rows at a page boundary would repeat or be skipped
+        rank = db.cast(db.func.ts_rank(document, tsquery), db.Float(precision=53))
+
+        matches = (db.session
+                   .query(Message, rank)
+                   .options(db.joinedload(Message.user))
+                   .filter(document.op("@@")(tsquery)))
+        if since:
+            matches = matches.filter(Message.timestamp >= since)
+        if until:
+            matches = matches.filter(Message.timestamp < until)
+
+        page = paginate(matches,
+                        [rank, Message.timestamp, Message.id],
+                        before,
+                        per_page,
+                        item_key=lambda row: (row[1], row[0].timestamp, row[0].id))
+
+        return Page([msg for msg, rank in page.items], page.next_cursor)
+
+    def _local_search(self, query, since, until, before, per_page):
+        with self.lock:
+            results = self._local().search(query, since, until)
+
+        if before:
+            after = decode_cursor(before, [float, datetime, int])
+            if after is None:
+                abort(400)
+            results = [result for result in results if result < after]
+
+        shown = results[:per_page]
+        next_cursor = encode_cursor(shown[-1]) if len(results) > per_page else None
+
+        ids = [doc_id for score, timestamp, doc_id in shown]
+        messages = {msg.id: msg for msg in (Message
+                                            .query
+                                            .options(db.joinedload(Message.user))
+                                            .filter(Message.id.in_(ids)))}
+
+        return Page([messages[doc_id] for doc_id in ids if doc_id in messages],
+                    next_cursor)
+
+    def _local(self):
+        """The in-memory index, built from the messages table on first use.
+
+        Callers hold self.lock.
+        """
+
+        if self.index is None:
+            self.index = InvertedIndex()
+            rows = db.session.query(Message.id, Message.text, Message.timestamp)
+            for row in rows:
+                self.index.add(row.id, row.text, row.timestamp)
+
+        return self.index
+
+    def message_added(self, message):
+        """Add a newly-inserted `message` to the in-memory index."""
+
+        with self.lock:
+            if self.index is not None:
+                self.index.add(message.id, message.text, message.timestamp)
+
+    def message_deleted(self, message):
+        """Remove a deleted `message` from the in-memory index."""
+
+        with self.lock:
+            if self.index is not None:
+                self.index.remove(message.id)
+
+
+user_search = UserSearch()
+message_search = MessageSearch()
+
+event.listen(User, "after_insert",
+             lambda mapper, conn, user: user_search.user_changed(user))
+event.listen(User, "after_update",
+             lambda mapper, conn, user: user_search.user_changed(user))
+event.listen(User, "after_delete",
+             lambda mapper, conn, user: user_search.user_deleted(user))
+event.listen(Message, "after_insert",
+             lambda mapper, conn, msg: message_search.message_added(msg))
+event.listen(Message, "after_delete",
+             lambda mapper, conn, msg: message_search.message_deleted(msg))
@@ -1,19 +1,321 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Run it like:
 
-db.drop_all()
-db.create_all()
+    python seed.py                            # reset db, load generator/*.csv
+    python seed.py --data-dir data/ --defer-indexes
+    python seed.py --data-dir data/ --resume  # carry on after a failure
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+Each table is loaded from every <table>*.csv in the data directory, in name
+order, so sharded files (users-00000.csv, users-00001.csv, ...) work. Rows
+are streamed in chunks of --chunk-size and each chunk is committed on its
+own, so memory use stays flat however big the files are. On Postgres chunks
+go in with COPY FROM STDIN; elsewhere with executemany INSERTs.
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+Progress is recorded in a seed_progress table in the same transaction as
+each chunk, so --resume picks up exactly where a failed run stopped.
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+--defer-indexes (Postgres only) drops the secondary indexes and foreign keys
+on the seeded tables before loading and recreates them at the end, which is
+much faster than maintaining them row by row. Their definitions are saved in
+seed_deferred so a resumed run can still restore them.
 
-db.session.commit()
+Users and messages without an id column get ids in file order (1, 2, ...),
+which is what the message/follow/like CSVs refer to.
+"""
+
+import argparse
+import csv
+import io
+import os
+import time
+from datetime import datetime
+from glob import glob
+from itertools import islice
+
+from flask_migrate import downgrade, upgrade
+from sqlalchemy import bindparam, text
+
+from app import app, db
+from models import Message, User, TimelineEntry
+
+# (table, whether rows need ids assigned when the CSV has none)
+TABLES = [
+    ('users', True),
+    ('messages', True),
+    ('follows', False),
+    ('likes', False),
+]
+
+# Tables whose indexes and foreign keys --defer-indexes drops during the
+# load. timeline_entries isn't loaded from CSV but is rebuilt afterwards.
+DEFERRED_TABLES = [table for table, assigns_ids in TABLES] + ['timeline_entries']
+
+DEFAULT_CHUNK_SIZE = 50_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--data-dir', default='generator')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--resume', action='store_true',
+                        help="continue a failed load instead of resetting the db")
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help="build indexes and foreign keys after loading (Postgres)")
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.data_dir, args.chunk_size, args.resume, args.defer_indexes)
+
+
+def seed(data_dir, chunk_size=DEFAULT_CHUNK_SIZE, resume=False, defer_indexes=False):
+    """Load every CSV in `data_dir`, then build timelines and counters."""
+
+    if not resume:
+        reset()
+
+    create_progress_tables()
+    is_postgres = db.engine.dialect.name == 'postgresql'
+
+    if defer_indexes and not is_postgres:
+        print("--defer-indexes is only supported on Postgres; ignoring it.")
+        defer_indexes = False
+
+    if defer_indexes:
+        drop_deferred()
+
+    for table, assigns_ids in TABLES:
+        for path in sorted(glob(os.path.join(data_dir, f"{table}*.csv"))):
+            load_file(table, path, assigns_ids, chunk_size, is_postgres)
+
+    restore_deferred()
+
+    if is_postgres:
+        reset_sequences()
+
+    step("timelines", TimelineEntry.rebuild)
+    step("counters", User.reconcile_counters)
+    step("like counts", Message.reconcile_counters)
+
+    drop_progress_tables()
+
+
+def reset():
+    """Migrate the database down to nothing and back up.
+
+    A failed --defer-indexes run leaves indexes and foreign keys dropped,
+    which the downgrade expects to find, so whatever it saved in
+    seed_deferred is restored first (on emptied tables, so that's quick).
+    """
+
+    create_progress_tables()
+
+    with db.engine.connect() as conn:
+        leftover = conn.execute(text("SELECT count(*) FROM seed_deferred")).scalar()
+
+    if leftover:
+        with db.engine.begin() as conn:
+            conn.execute(text(f"TRUNCATE {', '.join(DEFERRED_TABLES)} CASCADE"))
+        restore_deferred()
+
+    drop_progress_tables()
+    downgrade(revision="base")
+    upgrade()
+
+
+def drop_progress_tables():
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS seed_progress"))
+        conn.execute(text("DROP TABLE IF EXISTS seed_deferred"))
+
+
+def create_progress_tables():
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS seed_progress "
+            "(filename TEXT PRIMARY KEY, rows_loaded INTEGER NOT NULL)"))
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS seed_deferred "
+            "(name TEXT PRIMARY KEY, table_name TEXT NOT NULL, "
+            "kind TEXT NOT NULL, definition TEXT NOT NULL)"))
+
+
+def load_file(table, path, assigns_ids, chunk_size, is_postgres):
+    """Stream `path` into `table` a chunk at a time, skipping rows an
+    earlier run already committed."""
+
+    filename = os.path.basename(path)
+
+    with db.engine.connect() as conn:
+        done = conn.execute(
+            text("SELECT rows_loaded FROM seed_progress WHERE filename = :f"),
+            dict(f=filename)).scalar() or 0
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+
+        for _ in islice(reader, done):
+            pass
+
+        add_ids = assigns_ids and 'id' not in columns
+        if add_ids:
+            columns = ['id'] + columns
+            with db.engine.connect() as conn:
+                next_id = conn.execute(
+                    text(f"SELECT coalesce(max(id), 0) + 1 FROM {table}")).scalar()
+
+        started = time.monotonic()
+        loaded = 0
+
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                break
+
+            if add_ids:
+                rows = [[next_id + i] + row for i, row in enumerate(rows)]
+                next_id += len(rows)
+
+            with db.engine.begin() as conn:
+                if is_postgres:
+                    copy_rows(conn, table, columns, rows)
+                else:
+                    insert_rows(conn, table, columns, rows)
+
+                conn.execute(
+                    text("INSERT INTO seed_progress (filename, rows_loaded) "
+                         "VALUES (:f, :n) ON CONFLICT (filename) "
+                         "DO UPDATE SET rows_loaded = excluded.rows_loaded"),
+                    dict(f=filename, n=done + loaded + len(rows)))
+
+            loaded += len(rows)
+            elapsed = time.monotonic() - started
+            print(f"{filename}: {done + loaded:,} rows "
+                  f"({loaded / elapsed:,.0f} rows/s)")
+
+
+def copy_rows(conn, table, columns, rows):
+    """Load `rows` with Postgres COPY FROM STDIN."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+
+
+def insert_rows(conn, table, columns, rows):
+    """Load `rows` with a multi-row INSERT, converting each CSV field to
+    its column's type."""
+
+    table = db.metadata.tables[table]
+    columns = [table.c[name] for name in columns]
+
+    conn.execute(
+        table.insert(),
+        [{column.name: parse_field(column, value)
+          for column, value in zip(columns, row)}
+         for row in rows])
+
+
+def parse_field(column, value):
+    """A CSV field as a value of `column`'s Python type; empty is NULL, as
+    it is for COPY."""
+
+    if not isinstance(value, str):
+        return value
+
+    if value == '':
+        return None
+
+    kind = column.type.python_type
+    if kind is datetime:
+        return datetime.fromisoformat(value)
+
+    return kind(value)
+
+
+def drop_deferred():
+    """Drop secondary indexes and foreign keys on the seeded tables, saving
+    their definitions in seed_deferred."""
+
+    tables = bindparam('tables', expanding=True)
+
+    with db.engine.begin() as conn:
+        indexes = conn.execute(text(
+            "SELECT indexname, tablename, indexdef FROM pg_indexes "
+            "WHERE schemaname = current_schema() AND tablename IN :tables "
+            "AND indexname NOT IN (SELECT conname FROM pg_constraint)"
+        ).bindparams(tables), dict(tables=DEFERRED_TABLES)).all()
+
+        foreign_keys = conn.execute(text(
+            "SELECT conname, conrelid::regclass::text, pg_get_constraintdef(oid) "
+            "FROM pg_constraint "
+            "WHERE contype = 'f' AND conrelid::regclass::text IN :tables"
+        ).bindparams(tables), dict(tables=DEFERRED_TABLES)).all()
+
+        for name, table, definition in indexes:
+            save_deferred(conn, name, table, 'index', definition)
+            conn.execute(text(f'DROP INDEX "{name}"'))
+
+        for name, table, definition in foreign_keys:
+            save_deferred(conn, name, table, 'foreign key', definition)
+            conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+
+
+def save_deferred(conn, name, table, kind, definition):
+    conn.execute(
+        text("INSERT INTO seed_deferred (name, table_name, kind, definition) "
+             "VALUES (:name, :table, :kind, :definition)"),
+        dict(name=name, table=table, kind=kind, definition=definition))
+
+
+def restore_deferred():
+    """Recreate whatever drop_deferred dropped: indexes first, so the
+    foreign key checks can use them."""
+
+    with db.engine.connect() as conn:
+        deferred = conn.execute(text(
+            "SELECT name, table_name, kind, definition FROM seed_deferred "
+            "ORDER BY kind DESC, name")).all()
+
+    for name, table, kind, definition in deferred:
+        started = time.monotonic()
+
+        with db.engine.begin() as conn:
+            if kind == 'index':
+                conn.execute(text(definition))
+            else:
+                conn.execute(text(
+                    f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'))
+            conn.execute(text("DELETE FROM seed_deferred WHERE name = :name"),
+                         dict(name=name))
+
+        print(f"rebuilt {kind} {name} ({time.monotonic() - started:.1f}s)")
+
+
+def reset_sequences():
+    """Point id sequences past the ids we loaded explicitly."""
+
+    with db.engine.begin() as conn:
+        for table in ['users', 'messages']:
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"coalesce(max(id), 0) + 1, false) FROM {table}"))
+
+
+def step(name, fn):
+    """Run a whole-table maintenance step and report how long it took."""
+
+    started = time.monotonic()
+    fn()
+    db.session.commit()
+    print(f"built {name} ({time.monotonic() - started:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
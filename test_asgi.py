@@ -0,0 +1,75 @@
+"""ASGI serving tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+import asyncio
+import os
+import time
+from unittest import TestCase
+
+from asgiref.testing import ApplicationCommunicator
+from greenlet import greenlet
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
+
+from asgi import ThreadedWsgiToAsgi, app as asgi_app
+from models import db
+from app import app
+
+
+def get(application, path):
+    """Send a GET for `path` to an ASGI app; returns (status, body)."""
+
+    async def send():
+        communicator = ApplicationCommunicator(application, dict(
+            type='http', http_version='1.1', method='GET', scheme='http',
+            path=path, raw_path=path.encode(), query_string=b'', root_path='',
+            headers=[], server=('testserver', 80)))
+
+        await communicator.send_input(dict(type='http.request'))
+        start = await communicator.receive_output(5)
+        body = await communicator.receive_output(5)
+        return start['status'], body['body']
+
+    return send()
+
+
+class AsgiTestCase(TestCase):
+    def test_serves_app(self):
+        """The ASGI app serves the same pages as the WSGI one."""
+
+        status, body = asyncio.run(get(asgi_app, "/login"))
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"Welcome back.", body)
+
+    def test_requests_run_concurrently(self):
+        """Slow requests don't wait for each other."""
+
+        def slow_app(environ, start_response):
+            time.sleep(0.3)
+            start_response('200 OK', [])
+            return [b"done"]
+
+        application = ThreadedWsgiToAsgi(slow_app, threads=4)
+
+        async def four_requests():
+            return await asyncio.gather(*[get(application, "/") for _ in range(4)])
+
+        started = time.perf_counter()
+        results = asyncio.run(four_requests())
+
+        self.assertEqual(results, [(200, b"done")] * 4)
+        self.assertLess(time.perf_counter() - started, 0.9)
+
+    def test_session_per_greenlet(self):
+        """Each greenlet (as under gevent) gets its own database session."""
+
+        with app.app_context():
+            sessions = [greenlet(db.session).switch() for _ in range(2)]
+
+            self.assertIsNot(sessions[0], sessions[1])
+            self.assertIsNot(sessions[0], db.session())
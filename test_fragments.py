@@ -0,0 +1,142 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+import os
+from unittest import TestCase
+
+from flask_migrate import upgrade
+
+from fragments import LRUBackend, LocalMemcache, MemcachedBackend, fragment_cache
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
+
+from app import app, CURR_USER_KEY
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+with app.app_context():
+    upgrade()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BackendTestCase(TestCase):
+    def test_lru_eviction(self):
+        """The least recently used card goes first."""
+
+        backend = LRUBackend(max_items=2)
+        backend.set("a", 1, "A")
+        backend.set("b", 1, "B")
+        backend.get_many(["a"])
+        backend.set("c", 1, "C")
+
+        self.assertEqual(backend.get_many(["a", "b", "c"]),
+                         {"a": (1, "A"), "c": (1, "C")})
+
+        backend.delete("a")
+        self.assertEqual(backend.get_many(["a"]), {})
+
+    def test_memcached_stand_in(self):
+        """The stand-in evicts by size, and values survive the bytes trip."""
+
+        client = LocalMemcache(max_bytes=30)
+        backend = MemcachedBackend(client)
+
+        backend.set("a", 3, "<p>Ä</p>")
+        self.assertEqual(backend.get_many(["a"]), {"a": (3, "<p>Ä</p>")})
+
+        backend.set("b", 1, "x" * 20)
+        self.assertEqual(backend.get_many(["a", "b"]), {"b": (1, "x" * 20)})
+        self.assertLessEqual(client.size, 30)
+
+
+class FragmentViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u1.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+        self.client = app.test_client()
+
+    def get_as(self, user_id, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            return c.get(url).get_data(as_text=True)
+
+    def test_card_is_cached(self):
+        """A second render reuses the cached card."""
+
+        self.get_as(self.u1_id, f"/users/{self.u1_id}")
+
+        #change the text behind the cache's back
+        Message.query.filter_by(id=self.m1_id).update(dict(text="sneaky"))
+        db.session.commit()
+
+        html = self.get_as(self.u1_id, f"/users/{self.u1_id}")
+        self.assertIn("m1-text", html)
+        self.assertNotIn("sneaky", html)
+
+    def test_controls_per_viewer(self):
+        """Each viewer gets their own star in the shared card."""
+
+        self.get_as(self.u1_id, f"/users/{self.u1_id}")
+
+        html = self.get_as(self.u2_id, f"/users/{self.u1_id}")
+        self.assertIn(f"/messages/{self.m1_id}/like", html)
+
+        db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+        db.session.commit()
+
+        html = self.get_as(self.u2_id, f"/users/{self.u1_id}")
+        self.assertIn(f"/messages/{self.m1_id}/unlike", html)
+
+        html = self.get_as(self.u1_id, f"/users/{self.u1_id}")
+        self.assertNotIn(f"/messages/{self.m1_id}/like", html)
+        self.assertNotIn(f"/messages/{self.m1_id}/unlike", html)
+
+    def test_profile_edit_invalidates(self):
+        """Editing a profile re-renders that user's cards."""
+
+        self.get_as(self.u2_id, "/users")
+        self.get_as(self.u2_id, f"/users/{self.u1_id}")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/users/profile", data=dict(
+                username="renamed", email="u1@email.com",
+                image_url="", header_image_url="", bio="", location="",
+                password="password"))
+
+        self.assertIn("@renamed", self.get_as(self.u2_id, "/users"))
+        self.assertIn("@renamed", self.get_as(self.u2_id, f"/users/{self.u1_id}"))
+
+    def test_delete_forgets(self):
+        """Deleting a message drops its card."""
+
+        self.get_as(self.u1_id, f"/users/{self.u1_id}")
+        key = fragment_cache.key('message', self.m1_id)
+        self.assertIn(key, fragment_cache.backend.get_many([key]))
+
+        with self.client as c:
+            c.post(f"/messages/{self.m1_id}/delete")
+
+        self.assertEqual(fragment_cache.backend.get_many([key]), {})
@@ -0,0 +1,140 @@
+"""HTTP caching policy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+import os
+from unittest import TestCase
+
+from flask_migrate import upgrade
+
+from http_cache import STATIC_MAX_AGE, http_cache
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
+
+from app import app, CURR_USER_KEY
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+with app.app_context():
+    upgrade()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class StaticCacheTestCase(TestCase):
+    def test_fingerprinted_urls(self):
+        """Pages link static files with their content hash."""
+
+        version = http_cache.static_version('stylesheets/style.css')
+
+        resp = app.test_client().get("/login")
+        self.assertIn(f"/static/stylesheets/style.css?v={version}",
+                      resp.get_data(as_text=True))
+
+    def test_immutable_when_versioned(self):
+        """Versioned URLs are cached for good; others revalidate."""
+
+        version = http_cache.static_version('stylesheets/style.css')
+
+        with app.test_client() as c:
+            resp = c.get(f"/static/stylesheets/style.css?v={version}")
+            self.assertTrue(resp.cache_control.immutable)
+            self.assertTrue(resp.cache_control.public)
+            self.assertEqual(resp.cache_control.max_age, STATIC_MAX_AGE)
+            resp.close()
+
+            resp = c.get("/static/stylesheets/style.css?v=stale")
+            self.assertFalse(resp.cache_control.immutable)
+            self.assertTrue(resp.cache_control.no_cache)
+            resp.close()
+
+
+class PageCacheTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = u1.add_message("m1-text")
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+
+        self.client = app.test_client()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_not_modified(self):
+        """A repeat request with the ETag gets an empty 304."""
+
+        for url in ["/", f"/users/{self.u1_id}", f"/messages/{self.m1_id}"]:
+            with self.client as c:
+                self.login(c, self.u1_id)
+                resp = c.get(url)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertTrue(resp.headers['ETag'].startswith('W/'))
+                self.assertTrue(resp.cache_control.private)
+                self.assertIn('Last-Modified', resp.headers)
+
+                again = c.get(url, headers={'If-None-Match': resp.headers['ETag']})
+                self.assertEqual(again.status_code, 304)
+                self.assertEqual(again.get_data(), b"")
+                self.assertEqual(again.headers['ETag'], resp.headers['ETag'])
+
+    def test_changes_invalidate(self):
+        """Following, liking or another viewer all change the ETag."""
+
+        url = f"/users/{self.u1_id}"
+
+        with self.client as c:
+            self.login(c, self.u2_id)
+            etag = c.get(url).headers['ETag']
+
+            c.post(f"/users/follow/{self.u1_id}")
+            c.get("/")  #show (and so clear) the flash
+
+            resp = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+
+            c.post(f"/messages/{self.m1_id}/like")
+            c.get("/")
+
+            resp = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+
+            self.login(c, self.u1_id)
+            resp = c.get(url, headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_flash_skips_304(self):
+        """A pending flash message is always rendered."""
+
+        with self.client as c:
+            self.login(c, self.u2_id)
+            etag = c.get("/").headers['ETag']
+
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [("success", "Hi there")]
+
+            resp = c.get("/", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Hi there", resp.get_data(as_text=True))
+
+    def test_other_pages_not_stored(self):
+        """Pages without validators stay no-store."""
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+            self.assertTrue(c.get("/users").cache_control.no_store)
@@ -0,0 +1,133 @@
+"""Instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+import os
+from unittest import TestCase
+
+from flask_migrate import upgrade
+
+from instrumentation import Metrics
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
+
+from app import app, CURR_USER_KEY
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+with app.app_context():
+    upgrade()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MetricsTestCase(TestCase):
+    def test_render(self):
+        """Counters and histograms come out in the Prometheus text format."""
+
+        metrics = Metrics()
+        metrics.describe('hits_total', 'counter', "Hits.")
+        metrics.inc('hits_total', dict(page="/"))
+        metrics.inc('hits_total', dict(page="/"), 2)
+        metrics.observe('latency_seconds', {}, 0.3, buckets=(0.1, 0.5))
+
+        text = metrics.render()
+
+        self.assertIn("# TYPE hits_total counter", text)
+        self.assertIn('hits_total{page="/"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('latency_seconds_bucket{le="0.5"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn("latency_seconds_count 1", text)
+
+    def test_collector(self):
+        """Collectors add gauges at scrape time."""
+
+        metrics = Metrics()
+        metrics.describe('depth', 'gauge', "Queue depth.")
+        metrics.collector(lambda: [('depth', dict(queue="a"), 7)])
+
+        self.assertIn('depth{queue="a"} 7', metrics.render())
+
+
+class InstrumentationViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['N_PLUS_ONE_THRESHOLD'] = 20
+        app.config['METRICS_TOKEN'] = None
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_server_timing(self):
+        """Responses report query count, db and template time."""
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get("/users")
+
+            timing = resp.headers['Server-Timing']
+            self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+            self.assertIn("tpl;dur=", timing)
+            self.assertIn("app;dur=", timing)
+
+    def test_bcrypt_timing(self):
+        """Logging in reports time spent hashing."""
+
+        with self.client as c:
+            resp = c.post("/login", data=dict(username="u1", password="password"))
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn("bcrypt;dur=", resp.headers['Server-Timing'])
+
+    def test_metrics(self):
+        """/metrics counts requests by endpoint and status."""
+
+        with self.client as c:
+            self.login(c)
+            c.get("/users")
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(
+                'warbler_requests_total{endpoint="list_users",method="GET",status="200"}',
+                text)
+            self.assertIn('warbler_request_queries_count{endpoint="list_users"}', text)
+
+    def test_metrics_token(self):
+        """With METRICS_TOKEN set, /metrics needs it as a bearer token."""
+
+        app.config['METRICS_TOKEN'] = "sekrit"
+
+        with self.client as c:
+            self.assertEqual(c.get("/metrics").status_code, 401)
+
+            resp = c.get("/metrics", headers={'Authorization': "Bearer sekrit"})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_n_plus_one_logged(self):
+        """Requests over the query threshold are logged."""
+
+        app.config['N_PLUS_ONE_THRESHOLD'] = 1
+
+        with self.client as c:
+            self.login(c)
+
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                c.get("/users")
+
+            self.assertIn("GET /users ran", logs.output[0])
@@ -0,0 +1,363 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask_migrate import upgrade
+
+from instrumentation import instrumentation
+from jobs import jobs, job_table
+from models import (
+    db, AccountPurge, FollowSuggestion, Follows, Like, Message, User,
+    TimelineEntry, TRENDING_COMPACT_INTERVAL)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
+
+from app import app, CURR_USER_KEY
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+with app.app_context():
+    upgrade()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+attempts = []
+
+
+@jobs.task('test_flaky')
+def flaky(succeed_on):
+    attempts.append(len(attempts) + 1)
+    if len(attempts) < succeed_on:
+        raise RuntimeError("not yet")
+
+
+class JobQueueTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        #queue jobs, as in production, starting from an empty queue
+        db.session.execute(job_table.delete())
+        db.session.commit()
+        jobs.mode = 'queue'
+
+        app.config['JOBS_RETRY_DELAY'] = 0
+        attempts.clear()
+
+    def tearDown(self):
+        jobs.mode = 'eager'
+        app.config['JOBS_RETRY_DELAY'] = 10
+        db.session.rollback()
+
+    def queued(self):
+        #a connection of its own, so it only sees committed jobs
+        with db.engine.connect() as conn:
+            rows = conn.execute(job_table.select().order_by(job_table.c.id))
+            return [dict(row) for row in rows.mappings()]
+
+    def test_enqueued_on_commit(self):
+        """Jobs reach the queue when the transaction commits, and not at
+        all if it rolls back."""
+
+        jobs.enqueue('test_flaky', 1)
+        self.assertEqual(self.queued(), [])
+
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(self.queued(), [])
+
+        jobs.enqueue('test_flaky', 1)
+        db.session.commit()
+        self.assertEqual([job['name'] for job in self.queued()], ['test_flaky'])
+
+    def test_idempotency_key(self):
+        """A key matching a waiting job adds nothing; once that job has run,
+        the key can be queued again."""
+
+        for _ in range(3):
+            jobs.enqueue('test_flaky', 1, key="once")
+            db.session.commit()
+
+        self.assertEqual(len(self.queued()), 1)
+
+        jobs.work(burst=True)
+        jobs.enqueue('test_flaky', 1, key="once")
+        db.session.commit()
+
+        self.assertEqual([job['status'] for job in self.queued()], ['done', 'queued'])
+
+    def test_retries_then_fails(self):
+        """A failing job is retried, and kept as failed after the last try."""
+
+        app.config['JOBS_MAX_ATTEMPTS'] = 3
+
+        jobs.enqueue('test_flaky', 2)
+        jobs.enqueue('test_flaky', 100)
+        db.session.commit()
+
+        jobs.work(burst=True)
+
+        done, failed = self.queued()
+        self.assertEqual((done['status'], done['attempts']), ('done', 2))
+        self.assertEqual((failed['status'], failed['attempts']), ('failed', 3))
+        self.assertIn("not yet", failed['error'])
+
+        app.config['JOBS_MAX_ATTEMPTS'] = 5
+
+    def test_failure_with_key_queued_again(self):
+        """A job that fails while its key is queued again leaves the retry
+        to the waiting job."""
+
+        jobs.enqueue('test_flaky', 2, key="same")
+        db.session.commit()
+        job = jobs.claim()
+
+        jobs.enqueue('test_flaky', 2, key="same")
+        db.session.commit()
+        self.assertFalse(jobs.run(job))
+
+        self.assertEqual([job['status'] for job in self.queued()],
+                         ['superseded', 'queued'])
+        self.assertEqual(jobs.work(burst=True), 1)
+
+    def test_expired_lease_is_reclaimed(self):
+        """A job whose worker died is picked up once its lease runs out."""
+
+        jobs.enqueue('test_flaky', 1)
+        db.session.commit()
+
+        app.config['JOBS_LEASE'] = -1
+        self.assertIsNotNone(jobs.claim())
+        app.config['JOBS_LEASE'] = 300
+
+        job = jobs.claim()
+        self.assertIsNotNone(job)
+        self.assertEqual(job['attempts'], 1)
+        self.assertIsNone(jobs.claim())
+
+    def test_claim_skips_locked_jobs(self):
+        """Workers sharing the queue never wait on or take a job another
+        worker is claiming."""
+
+        jobs.enqueue('test_flaky', 1)
+        jobs.enqueue('test_flaky', 1)
+        db.session.commit()
+        first, second = [job['id'] for job in self.queued()]
+
+        with db.engine.connect() as other_worker:
+            with other_worker.begin():
+                other_worker.execute(
+                    job_table.select()
+                    .where(job_table.c.id == first)
+                    .with_for_update())
+
+                self.assertEqual(jobs.claim()['id'], second)
+                self.assertIsNone(jobs.claim())
+
+    def test_periodic_task_reschedules_itself(self):
+        """Starting workers queues each periodic task once, and every run
+        queues the next."""
+
+        app.test_cli_runner().invoke(args=["run-jobs", "--burst"])
+        jobs.schedule_periodic()
+
+        compactions = [job for job in self.queued() if job['name'] == 'compact_trending']
+        self.assertEqual([job['status'] for job in compactions], ['done', 'queued'])
+
+        done, waiting = compactions
+        self.assertGreaterEqual(
+            (waiting['run_at'] - done['enqueued_at']).total_seconds(),
+            TRENDING_COMPACT_INTERVAL)
+
+    def test_metrics(self):
+        """Queue depth and lag are exported."""
+
+        jobs.enqueue('test_flaky', 1)
+        db.session.commit()
+
+        text = instrumentation.metrics.render()
+        self.assertIn('warbler_jobs{status="queued"} 1', text)
+        self.assertIn('warbler_jobs_lag_seconds', text)
+
+    def test_fan_out_in_background(self):
+        """A new message reaches followers' timelines once the job runs;
+        the author sees it at once."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post(f"/users/follow/{self.u1_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post("/messages/new", data={"text": "later"})
+
+        def timeline(user_id):
+            return TimelineEntry.query.filter_by(user_id=user_id).count()
+
+        self.assertEqual(timeline(self.u1_id), 1)
+        self.assertEqual(timeline(self.u2_id), 0)
+
+        #the follow's timeline sync and the fan-out (its suggestions
+        #refresh isn't due yet)
+        self.assertEqual(jobs.work(burst=True), 2)
+        self.assertEqual(timeline(self.u2_id), 1)
+
+        #running them again changes nothing
+        for job in self.queued():
+            jobs.run(job)
+        self.assertEqual(timeline(self.u2_id), 1)
+
+    def test_follow_refreshes_suggestions_later(self):
+        """A follow queues its user's suggestions refresh, which runs once
+        it's due."""
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+        User.query.get(self.u2_id).follow(u3)
+        db.session.commit()
+        u3_id = u3.id
+        jobs.work(burst=True)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post(f"/users/follow/{self.u2_id}")
+
+        #the timeline sync runs now; the refresh waits out its delay
+        self.assertEqual(jobs.work(burst=True), 1)
+        self.assertEqual(FollowSuggestion.query.filter_by(user_id=self.u1_id).count(), 0)
+
+        with db.engine.begin() as conn:
+            conn.execute(job_table.update()
+                         .where(job_table.c.name == 'refresh_follow_suggestions')
+                         .values(run_at=job_table.c.enqueued_at))
+
+        #u1's refresh, and u2's from following u3
+        self.assertEqual(jobs.work(burst=True), 2)
+        self.assertEqual(
+            [user.id for user in FollowSuggestion.for_user(User.query.get(self.u1_id))],
+            [u3_id])
+
+    def test_retract_in_background(self):
+        """A deleted message's likes go with it; its timeline entries are
+        removed once the job runs."""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u2.follow(u1)
+        msg = u1.add_message("gone soon")
+        db.session.flush()
+        u2.like(msg)
+        db.session.commit()
+        msg_id = msg.id
+        jobs.work(burst=True)
+
+        def entries():
+            return TimelineEntry.query.filter_by(message_id=msg_id).count()
+
+        self.assertEqual(entries(), 2)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(Like.query.filter_by(message_id=msg_id).count(), 0)
+        self.assertEqual(entries(), 2)
+
+        self.assertEqual(jobs.work(burst=True), 1)
+        self.assertEqual(entries(), 0)
+
+    def test_delete_user_in_batches(self):
+        """A deleted account is hidden at once, then purged in small
+        batches that leave the other users' counters right."""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u2.follow(u1)
+        u1.follow(u2)
+        for n in range(5):
+            msg = u1.add_message(f"m{n}")
+            db.session.flush()
+            u2.like(msg)
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post("/users/delete")
+
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertIsNotNone(
+            User.query.execution_options(include_deleted=True).get(self.u1_id))
+
+        with patch('models.PURGE_BATCH_SIZE', 2), \
+                patch('models.PURGE_BATCH_DELAY', 0):
+            ran = jobs.work(burst=True)
+
+        self.assertGreater(ran, len(AccountPurge.STAGES))
+        db.session.expire_all()
+
+        purge = AccountPurge.query.get(self.u1_id)
+        self.assertIsNotNone(purge.finished_at)
+        self.assertEqual(
+            User.query.execution_options(include_deleted=True).get(self.u1_id),
+            None)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual((u2.following_count, u2.follower_count, u2.liked_count),
+                         (0, 0, 0))
+
+    def test_eager_runs_delayed_jobs_afterwards(self):
+        """In eager mode a delayed job waits for the app context to end,
+        then runs, with the jobs it delays in turn; so a purge finishes."""
+
+        jobs.mode = 'eager'
+        u1 = User.query.get(self.u1_id)
+        for n in range(5):
+            u1.add_message(f"m{n}")
+        db.session.commit()
+
+        with patch('models.PURGE_BATCH_SIZE', 2):
+            with app.app_context():
+                u1.tombstone()
+                db.session.commit()
+
+                #one batch ran; the next is held back
+                purge = AccountPurge.query.get(self.u1_id)
+                self.assertIsNone(purge.finished_at)
+                self.assertEqual(len(jobs.delayed), 1)
+
+        self.assertEqual(len(jobs.delayed), 0)
+        db.session.expire_all()
+        self.assertIsNotNone(AccountPurge.query.get(self.u1_id).finished_at)
+        self.assertEqual(
+            Message.query.execution_options(include_deleted=True).count(), 0)
+
+    def test_eager_drops_delayed_jobs_on_error(self):
+        """A request that fails takes its delayed jobs with it."""
+
+        jobs.mode = 'eager'
+
+        with self.assertRaises(RuntimeError):
+            with app.app_context():
+                jobs.enqueue('test_flaky', 1, delay=1)
+                raise RuntimeError("view failed")
+
+        self.assertEqual(len(jobs.delayed), 0)
+        self.assertEqual(attempts, [])
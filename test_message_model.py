@@ -8,14 +8,18 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows, Like
+from flask_migrate import upgrade
+
+from models import db, User, Message, Follows, Like, TimelineEntry, Trending, TrendingCount
 #from sqlalchemy.exc import IntegrityError
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
 
 from app import app
 
-db.create_all()
+with app.app_context():
+    upgrade()
 
 
 class MessageModelTestCase(TestCase):
@@ -59,6 +63,38 @@ class MessageModelTestCase(TestCase):
 
         self.assertIn(m1, u1.messages)
 
+    def test_timeline_rebuild(self):
+        """Test rebuilding timelines from existing messages and follows."""
+
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=self.u2_id))
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        u1_timeline = {e.message_id for e in
+                       TimelineEntry.query.filter_by(user_id=self.u1_id)}
+        u2_timeline = {e.message_id for e in
+                       TimelineEntry.query.filter_by(user_id=self.u2_id)}
+
+        self.assertEqual(u1_timeline, {self.m1_id})
+        self.assertEqual(u2_timeline, {self.m1_id})
+
+    def test_timeline_rebuild_skips_self_follows(self):
+        """Test a user following themselves sees their messages once."""
+
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=self.u1_id))
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.assertEqual(
+            [e.message_id for e in TimelineEntry.query.filter_by(user_id=self.u1_id)],
+            [self.m1_id])
+
 
 ###################
 
@@ -133,3 +169,30 @@ class LikeModelTestCase(TestCase):
         result = u2.is_liked(m2)
 
         self.assertFalse(result)
+
+    def test_trending_decay(self):
+        """Test recent likes outweigh older ones, and counts past the window
+        are dropped."""
+
+        TrendingCount.query.delete()
+        now = TrendingCount.current_bucket()
+        db.session.add_all([
+            TrendingCount(kind='message', subject_id=self.m1_id,
+                          bucket=now - 12, count=3),
+            TrendingCount(kind='message', subject_id=self.m2_id,
+                          bucket=now, count=1),
+            TrendingCount(kind='message', subject_id=self.m2_id,
+                          bucket=now - 48, count=100),
+        ])
+        TrendingCount.compact()
+        db.session.commit()
+
+        #three likes two half-lives ago count for 0.75, one like now for 1
+        scores = [(t.subject_id, t.score)
+                  for t in Trending.query.filter_by(kind='message').order_by(Trending.rank)]
+        self.assertEqual(scores, [(self.m2_id, 1.0), (self.m1_id, 0.75)])
+        self.assertEqual(TrendingCount.query.count(), 2)
+
+        u1 = User.query.get(self.u1_id)
+        self.assertEqual([msg.id for msg in Trending.messages(u1).messages],
+                         [self.m2_id, self.m1_id])
@@ -6,9 +6,15 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, Message, User, Like
+from flask_migrate import upgrade
+from sqlalchemy import event
+
+from models import (
+    db, Message, User, Like, Follows, TimelineEntry, Trending, TrendingCount,
+    MESSAGES_PER_PAGE)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -16,18 +22,21 @@ from models import db, Message, User, Like
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from search import message_search
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
+# Create our tables by running the migrations (we do this here, so we
+# only create the tables once for all tests --- in each test, we'll delete
+# the data and create fresh new clean test data
 
-db.create_all()
+with app.app_context():
+    upgrade()
 
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
@@ -153,6 +162,38 @@ class MessageLikingViewTestCase(MessageBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Warble liked!", html)
 
+    def test_trending_page(self):
+        """ Test a liked message and a followed user show up as trending
+        once the rankings are compacted, and an unlike takes the message
+        back off. """
+        TrendingCount.query.delete()
+        Trending.query.delete()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.m1_id}/like")
+            c.post(f"/users/follow/{self.u1_id}")
+
+            #likes and follows only count; rankings change on compaction
+            html = c.get("/trending").get_data(as_text=True)
+            self.assertIn("Nothing's trending yet.", html)
+
+            app.test_cli_runner().invoke(args=["compact-trending"])
+            html = c.get("/trending").get_data(as_text=True)
+
+            self.assertIn("m1-text", html)
+            self.assertIn("Gaining followers", html)
+
+            c.post(f"/messages/{self.m1_id}/unlike")
+            app.test_cli_runner().invoke(args=["compact-trending"])
+            html = c.get("/trending").get_data(as_text=True)
+
+            self.assertNotIn("m1-text", html)
+            self.assertIn("Nothing's trending yet.", html)
+
     def test_liking_own_message(self):
         """Test that a user cannot like their own message."""
         with self.client as c:
@@ -206,4 +247,322 @@ class MessageLikingViewTestCase(MessageBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized.", html)
 
+    def test_like_and_unlike_are_idempotent(self):
+        """Test that repeated likes and unlikes are harmless no-ops."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            for _ in range(2):
+                resp = c.post(f"/messages/{self.m1_id}/like")
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(Like.query.filter_by(user_id=self.u2_id).count(), 1)
+            self.assertEqual(User.query.get(self.u2_id).liked_count, 1)
+            self.assertEqual(Message.query.get(self.m1_id).like_count, 1)
+
+            for _ in range(2):
+                resp = c.post(f"/messages/{self.m1_id}/unlike")
+                self.assertEqual(resp.status_code, 302)
+
+            db.session.expire_all()
+            self.assertEqual(Like.query.filter_by(user_id=self.u2_id).count(), 0)
+            self.assertEqual(User.query.get(self.u2_id).liked_count, 0)
+            self.assertEqual(Message.query.get(self.m1_id).like_count, 0)
+
+    def test_like_count_and_likers(self):
+        """Test cards show a message's like count, linking to a paged list
+        of who liked it."""
+        likers = [User.signup(f"liker{n}", f"liker{n}@email.com", "password", None)
+                  for n in range(3)]
+        db.session.flush()
+        m1 = Message.query.get(self.m1_id)
+        for liker in likers:
+            liker.like(m1)
+        db.session.commit()
+        liker_ids = [liker.id for liker in likers]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertIn(f'<a href="/messages/{self.m1_id}/likes" class="like-count">3</a>', html)
+
+            resp = c.get(f"/messages/{self.m1_id}/likes")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("3 users", html)
+            for n in range(3):
+                self.assertIn(f"@liker{n}", html)
+
+        m1 = Message.query.get(self.m1_id)
+        page = m1.likers(per_page=2)
+        self.assertEqual([user.id for user in page.items], liker_ids[:0:-1])
+        rest = m1.likers(page.next_cursor, per_page=2)
+        self.assertEqual(([user.id for user in rest.items], rest.next_cursor),
+                         (liker_ids[:1], None))
+
+class MessageTimelineViewTestCase(MessageBaseViewTestCase):
+    def test_new_message_fans_out_to_followers(self):
+        """Test that a new message lands on the author's and followers' timelines."""
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "fanned out"})
+            message = Message.query.filter_by(text="fanned out").one()
+
+            timeline_owners = {e.user_id for e in
+                               TimelineEntry.query.filter_by(message_id=message.id)}
+            self.assertEqual(timeline_owners, {self.u1_id, self.u2_id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get("/")
+            self.assertIn("fanned out", resp.get_data(as_text=True))
+
+    def test_follow_and_unfollow_update_timeline(self):
+        """Test that following backfills the timeline and unfollowing clears it."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/users/follow/{self.u1_id}")
+            resp = c.get("/")
+            self.assertIn("m1-text", resp.get_data(as_text=True))
+
+            c.post(f"/users/stop-following/{self.u1_id}")
+            resp = c.get("/")
+            self.assertNotIn("m1-text", resp.get_data(as_text=True))
+
+    def test_follow_and_unfollow_are_idempotent(self):
+        """Test that a double-submitted follow or unfollow counts once."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            for _ in range(2):
+                resp = c.post(f"/users/follow/{self.u1_id}")
+                self.assertEqual(resp.status_code, 302)
+
+            u1 = User.query.get(self.u1_id)
+            self.assertEqual(u1.follower_count, 1)
+            self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u2_id).count(), 1)
+
+            for _ in range(2):
+                resp = c.post(f"/users/stop-following/{self.u1_id}")
+                self.assertEqual(resp.status_code, 302)
+
+            db.session.expire_all()
+            self.assertEqual(User.query.get(self.u1_id).follower_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).following_count, 0)
+
+    def test_delete_message_retracts_from_timelines(self):
+        """Test that deleting a message removes it from every timeline."""
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/messages/{self.m1_id}/delete")
+
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id=self.m1_id).count(), 0)
+
+class MessagePaginationViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        #one more message than fits on a page, oldest first
+        start = datetime(2020, 1, 1)
+        db.session.add_all([
+            Message(text=f"paged-{i}",
+                    user_id=self.u1_id,
+                    timestamp=start + timedelta(minutes=i))
+            for i in range(MESSAGES_PER_PAGE + 1)
+        ])
+        db.session.commit()
+
+    def test_profile_pages_with_cursor(self):
+        """Test that the profile shows one page of messages and a cursor to the rest."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/users/{self.u1_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f"paged-{MESSAGES_PER_PAGE}<", html)
+            self.assertNotIn("paged-0<", html)
+            self.assertIn("Load more", html)
+
+            cursor = html.split("?before=")[1].split('"')[0]
+            resp = c.get(f"/users/{self.u1_id}?before={cursor}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("paged-0<", html)
+            self.assertNotIn(f"paged-{MESSAGES_PER_PAGE}<", html)
+            self.assertNotIn("Load more", html)
+
+    def test_bad_cursor(self):
+        """Test that a malformed cursor is a bad request."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/users/{self.u1_id}?before=not-a-cursor")
+
+            self.assertEqual(resp.status_code, 400)
+
+class MessageFeedQueryCountTestCase(MessageBaseViewTestCase):
+    def count_queries(self, url):
+        """Count SQL statements issued while fetching `url` as u2."""
+
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            #first request caches the identity snapshot in the session
+            c.get(url)
+
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = c.get(url)
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+
+        self.assertEqual(resp.status_code, 200)
+        return len(statements)
+
+    def add_followed_authors(self, prefix, count):
+        """Have u2 follow `count` new users who each post a message."""
+
+        for i in range(count):
+            author = User(username=f"{prefix}{i}",
+                          email=f"{prefix}{i}@email.com",
+                          password="unused")
+            db.session.add(author)
+            db.session.flush()
+            db.session.add(Message(text=f"by {prefix}{i}", user_id=author.id))
+            db.session.add(Follows(user_being_followed_id=author.id,
+                                   user_following_id=self.u2_id))
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+    def test_home_feed_query_count_is_constant(self):
+        """Test that the home feed costs the same number of queries however
+        many authors are on it."""
+
+        self.add_followed_authors("few", 1)
+        few = self.count_queries("/")
+
+        self.add_followed_authors("many", 10)
+        many = self.count_queries("/")
+
+        self.assertEqual(few, many)
+
+class MessageSearchViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        db.session.add_all([
+            Message(text="Spotted a heron by the river",
+                    user_id=self.u2_id,
+                    timestamp=datetime(2021, 5, 1)),
+            Message(text="Herons everywhere, herons! Such herons.",
+                    user_id=self.u2_id,
+                    timestamp=datetime(2022, 5, 1)),
+            Message(text="Nothing to see here",
+                    user_id=self.u2_id,
+                    timestamp=datetime(2022, 6, 1)),
+        ])
+        db.session.commit()
+
+    def search(self, query_string):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/messages/search?{query_string}")
+            self.assertEqual(resp.status_code, 200)
+            return resp.get_data(as_text=True)
+
+    def test_search_ranks_matches(self):
+        """Test that search finds stemmed matches, best first."""
+        html = self.search("q=heron")
+
+        self.assertIn("Spotted a heron", html)
+        self.assertIn("Herons everywhere", html)
+        self.assertNotIn("Nothing to see", html)
+        self.assertLess(html.index("Herons everywhere"),
+                        html.index("Spotted a heron"))
+
+    def test_search_time_range(self):
+        """Test that since/until bound the results (both inclusive)."""
+        html = self.search("q=heron&since=2021-01-01&until=2021-05-01")
+
+        self.assertIn("Spotted a heron", html)
+        self.assertNotIn("Herons everywhere", html)
+
+    def test_search_pages_with_cursor(self):
+        """Test paging through results one at a time."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            page = message_search.search("heron", per_page=1)
+            self.assertEqual(len(page.items), 1)
+            self.assertIn("Herons everywhere", page.items[0].text)
+
+            page = message_search.search("heron", before=page.next_cursor, per_page=1)
+            self.assertIn("Spotted a heron", page.items[0].text)
+            self.assertIsNone(page.next_cursor)
+
+    def test_search_pages_through_tied_ranks(self):
+        """Test paging one at a time through many equal and near-equal
+        ranks shows every match exactly once."""
+        db.session.add_all([
+            Message(text="heron " + "word " * (i % 7),
+                    user_id=self.u2_id,
+                    timestamp=datetime(2020, 1, 1 + i % 3))
+            for i in range(20)
+        ])
+        db.session.commit()
+
+        expected = Message.query.filter(Message.text.ilike("%heron%")).count()
+        seen = []
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            page = message_search.search("heron", per_page=1)
+            seen.extend(msg.id for msg in page.items)
+            while page.next_cursor and len(seen) <= expected:
+                page = message_search.search(
+                    "heron", before=page.next_cursor, per_page=1)
+                seen.extend(msg.id for msg in page.items)
+
+        self.assertEqual(len(seen), expected)
+        self.assertEqual(len(set(seen)), expected)
+
+    def test_search_logged_out(self):
+        """Test that search requires login."""
+        resp = self.client.get("/messages/search?q=heron", follow_redirects=True)
+
+        self.assertIn("Access unauthorized.", resp.get_data(as_text=True))
+
 #install Coverage
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pooling.py
+
+import os
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import Engine
+
+from instrumentation import instrumentation
+from pooling import TimedQueuePool, db_pool
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
+
+from app import app
+
+DATABASE_URL = app.config['SQLALCHEMY_DATABASE_URI']
+
+
+def engine_options(**config):
+    """The engine options db_pool gives an app with `config`."""
+
+    pool_app = Flask(__name__)
+    pool_app.config.update(config, SQLALCHEMY_DATABASE_URI=DATABASE_URL)
+    db_pool.init_app(pool_app)
+
+    return pool_app.config['SQLALCHEMY_ENGINE_OPTIONS']
+
+
+def make_engine(**config):
+    return create_engine(DATABASE_URL, **engine_options(**config))
+
+
+class PoolTestCase(TestCase):
+    def tearDown(self):
+        db_pool.local_timeout = 0
+        if event.contains(Engine, 'begin', db_pool.set_local_timeout):
+            event.remove(Engine, 'begin', db_pool.set_local_timeout)
+
+    def test_app_engine(self):
+        """The app's engine uses the configured, timed pool."""
+
+        with app.app_context():
+            from models import db
+            pool = db.engine.pool
+
+        self.assertIsInstance(pool, TimedQueuePool)
+        self.assertEqual(pool.size(), app.config['DB_POOL_SIZE'])
+        self.assertEqual(pool._max_overflow, app.config['DB_MAX_OVERFLOW'])
+        self.assertTrue(pool._pre_ping)
+
+    def test_checkout_timeout(self):
+        """An exhausted pool times out, and the failure is counted."""
+
+        engine = make_engine(DB_POOL_SIZE=1, DB_MAX_OVERFLOW=0, DB_POOL_TIMEOUT=0.1)
+        key = ('warbler_db_pool_checkout_failures_total', (('reason', 'timeout'),))
+        failures = instrumentation.metrics.counters[key]
+
+        with engine.connect():
+            metrics = instrumentation.metrics.render()
+            self.assertIn('warbler_db_pool_connections{state="in_use"} 1', metrics)
+
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+
+        self.assertEqual(instrumentation.metrics.counters[key], failures + 1)
+        self.assertIn("warbler_db_pool_checkout_seconds_count",
+                      instrumentation.metrics.render())
+        engine.dispose()
+
+    def test_statement_timeout(self):
+        """Slow statements are cancelled, with or without PgBouncer mode."""
+
+        for pgbouncer in (False, True):
+            engine = make_engine(DB_STATEMENT_TIMEOUT=50, DB_PGBOUNCER=pgbouncer)
+
+            with engine.connect() as conn, conn.begin():
+                with self.assertRaises(exc.OperationalError):
+                    conn.execute(text("SELECT pg_sleep(1)"))
+
+            engine.dispose()
+
+    def test_pgbouncer_mode_is_per_transaction(self):
+        """In PgBouncer mode the timeout doesn't outlive the transaction,
+        and isn't sent as a startup option."""
+
+        self.assertNotIn('connect_args',
+                         engine_options(DB_STATEMENT_TIMEOUT=1234, DB_PGBOUNCER=True))
+
+        engine = make_engine(DB_STATEMENT_TIMEOUT=1234, DB_PGBOUNCER=True)
+
+        with engine.connect() as conn:
+            with conn.begin():
+                self.assertEqual(
+                    conn.execute(text("SHOW statement_timeout")).scalar(), "1234ms")
+
+            self.assertEqual(
+                conn.exec_driver_sql("SHOW statement_timeout").scalar(), "0")
+
+        engine.dispose()
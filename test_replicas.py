@@ -0,0 +1,142 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from flask_migrate import upgrade
+from sqlalchemy import create_engine
+
+from models import db, User
+from replicas import PRIMARY_UNTIL_KEY, Replica, replica_router
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
+
+from app import app, CURR_USER_KEY
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+with app.app_context():
+    upgrade()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LaggingReplica(Replica):
+    def __init__(self, engine, lag):
+        super().__init__(engine)
+        self.measured_lag = lag
+        self.measurements = 0
+
+    def measure_lag(self):
+        self.measurements += 1
+        return self.measured_lag
+
+
+class ReplicaTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        #an SQLite file standing in for a replica, with the same schema
+        self.replica_dir = tempfile.TemporaryDirectory()
+        self.replica_engine = create_engine(
+            f"sqlite:///{self.replica_dir.name}/replica.db")
+        db.metadata.create_all(self.replica_engine)
+
+        self.replica = LaggingReplica(self.replica_engine, lag=0)
+        replica_router.replicas = [self.replica]
+
+    def tearDown(self):
+        replica_router.replicas = []
+        db.session.remove()
+        self.replica_engine.dispose()
+        self.replica_dir.cleanup()
+
+    def bind(self):
+        return db.session.get_bind(User.__mapper__)
+
+    def test_get_reads_replica(self):
+        """GET requests read from the replica; other requests, and code
+        outside requests, use the primary."""
+
+        with app.test_request_context("/users"):
+            self.assertIs(self.bind(), self.replica_engine)
+        db.session.remove()
+
+        with app.test_request_context("/users/follow/1", method="POST"):
+            self.assertIs(self.bind(), db.engine)
+        db.session.remove()
+
+        with app.app_context():
+            self.assertIs(self.bind(), db.engine)
+
+    def test_writes_use_primary(self):
+        """Once a request has written, it reads from the primary."""
+
+        with app.test_request_context("/"):
+            db.session.add(User(username="u2", email="u2@email.com", password="x"))
+            db.session.flush()
+
+            self.assertIs(self.bind(), db.engine)
+            db.session.rollback()
+
+    def test_sticky_after_write(self):
+        """A browser that just wrote reads from the primary for a while."""
+
+        with app.test_request_context("/"):
+            from flask import session
+            session[PRIMARY_UNTIL_KEY] = time.time() + 5
+            self.assertIs(self.bind(), db.engine)
+        db.session.remove()
+
+        with app.test_request_context("/"):
+            from flask import session
+            session[PRIMARY_UNTIL_KEY] = time.time() - 1
+            self.assertIs(self.bind(), self.replica_engine)
+
+    def test_lagging_replica_skipped(self):
+        """A replica too far behind isn't used; lag is checked at most once
+        per interval."""
+
+        self.replica.measured_lag = replica_router.max_lag + 1
+
+        for _ in range(3):
+            with app.test_request_context("/"):
+                self.assertIs(self.bind(), db.engine)
+            db.session.remove()
+
+        self.assertEqual(self.replica.measurements, 1)
+
+    def test_views(self):
+        """Pages read the replica, until the browser writes something."""
+
+        with self.replica_engine.begin() as conn:
+            conn.execute(User.__table__.insert(), dict(
+                id=self.u1_id, username="u1", email="u1@email.com", password="x"))
+            conn.execute(User.__table__.insert(), dict(
+                id=self.u1_id + 1, username="replica-only",
+                email="r@email.com", password="x"))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertIn("@replica-only", c.get("/users").get_data(as_text=True))
+
+            c.post("/users/profile", data=dict(
+                username="renamed", email="u1@email.com",
+                image_url="", header_image_url="", bio="", location="",
+                password="password"))
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("@renamed", html)
+            self.assertNotIn("@replica-only", html)
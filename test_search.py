@@ -0,0 +1,103 @@
+"""Search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+from datetime import datetime
+from unittest import TestCase
+
+from search import InvertedIndex, PrefixIndex, SortedKeys, escape_like
+
+
+class PrefixIndexTestCase(TestCase):
+    def setUp(self):
+        self.index = PrefixIndex()
+        self.index.add(1, [("annporter", 3), ("Loves hiking", 1), ("Portland", 1)])
+        self.index.add(2, [("portia", 3), ("Annual reports", 1), (None, 1)])
+        self.index.add(3, [("zed", 3), ("", 1), ("Annapolis", 1)])
+
+    def test_prefix_match(self):
+        """Every query word must prefix some indexed word."""
+
+        self.assertEqual(set(self.index.search("ann", 10)), {1, 2, 3})
+        self.assertEqual(self.index.search("ann port", 10), [1, 2])
+        self.assertEqual(self.index.search("hik", 10), [1])
+        self.assertEqual(self.index.search("nothing", 10), [])
+        self.assertEqual(self.index.search("!!!", 10), [])
+
+    def test_ranking_and_limit(self):
+        """Username matches outrank bio/location matches."""
+
+        self.assertEqual(self.index.search("port", 10), [2, 1])
+        self.assertEqual(self.index.search("port", 1), [2])
+
+    def test_reindex_and_remove(self):
+        """Re-adding a doc replaces its old words; removing drops it."""
+
+        self.index.add(3, [("hikingfan", 3)])
+        self.assertEqual(self.index.search("annap", 10), [])
+        self.assertEqual(self.index.search("hik", 10), [3, 1])
+
+        self.index.remove(1)
+        self.index.remove(1)
+        self.assertEqual(self.index.search("hik", 10), [3])
+        self.assertNotIn("annporte", self.index.postings)
+
+
+class SortedKeysTestCase(TestCase):
+    def test_starting_with(self):
+        """Prefix lookups come back in key order, limited."""
+
+        keys = SortedKeys()
+        for doc_id, key in [(1, "bob"), (2, "ann"), (3, "anna"), (4, "annie")]:
+            keys.add(doc_id, key)
+
+        self.assertEqual(keys.starting_with("ann", 10), [2, 3, 4])
+        self.assertEqual(keys.starting_with("ann", 2), [2, 3])
+        self.assertEqual(keys.starting_with("c", 10), [])
+
+        keys.add(3, "carl")
+        keys.remove(2)
+        self.assertEqual(keys.starting_with("ann", 10), [4])
+        self.assertEqual(keys.starting_with("c", 10), [3])
+
+    def test_escape_like(self):
+        """LIKE wildcards are escaped."""
+
+        self.assertEqual(escape_like("a_b%c\\"), "a\\_b\\%c\\\\")
+
+
+class InvertedIndexTestCase(TestCase):
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, "The heron and the river", datetime(2021, 1, 1))
+        self.index.add(2, "heron heron heron", datetime(2022, 1, 1))
+        self.index.add(3, "A quiet river", datetime(2023, 1, 1))
+
+    def test_search_ranks_and_filters(self):
+        """Matches need every word, rank by tf-idf and respect time ranges."""
+
+        self.assertEqual([doc for score, ts, doc in self.index.search("heron")],
+                         [2, 1])
+        self.assertEqual([doc for score, ts, doc in self.index.search("heron river")],
+                         [1])
+        self.assertEqual(
+            [doc for score, ts, doc in self.index.search(
+                "river", since=datetime(2022, 1, 1))],
+            [3])
+        self.assertEqual(
+            [doc for score, ts, doc in self.index.search(
+                "river", until=datetime(2022, 1, 1))],
+            [1])
+
+    def test_incremental_updates(self):
+        """Adding and removing messages updates results without a rebuild."""
+
+        self.index.add(4, "heron", datetime(2024, 1, 1))
+        self.index.remove(2)
+
+        self.assertEqual({doc for score, ts, doc in self.index.search("heron")},
+                         {1, 4})
+        self.assertNotIn(2, self.index.timestamps)
@@ -0,0 +1,82 @@
+"""Seeding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+
+import csv
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask_migrate import upgrade
+from sqlalchemy import text
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
+
+from app import app
+
+import seed
+
+with app.app_context():
+    upgrade()
+
+
+class SeedTestCase(TestCase):
+    def setUp(self):
+        #every generated user, and their first few messages
+        self.data_dir = tempfile.mkdtemp()
+        shutil.copy("generator/users.csv", self.data_dir)
+
+        with open("generator/messages.csv", newline='') as source, \
+                open(os.path.join(self.data_dir, "messages.csv"), 'w', newline='') as dest:
+            csv.writer(dest).writerows(row for row, _ in zip(csv.reader(source), range(21)))
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+        db.session.remove()
+
+        #leave an empty, fully migrated database for the other tests
+        with app.app_context():
+            seed.reset()
+
+    def index_names(self):
+        with db.engine.connect() as conn:
+            return {name for (name,) in conn.execute(text(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE schemaname = current_schema()"))}
+
+    def test_seed_with_deferred_indexes(self):
+        """Indexes dropped for the load are back afterwards."""
+
+        indexes = self.index_names()
+
+        with app.app_context():
+            seed.seed(self.data_dir, chunk_size=7, defer_indexes=True)
+
+        self.assertEqual(self.index_names(), indexes)
+        self.assertEqual(User.query.count(), 300)
+        self.assertEqual(Message.query.count(), 20)
+
+    def test_fresh_run_after_failed_deferred_run(self):
+        """A failed --defer-indexes run doesn't stop a fresh run from
+        resetting the database."""
+
+        indexes = self.index_names()
+
+        with app.app_context():
+            with patch('seed.load_file', side_effect=RuntimeError("disk full")):
+                with self.assertRaises(RuntimeError):
+                    seed.seed(self.data_dir, defer_indexes=True)
+
+            self.assertTrue(indexes - self.index_names())
+
+            seed.seed(self.data_dir)
+
+        self.assertEqual(self.index_names(), indexes)
+        self.assertEqual(Message.query.count(), 20)
@@ -7,8 +7,13 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, User, Message, Follows
+from flask_migrate import upgrade
+
+from flask import Flask
+from models import db, User, CurrentUser, Message, Follows, FollowSuggestion
+from passwords import PasswordHasher, HashingBusy
 from sqlalchemy.exc import IntegrityError
 
 # BEFORE we import our app, let's set an environmental variable
@@ -17,16 +22,18 @@ from sqlalchemy.exc import IntegrityError
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
 
 # Now we can import app
 
 from app import app
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
+# Create our tables by running the migrations (we do this here, so we
+# only create the tables once for all tests --- in each test, we'll delete
+# the data and create fresh new clean test data
 
-db.create_all()
+with app.app_context():
+    upgrade()
 
 
 class UserModelTestCase(TestCase):
@@ -117,6 +124,111 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(result)
 
+    def test_following_status(self):
+        """ Test following_status answers for a batch of ids at once, with
+        and without the cached following_ids set loaded."""
+
+        u1 = User.query.get(self.u1_id)
+
+        db.session.add(Follows(user_following_id=self.u1_id,
+                               user_being_followed_id=self.u2_id))
+        db.session.commit()
+
+        ids = [self.u1_id, self.u2_id, -1]
+        self.assertEqual(u1.following_status(ids), {self.u2_id})
+        self.assertEqual(u1.following_status([]), set())
+
+        self.assertTrue(u1.is_following(User.query.get(self.u2_id)))
+        self.assertNotIn('following_ids', u1.__dict__)
+
+        self.assertEqual(u1.following_ids, {self.u2_id})
+        self.assertEqual(u1.following_status(ids), {self.u2_id})
+        self.assertTrue(u1.is_following(User.query.get(self.u2_id)))
+
+    def test_forget_id_sets(self):
+        """ Test cached id sets are reloaded after forget_id_sets."""
+
+        u1 = User.query.get(self.u1_id)
+
+        self.assertNotIn(self.u2_id, u1.following_ids)
+
+        db.session.add(Follows(user_following_id=self.u1_id,
+                               user_being_followed_id=self.u2_id))
+        db.session.commit()
+        u1.forget_id_sets()
+
+        self.assertIn(self.u2_id, u1.following_ids)
+
+    def test_current_user_is_narrow(self):
+        """ Test CurrentUser answers identity and membership questions without
+        loading the full User, and loads it for anything else."""
+
+        current = CurrentUser.load(self.u1_id)
+
+        self.assertEqual(current.username, "u1")
+        self.assertFalse(current.is_following(User.query.get(self.u2_id)))
+        self.assertIsNone(current._user)
+
+        self.assertEqual(current.email, "u1@email.com")
+        self.assertIsNotNone(current._user)
+
+    def test_current_user_snapshot_versioning(self):
+        """ Test a cached snapshot is reused until the user's version changes,
+        and a deleted user loads as None."""
+
+        snapshot = CurrentUser.load(self.u1_id).snapshot
+        stale = dict(snapshot, username="old-name")
+
+        self.assertEqual(CurrentUser.load(self.u1_id, stale).username, "old-name")
+
+        u1 = User.query.get(self.u1_id)
+        u1.version = User.version + 1
+        db.session.commit()
+
+        self.assertEqual(CurrentUser.load(self.u1_id, stale).username, "u1")
+
+        self.assertIsNone(CurrentUser.load(-1))
+
+    def test_follow_suggestions(self):
+        """ Friends of friends and co-likers are suggested, best first,
+        and following one drops it from the list. """
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        u4 = User.signup("u4", "u4@email.com", "password", None)
+        db.session.flush()
+
+        u1.follow(u2)
+        u2.follow(u3)
+        u2.follow(u4)
+        msg = u2.add_message("shared")
+        db.session.flush()
+        u1.like(msg)
+        u4.like(msg)
+        FollowSuggestion.refresh([u1.id])
+        db.session.commit()
+
+        #u4 is followed by someone u1 follows and shares a like
+        self.assertEqual(FollowSuggestion.for_user(u1), [u4, u3])
+        self.assertEqual(
+            FollowSuggestion.query.get((u1.id, u4.id)).score, 1.5)
+
+        #too popular a message doesn't count as a shared taste
+        with patch('models.CO_LIKE_MAX_LIKES', 1):
+            FollowSuggestion.refresh([u1.id])
+        self.assertEqual(
+            FollowSuggestion.query.get((u1.id, u4.id)).score, 1.0)
+
+        #following takes a suggestion off at once
+        u1.follow(u4)
+        db.session.commit()
+        self.assertEqual(FollowSuggestion.for_user(u1), [u3])
+
+        u3.deleted_at = db.func.now()
+        FollowSuggestion.refresh([u1.id])
+        db.session.commit()
+        self.assertEqual(FollowSuggestion.for_user(u1), [])
+
     def test_user_signup_success(self):
         """ Upon User.signup, is a new user created successfully given valid
         credentials"""
@@ -163,3 +275,34 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(test)
 
+    def test_rehash_on_login_when_cost_changes(self):
+        """ A successful login re-hashes a password made at a different cost."""
+        u1 = User.query.get(self.u1_id)
+        old_hash = u1.password
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        try:
+            self.assertEqual(User.authenticate("u1", "password"), u1)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+        self.assertNotEqual(u1.password, old_hash)
+        self.assertTrue(u1.password.startswith("$2b$04$"))
+        self.assertTrue(u1.check_password("password"))
+
+    def test_hasher_applies_backpressure(self):
+        """ The hasher refuses work once every slot is taken."""
+        pool_app = Flask(__name__)
+        pool_app.config.update(PASSWORD_HASH_WORKERS=1,
+                               PASSWORD_HASH_QUEUE=0,
+                               PASSWORD_HASH_TIMEOUT=0.01,
+                               BCRYPT_LOG_ROUNDS=4)
+        hasher = PasswordHasher()
+        hasher.init_app(pool_app)
+
+        self.assertTrue(hasher.check(hasher.hash("password"), "password"))
+
+        hasher.slots.acquire()
+        with self.assertRaises(HashingBusy):
+            hasher.hash("password")
+        hasher.slots.release()
@@ -5,17 +5,23 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 import os
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User, Like, Follows
+from flask_migrate import upgrade
+
+from models import db, AccountPurge, Message, User, Like, Follows
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['JOBS_MODE'] = "eager"
 
 from app import app, CURR_USER_KEY
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
-db.create_all()
+with app.app_context():
+    upgrade()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
@@ -59,6 +65,48 @@ class UserProfileViewTestCase(UserBaseViewTestCase):
             self.assertIn("u1", html)
             self.assertIn("u2", html)
             
+    def test_search_users(self):
+        """ Test searching users by username, bio and location word prefixes. """
+        u2 = User.query.get(self.u2_id)
+        u2.bio = "Birdwatcher and baker"
+        u2.location = "Portland"
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users?q=bird port")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@u2", html)
+            self.assertNotIn("@u1", html)
+
+            resp = c.get("/users?q=nobody")
+            self.assertIn("Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_typeahead(self):
+        """ Test the username typeahead endpoint. """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users/typeahead?q=U")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([u["username"] for u in resp.json["users"]],
+                             ["u1", "u2"])
+
+            resp = c.get("/users/typeahead?q=u_")
+            self.assertEqual(resp.json["users"], [])
+
+    def test_typeahead_logged_out(self):
+        """ Test the typeahead endpoint requires login. """
+        resp = self.client.get("/users/typeahead?q=u")
+
+        self.assertEqual(resp.status_code, 401)
+
     def test_list_users_logged_out(self):
         """ Test user directory view for logged out user.  """
         with self.client as c:
@@ -124,6 +172,22 @@ class UserProfileViewTestCase(UserBaseViewTestCase):
             self.assertIn("NEW TEST LOCATION", html)
             self.assertIn("NEW TEST BIO", html)
 
+    def test_edit_profile_refreshes_cached_identity(self):
+        """ Test the nav reflects a profile edit on the very next request. """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get('/')
+            c.post('/users/profile', data={"username": "renamed",
+                                "email": "u1@email.com",
+                                "password": "password"})
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('alt="renamed"', html)
+
     def test_logged_in_edit_own_user_profile_bad_password(self):
         """ Test user cannot edit own profile with bad password. """
         with self.client as c:
@@ -177,6 +241,39 @@ class UserProfileViewTestCase(UserBaseViewTestCase):
             self.assertIn("User deleted!", html)
             self.assertNotIn((self.u1_id), all_user_ids)
             
+    def test_delete_purges_in_batches_after_the_request(self):
+        """ Test deleting in eager mode purges one batch in the request, and
+        the rest, a batch per transaction, once the request is over. """
+        with patch('models.PURGE_BATCH_SIZE', 1):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post('/users/delete')
+
+        db.session.expire_all()
+        self.assertIsNotNone(AccountPurge.query.get(self.u1_id).finished_at)
+        self.assertEqual(Message.query.execution_options(include_deleted=True).count(), 0)
+
+    def test_deleted_user_hidden(self):
+        """ Test a deleted user and their messages vanish before they're purged. """
+        u1 = User.query.get(self.u1_id)
+        u1.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            self.assertEqual(c.get(f"/users/{self.u1_id}").status_code, 404)
+            self.assertEqual(c.get(f"/messages/{self.m1_id}").status_code, 404)
+            self.assertNotIn("@u1", c.get("/users").get_data(as_text=True))
+            self.assertNotIn("m1-text",
+                             c.get(f"/users/{self.u2_id}/likes").get_data(as_text=True))
+
+            resp = c.post("/login", data={"username": "u1", "password": "password"})
+            self.assertIn("Invalid credentials", resp.get_data(as_text=True))
+
     def test_logged_out_delete_user_profile(self):
         """ Test user cannot delete their profile while logged out."""
         with self.client as c:
@@ -201,6 +298,36 @@ class UserFollowViewTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("u2",html)
 
+    def test_follow_updates_counters(self):
+        """ Test following and unfollowing keep both users' counters current. """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/follow/{self.u2_id}')
+
+            self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+            self.assertEqual(User.query.get(self.u2_id).follower_count, 1)
+
+            c.post(f'/users/stop-following/{self.u2_id}')
+
+            self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).follower_count, 0)
+
+    def test_follow_yourself_rejected(self):
+        """ Test following yourself is refused and leaves your timeline alone. """
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f'/users/follow/{self.u1_id}', follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("You can&#39;t follow yourself!", html)
+            self.assertEqual(Follows.query.count(), 0)
+            self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+
     def test_logged_out_follow_functionality(self):
         """ Test adding a follow when logged out. """
         with self.client as c:
@@ -286,9 +413,57 @@ class UserFollowViewTestCase(UserBaseViewTestCase):
             
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized.", html)
-            
+
+    def test_home_suggests_users_to_follow(self):
+        """ Test the home page sidebar shows who to follow, after a follow
+        refreshes the suggestions (once its request is over). """
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+        User.query.get(self.u2_id).follow(u3)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertNotIn("Who to follow", c.get("/").get_data(as_text=True))
+
+            c.post(f'/users/follow/{self.u2_id}')
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertIn("Who to follow", html)
+            self.assertIn("@u3", html)
+
 
 class UserLikeViewTestCase(UserBaseViewTestCase):
+    def test_reconcile_counters(self):
+        """Test reconciling counters from rows inserted behind the app's back"""
+
+        User.reconcile_counters()
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.message_count, 1)
+        self.assertEqual(u2.liked_count, 1)
+        self.assertEqual(u1.liked_count, 0)
+
+    def test_delete_message_updates_like_counters(self):
+        """Test deleting a liked message decrements its likers' counters"""
+
+        User.reconcile_counters()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{self.m1_id}/delete')
+
+        self.assertEqual(User.query.get(self.u1_id).message_count, 0)
+        self.assertEqual(User.query.get(self.u2_id).liked_count, 0)
+
     def test_like_page_logged_in(self):
         """Test like page on user profile"""
         with self.client as c: